@@ -19,6 +19,8 @@ import time
 import stat
 import glob
 import csv
+import hashlib
+import binascii
 if sys.version_info[0] > 2:
     basestring = str
     from io import StringIO
@@ -29,6 +31,11 @@ else:
 import requests
 import numpy
 import paramiko
+from paramiko.sftp import CMD_EXTENDED, CMD_EXTENDED_REPLY
+try:
+    from paramiko.sftp_client import int64
+except ImportError:
+    from paramiko.py3compat import long as int64
 
 
 def load_csv(text, delimiter=";"):
@@ -200,7 +207,8 @@ class CWInstanceConnection(object):
 
         return rset
 
-    def execute_with_sync(self, rql, sync_dir, timer=3, nb_tries=3):
+    def execute_with_sync(self, rql, sync_dir, timer=3, nb_tries=3,
+                          incremental=False, checksum=False):
         """ Method that loads the rset from a rql request through sftp protocol
         using the CWSearch mechanism.
 
@@ -216,6 +224,13 @@ class CWInstanceConnection(object):
         nb_tries: int (optional default 3)
             if the update has not been detected after 'nb_of_try' trials
             raise an exception.
+        incremental: bool (optional default False)
+            if set, synchronize an already downloaded CWSearch: only the
+            missing or modified files are downloaded.
+        checksum: bool (optional default False)
+            if set, compare the server side checksums of the files with the
+            local ones to detect the modified files and to verify the
+            transfers.
 
         Returns
         -------
@@ -264,7 +279,8 @@ class CWInstanceConnection(object):
             print("Autodetected sync parameters: '%s'", str(cw_params))
 
         # Copy the data with the sftp fuse mount point
-        self._get_server_dataset(sync_dir, cwsearch_title, cw_params)
+        self._get_server_dataset(sync_dir, cwsearch_title, cw_params,
+                                 incremental=incremental, checksum=checksum)
 
         # Load the rset
         local_dir = os.path.join(sync_dir, cwsearch_title)
@@ -375,14 +391,15 @@ class CWInstanceConnection(object):
     # Private Members
     ###########################################################################
 
-    def _get_server_dataset(self, sync_dir, cwsearch_title, cw_params):
+    def _get_server_dataset(self, sync_dir, cwsearch_title, cw_params,
+                            incremental=False, checksum=False):
         """ Download the CWSearch result trough a sftp connection.
 
         .. note::
 
             If a folder 'sync_dir' + 'cwsearch_title' is detected on the local
-            machine, no download is run. We assume that the CWSearch has already
-            been downloaded properly.
+            machine, no download is run unless 'incremental' is set. We assume
+            that the CWSearch has already been downloaded properly.
 
         Parameters
         ----------
@@ -392,6 +409,12 @@ class CWInstanceConnection(object):
             the title of the CWSearch that will be downloaded.
         cw_params: dict (mandatory)
             a dictionary containing cw/fuse parameters.
+        incremental: bool (optional default False)
+            if set, only download the missing or modified files of an already
+            downloaded CWSearch.
+        checksum: bool (optional default False)
+            if set, use the server side checksums to detect the modified
+            files and to verify the transfers.
         """
         # Build the mount point
         mount_point = os.path.join(
@@ -404,7 +427,7 @@ class CWInstanceConnection(object):
 
         # Get the local folder
         local_dir = os.path.join(sync_dir, cwsearch_title)
-        if os.path.isdir(local_dir):
+        if os.path.isdir(local_dir) and not incremental:
             print("The CWSearch '{0}' has been found at location "
                   "'{1}'. Do not download the data again.".format(
                     cwsearch_title, local_dir))
@@ -417,16 +440,22 @@ class CWInstanceConnection(object):
             if self.verbosity > 2:
                 print("Downloading: '%s' to '%s'", virtual_dir_to_sync,
                              local_dir)
-            self._sftp_get_recursive(virtual_dir_to_sync, local_dir, sftp)
+            self._sftp_get_recursive(virtual_dir_to_sync, local_dir, sftp,
+                                     checksum=checksum)
             if self.verbosity > 2:
                 print("Downloading done")
 
             sftp.close()
             transport.close()
 
-    def _sftp_get_recursive(self, path, dest, sftp):
+    def _sftp_get_recursive(self, path, dest, sftp, checksum=False):
         """ Recursive download of the data through a sftp connection.
 
+        The files already downloaded with the same size and modification
+        time, or with the same checksum if requested, are not downloaded
+        again. When the server does not compute the checksums, the size and
+        modification time comparison is used instead.
+
         Parameters
         ----------
         path: str (mandatory)
@@ -434,38 +463,177 @@ class CWInstanceConnection(object):
         dest: str (mandatory)
             the destination folder on the local machine.
         sftp: paramiko sftp connection (mandatory)
+        checksum: bool (optional default False)
+            if set, compare the server side checksums of the files with the
+            local ones and verify the transfers.
         """
-        # Go through the current sftp folder content
+        # Go through the current sftp folder content: stat all the items at
+        # once
         dir_items = sftp.listdir(path)
-        os.makedirs(dest)
-        for item in dir_items:
+        if not os.path.isdir(dest):
+            os.makedirs(dest)
+        item_paths = [os.path.join(path, item) for item in dir_items]
+        items_attrs = self._sftp_stat_many(item_paths, sftp)
+        for item, item_path, attrs in zip(dir_items, item_paths, items_attrs):
 
             # Construct the item absolute path
-            item_path = os.path.join(path, item)
             dest_path = os.path.join(dest, item)
 
             # If a directory is found
-            if self._sftp_isdir(item_path, sftp):
-                self._sftp_get_recursive(item_path, dest_path, sftp)
+            if attrs is not None and stat.S_ISDIR(attrs.st_mode):
+                self._sftp_get_recursive(item_path, dest_path, sftp,
+                                         checksum=checksum)
+                continue
+
+            # Skip the files already downloaded
+            if attrs is not None and os.path.isfile(dest_path):
+                local_stat = os.stat(dest_path)
+                if local_stat.st_size == attrs.st_size:
+                    remote_md5 = None
+                    if checksum:
+                        remote_md5 = self._sftp_checksum(item_path, sftp)
+                    # Without the server checksum extension, fall back to
+                    # the modification time comparison
+                    if remote_md5 is not None:
+                        if remote_md5 == self._local_checksum(dest_path):
+                            continue
+                    elif int(local_stat.st_mtime) == int(attrs.st_mtime):
+                        continue
+
+            # Otherwise transfer the data and keep the server modification
+            # time to detect the next modifications
+            if self.verbosity > 2:
+                print("Downloading: '{0}'".format(item_path))
+            sftp.get(item_path, dest_path)
+            if attrs is not None:
+                os.utime(dest_path, (attrs.st_atime, attrs.st_mtime))
+            if checksum:
+                remote_md5 = self._sftp_checksum(item_path, sftp)
+                if (remote_md5 is not None and
+                        remote_md5 != self._local_checksum(dest_path)):
+                    raise IOError("The transfer of '{0}' is corrupted: "
+                                  "checksums differ.".format(item_path))
+
+    def _sftp_stat_many(self, paths, sftp, chunk_size=1000):
+        """ Get the attributes of several distant paths through a sftp
+        connection.
+
+        The paths are stated by chunks with the 'stat-many@rql_download'
+        server extension when available, one by one otherwise.
 
-            # Otherwise transfer the data
-            else:
-                sftp.get(item_path, dest_path)
+        Parameters
+        ----------
+        paths: list of str (mandatory)
+            the sftp paths to stat.
+        sftp: paramiko sftp connection (mandatory)
+        chunk_size: int (optional default 1000)
+            the maximum number of paths stated in one request.
 
-    def _sftp_isdir(self, path, sftp):
-        """ Check if a distant path is a directory through a sftp connection.
+        Returns
+        -------
+        attrs: list of paramiko.SFTPAttributes
+            the paths attributes, None for the missing paths.
+        """
+        attrs = []
+        try:
+            for index in range(0, len(paths), chunk_size):
+                msg = self._sftp_extended_request(
+                    sftp, "stat-many@rql_download",
+                    json.dumps(paths[index: index + chunk_size]))
+                for item in json.loads(msg.get_string().decode("utf-8")):
+                    if item is None:
+                        attrs.append(None)
+                        continue
+                    item_attrs = paramiko.SFTPAttributes()
+                    item_attrs.st_size = item["size"]
+                    item_attrs.st_uid = item["uid"]
+                    item_attrs.st_gid = item["gid"]
+                    item_attrs.st_mode = item["permissions"]
+                    item_attrs.st_atime = item["atime"]
+                    item_attrs.st_mtime = item["mtime"]
+                    attrs.append(item_attrs)
+        except IOError:
+            # The server does not support the extension
+            attrs = []
+            for path in paths:
+                try:
+                    attrs.append(sftp.stat(path))
+                except IOError:
+                    attrs.append(None)
+        return attrs
+
+    def _sftp_checksum(self, path, sftp, algorithm="md5"):
+        """ Get the checksum of a distant file computed by the server with
+        the 'check-file-name' extension.
 
         Parameters
         ----------
         path: str (mandatory)
-            the sftp path to download.
+            the sftp path of the file.
         sftp: paramiko sftp connection (mandatory)
+        algorithm: str (optional default 'md5')
+            the hash algorithm.
+
+        Returns
+        -------
+        checksum: str
+            the file hexadecimal checksum, None if the server does not
+            support the extension.
         """
         try:
-            return stat.S_ISDIR(sftp.stat(path).st_mode)
-        #Path does not exist, so by definition not a directory
+            msg = self._sftp_extended_request(
+                sftp, "check-file-name", path, algorithm, int64(0),
+                int64(0), 0)
         except IOError:
-            return False
+            return None
+        if (msg.get_string() != b"check-file" or
+                msg.get_string().decode("utf-8") != algorithm):
+            return None
+        return binascii.hexlify(msg.get_remainder()).decode("utf-8")
+
+    def _sftp_extended_request(self, sftp, name, *args):
+        """ Send an extended request through a sftp connection.
+
+        Parameters
+        ----------
+        sftp: paramiko sftp connection (mandatory)
+        name: str (mandatory)
+            the extended request name.
+        args: list (optional)
+            the extended request arguments.
+
+        Returns
+        -------
+        msg: paramiko.Message
+            the extended reply data.
+        """
+        t, msg = sftp._request(CMD_EXTENDED, name, *args)
+        if t != CMD_EXTENDED_REPLY:
+            raise IOError("Expected an extended reply to '{0}'.".format(name))
+        return msg
+
+    def _local_checksum(self, path, algorithm="md5", block_size=1048576):
+        """ Compute the checksum of a local file.
+
+        Parameters
+        ----------
+        path: str (mandatory)
+            the local file path.
+        algorithm: str (optional default 'md5')
+            the hash algorithm.
+        block_size: int (optional default 1MB)
+            the size of each read.
+
+        Returns
+        -------
+        checksum: str
+            the file hexadecimal checksum.
+        """
+        digest = hashlib.new(algorithm)
+        with open(path, "rb") as open_file:
+            for block in iter(lambda: open_file.read(block_size), b""):
+                digest.update(block)
+        return digest.hexdigest()
 
     def _create_cwsearch(self, rql, export_type="cwsearch"):
         """ Method that creates a CWSearch entity from a rql.
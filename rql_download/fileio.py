@@ -0,0 +1,491 @@
+#! /usr/bin/env python
+##########################################################################
+# NSAp - Copyright (C) CEA, 2013
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+""" Low level file access tools shared by the fuse and sftp servers.
+"""
+
+# System import
+import os
+import Queue
+import hashlib
+import collections
+import itertools
+import ctypes
+import ctypes.util
+import threading
+
+
+def _libc_pread():
+    """ Build a 'pread' function on top of the C library.
+
+    The ctypes foreign call releases the GIL, so that concurrent readers are
+    not serialized by the interpreter.
+
+    Returns
+    -------
+    pread: callable
+        a function with the 'os.pread' signature.
+    """
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    cpread = getattr(libc, "pread64", None) or libc.pread
+    cpread.argtypes = (ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t,
+                       ctypes.c_int64)
+    cpread.restype = ctypes.c_ssize_t
+
+    def pread(fd, length, offset):
+        """ Read at most 'length' bytes from the file descriptor 'fd' at
+        position 'offset', leaving the file offset unchanged.
+        """
+        buf = ctypes.create_string_buffer(length)
+        nbytes = cpread(fd, buf, length, offset)
+        if nbytes < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return ctypes.string_at(buf, nbytes)
+
+    return pread
+
+
+# Positional read: no shared file offset, hence no lock between concurrent
+# readers of the same file descriptor (os.pread is only available from
+# python 3.3)
+pread = getattr(os, "pread", None) or _libc_pread()
+
+
+class ReadAheadCache(object):
+    """ Read-ahead buffers of the open files, with a global memory cap.
+
+    When sequential reads are detected on an opening of a file, the next
+    'window_size' bytes are prefetched by a background worker and the next
+    reads are served from memory. The memory held by all the buffers never
+    exceeds 'max_memory' bytes: the prefetch is skipped otherwise.
+
+    .. code-block:: python
+
+        cache = ReadAheadCache(window_size=8 * 1024 ** 2,
+                               max_memory=512 * 1024 ** 2)
+        read_ahead_file = cache.open(fd)
+        data = read_ahead_file.read(length, offset)
+        read_ahead_file.close()
+        os.close(fd)
+    """
+    def __init__(self, window_size, max_memory, nb_workers=8):
+        """ Initialize the ReadAheadCache class.
+
+        Parameters
+        ----------
+        window_size: int (mandatory)
+            the number of bytes prefetched at once.
+        max_memory: int (mandatory)
+            the maximum number of bytes held by all the buffers.
+        nb_workers: int (optional, default 8)
+            the number of concurrent prefetches.
+        """
+        self.window_size = window_size
+        self.max_memory = max_memory
+        self.memory = 0
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.workers = []
+        for index in range(nb_workers):
+            self.workers.append(threading.Thread(target=self._prefetch_loop))
+            # Start thread as daemon to be able to kill it nicely
+            self.workers[-1].daemon = True
+            self.workers[-1].start()
+
+    def open(self, fd):
+        """ Start tracking the reads of an opening of a file: each opening
+        has its own read-ahead state, even if the file descriptor is
+        shared.
+
+        Returns
+        -------
+        read_ahead_file: ReadAheadFile
+            the read-ahead state of the opening.
+        """
+        return ReadAheadFile(self, fd)
+
+    def reserve(self, size):
+        """ Reserve memory for a buffer: return False if the memory cap is
+        reached.
+        """
+        with self.lock:
+            if self.memory + size > self.max_memory:
+                return False
+            self.memory += size
+            return True
+
+    def drop(self, chunk):
+        """ Drop a buffer: its memory is given back once its prefetch is
+        done, the prefetch worker still fills it otherwise.
+        """
+        with self.lock:
+            chunk.dropped = True
+            if chunk.ready.is_set():
+                chunk.data = None
+                self.memory -= chunk.size
+
+    def _prefetch_loop(self):
+        """ Prefetch worker loop.
+        """
+        while True:
+            fd, chunk = self.queue.get()
+            try:
+                if not chunk.dropped:
+                    chunk.data = pread(fd, chunk.size, chunk.start)
+            except OSError:
+                chunk.data = None
+            finally:
+                with self.lock:
+                    if chunk.dropped:
+                        chunk.data = None
+                        self.memory -= chunk.size
+                    chunk.ready.set()
+
+
+class ReadAheadChunk(object):
+    """ A prefetched part of a file.
+    """
+    def __init__(self, start, size):
+        self.start = start
+        self.size = size
+        self.data = None
+        self.dropped = False
+        self.ready = threading.Event()
+
+
+class ReadAheadFile(object):
+    """ The read-ahead state of an opening of a file (see
+    'ReadAheadCache').
+
+    At most two chunks are held per opening: the one being read and the
+    next one, prefetched when the reader reaches the middle of the first
+    one.
+    """
+    nb_sequential_reads = 2
+
+    def __init__(self, cache, fd):
+        """ Initialize the ReadAheadFile class.
+
+        Parameters
+        ----------
+        cache: ReadAheadCache (mandatory)
+            the cache that owns the buffers.
+        fd: int (mandatory)
+            the open file descriptor.
+        """
+        self.cache = cache
+        self.fd = fd
+        self.lock = threading.Lock()
+        self.position = None
+        self.nb_sequential = 0
+        self.chunks = []
+        # The dropped chunks whose prefetch may still use the file
+        # descriptor
+        self.dropped = []
+
+    def read(self, length, offset):
+        """ Read at most 'length' bytes at position 'offset' of the file.
+        """
+        end = offset + length
+        with self.lock:
+
+            # Detect the sequential accesses: a random access outside the
+            # prefetched chunks drops them
+            if offset == self.position:
+                self.nb_sequential += 1
+            elif not any(chunk.start <= offset < chunk.start + chunk.size
+                         for chunk in self.chunks):
+                self.nb_sequential = 0
+                self._clear()
+            self.position = end
+
+            # Drop the consumed chunks and find the chunk containing the
+            # requested data
+            for chunk in [item for item in self.chunks
+                          if item.start + item.size <= offset]:
+                self._drop(chunk)
+            hit = None
+            for chunk in self.chunks:
+                if chunk.start <= offset and end <= chunk.start + chunk.size:
+                    hit = chunk
+
+            # Prefetch the next window when the reader reaches the middle of
+            # the last chunk
+            if self.nb_sequential >= self.nb_sequential_reads:
+                start = end
+                if len(self.chunks) > 0:
+                    last = self.chunks[-1]
+                    start = last.start + last.size
+                    if offset < last.start + last.size // 2:
+                        start = None
+                if (start is not None and len(self.chunks) < 2 and
+                        self.cache.reserve(self.cache.window_size)):
+                    chunk = ReadAheadChunk(start, self.cache.window_size)
+                    self.chunks.append(chunk)
+                    self.cache.queue.put((self.fd, chunk))
+
+        # Serve the read from memory: zero-copy slice of the chunk, the
+        # chunk data is kept alive by the slice even if the chunk is dropped
+        if hit is not None:
+            hit.ready.wait()
+            data = hit.data
+            if data is not None:
+                return buffer(data, offset - hit.start, length)
+        return pread(self.fd, length, offset)
+
+    def close(self):
+        """ Drop all the chunks and wait for the prefetches in progress, so
+        that the file descriptor can be closed safely.
+        """
+        with self.lock:
+            self._clear()
+            dropped, self.dropped = self.dropped, []
+        for chunk in dropped:
+            chunk.ready.wait()
+
+    def _clear(self):
+        """ Drop all the chunks.
+        """
+        for chunk in list(self.chunks):
+            self._drop(chunk)
+
+    def _drop(self, chunk):
+        """ Drop a chunk: its memory is given back by the cache once its
+        prefetch is done.
+        """
+        self.chunks.remove(chunk)
+        self.cache.drop(chunk)
+        self.dropped = [item for item in self.dropped
+                        if not item.ready.is_set()]
+        if not chunk.ready.is_set():
+            self.dropped.append(chunk)
+
+
+class SharedFiles(object):
+    """ Share one read-only file descriptor between all the concurrent
+    openings of a real file.
+
+    The files are read with positional reads, so that the readers never
+    need a private file offset. Each opening gets its own handle, with its
+    own read-ahead state. The file descriptor is closed when its last
+    opening is released.
+
+    .. code-block:: python
+
+        files = SharedFiles()
+        handle = files.open(real_path, os.O_RDONLY)
+        data = files.read(handle, length, offset)
+        files.release(handle)
+    """
+    def __init__(self, read_ahead=None):
+        """ Initialize the SharedFiles class.
+
+        Parameters
+        ----------
+        read_ahead: ReadAheadCache (optional, default None)
+            the read-ahead buffers of the open files, if any.
+        """
+        self.read_ahead = read_ahead
+        self.lock = threading.Lock()
+        self.files = {}  # (real path, flags) -> [fd, nb_references]
+        self.handles = {}  # handle -> (fd, (real path, flags), read-ahead)
+        self.handle_ids = itertools.count(1)
+
+    def open(self, real_path, flags, opener=None):
+        """ Open a real file or share its already opened file descriptor.
+
+        Parameters
+        ----------
+        real_path: str (mandatory)
+            the real file path.
+        flags: int (mandatory)
+            the 'os.open' flags.
+        opener: callable (optional, default None)
+            the function opening the file with the 'os.open' signature, ie.
+            with the permissions of a user, None to use 'os.open'.
+
+        Returns
+        -------
+        handle: int
+            the handle of the opening.
+        """
+        key = (real_path, flags)
+        with self.lock:
+            fd = None
+            if key in self.files:
+                self.files[key][1] += 1
+                fd = self.files[key][0]
+
+        # Do not hold the lock during the open: it may be slow on remote
+        # file systems
+        if fd is None:
+            fd = (opener or os.open)(real_path, flags)
+            with self.lock:
+                if key in self.files:
+                    self.files[key][1] += 1
+                    os.close(fd)
+                    fd = self.files[key][0]
+                else:
+                    self.files[key] = [fd, 1]
+
+        # Each opening tracks its own reads
+        read_ahead_file = None
+        if self.read_ahead is not None:
+            read_ahead_file = self.read_ahead.open(fd)
+        with self.lock:
+            handle = next(self.handle_ids)
+            self.handles[handle] = (fd, key, read_ahead_file)
+        return handle
+
+    def fileno(self, handle):
+        """ Get the file descriptor of an opening.
+        """
+        return self.handles[handle][0]
+
+    def read(self, handle, length, offset):
+        """ Read at most 'length' bytes at position 'offset' of an opening,
+        from its read-ahead buffers if possible.
+        """
+        fd, key, read_ahead_file = self.handles[handle]
+        if read_ahead_file is not None:
+            return read_ahead_file.read(length, offset)
+        return pread(fd, length, offset)
+
+    def release(self, handle):
+        """ Release an opening: the file descriptor is closed, once the
+        prefetches of the opening are done, with its last opening.
+        """
+        with self.lock:
+            fd, key, read_ahead_file = self.handles.pop(handle)
+        if read_ahead_file is not None:
+            read_ahead_file.close()
+        with self.lock:
+            self.files[key][1] -= 1
+            if self.files[key][1] > 0:
+                return
+            del self.files[key]
+        os.close(fd)
+
+
+def hash_range(read, size, algorithm, start=0, length=0, block_size=0,
+               max_blocks=None, chunk_size=1048576):
+    """ Hash a range of a file, at once or block by block.
+
+    Parameters
+    ----------
+    read: callable (mandatory)
+        a function with the 'pread' signature without the file descriptor
+        (length, offset).
+    size: int (mandatory)
+        the file size in bytes.
+    algorithm: str (mandatory)
+        a 'hashlib' algorithm name.
+    start: int (optional, default 0)
+        the first byte of the range.
+    length: int (optional, default 0)
+        the number of bytes of the range, 0 to hash up to the end of the file.
+    block_size: int (optional, default 0)
+        the size of the blocks hashed separately, 0 to hash the range at once.
+    max_blocks: int (optional, default None)
+        the maximum number of blocks, None for no limit.
+    chunk_size: int (optional, default 1MB)
+        the size of each read.
+
+    Returns
+    -------
+    hashes: str
+        the concatenated digests of the blocks.
+
+    .. note::
+        raise a 'ValueError' if the range has more than 'max_blocks' blocks.
+    """
+    end = size
+    if length > 0:
+        end = min(start + length, size)
+    block_size = block_size or max(end - start, 1)
+    nb_blocks = max(end - start + block_size - 1, block_size) // block_size
+    if max_blocks is not None and nb_blocks > max_blocks:
+        raise ValueError("{0} blocks requested, at most {1} blocks can be "
+                         "hashed at once.".format(nb_blocks, max_blocks))
+    digests = []
+    for block_start in range(start, max(end, start + 1), block_size):
+        block_end = min(block_start + block_size, end)
+        digest = hashlib.new(algorithm)
+        offset = block_start
+        while offset < block_end:
+            data = read(min(chunk_size, block_end - offset), offset)
+            if not data:
+                break
+            digest.update(data)
+            offset += len(data)
+        digests.append(digest.digest())
+    return "".join(digests)
+
+
+class FileHashes(object):
+    """ The hashes of ranges of the real files, cached by path, modification
+    time and size, so that a file is only hashed again when it changes.
+
+    .. code-block:: python
+
+        hashes = FileHashes()
+        fd = os.open(real_path, os.O_RDONLY)
+        md5 = hashes.hash(real_path, fd, "md5")
+        os.close(fd)
+    """
+    algorithms = ("md5", "sha1", "sha224", "sha256", "sha384", "sha512")
+
+    def __init__(self, max_entries=4096):
+        """ Initialize the FileHashes class.
+
+        Parameters
+        ----------
+        max_entries: int (optional, default 4096)
+            the maximum number of cached hashes: the oldest are dropped.
+        """
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.hashes = collections.OrderedDict()  # key -> hashes
+
+    def hash(self, real_path, fd, algorithm, start=0, length=0,
+             block_size=0, max_blocks=None):
+        """ Hash a range of an open real file: see 'hash_range'.
+
+        Parameters
+        ----------
+        real_path: str (mandatory)
+            the real file path.
+        fd: int (mandatory)
+            the open file descriptor.
+        algorithm, start, length, block_size, max_blocks: object (mandatory)
+            see 'hash_range'.
+
+        Returns
+        -------
+        hashes: str
+            the concatenated digests of the blocks.
+        """
+        status = os.fstat(fd)
+        key = (real_path, status.st_mtime, status.st_size, algorithm, start,
+               length, block_size)
+        with self.lock:
+            if key in self.hashes:
+                return self.hashes[key]
+
+        # Do not hold the lock during the hash: other files may be hashed
+        # concurrently
+        hashes = hash_range(lambda size, offset: pread(fd, size, offset),
+                            status.st_size, algorithm, start, length,
+                            block_size, max_blocks)
+        with self.lock:
+            self.hashes[key] = hashes
+            while len(self.hashes) > self.max_entries:
+                self.hashes.popitem(last=False)
+        return hashes
@@ -0,0 +1,298 @@
+#! /usr/bin/env python
+##########################################################################
+# NSAp - Copyright (C) CEA, 2013
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Benchmarks of the fuse data path against a local directory.
+
+> parallel reads exemple:
+    python benchmark.py -b reads -d /tmp/study -n 1,2,4,8,16
+
+> fuse performance profiles exemple (mount the directory in '/tmp/mnt'):
+    python benchmark.py -b profiles -d /tmp/study -m /tmp/mnt
+"""
+
+# System import
+import os
+import pwd
+import time
+import threading
+import subprocess
+from optparse import OptionParser
+
+# RQL download import
+from cubes.rql_download.fuse.fuse import FUSE
+from cubes.rql_download.fuse.fuse_mount import FuseRset
+from cubes.rql_download.fuse.fuse_mount import VirtualDirectory
+from cubes.rql_download.fuse.fuse_mount import FUSE_PROFILES
+from cubes.rql_download.fileio import SharedFiles
+
+
+def list_files(directory):
+    """ List recursively the regular files of a directory.
+
+    Parameters
+    ----------
+    directory: str (mandatory)
+        the local directory to scan.
+
+    Returns
+    -------
+    files: list of str
+        the file paths.
+    """
+    files = []
+    for root, dirnames, fnames in os.walk(directory):
+        for fname in fnames:
+            path = os.path.join(root, fname)
+            if os.path.isfile(path):
+                files.append(path)
+    return files
+
+
+def locked_read(lock):
+    """ Build the legacy read function: a global lock around a seek and
+    a read.
+    """
+    def read(path, length, offset, fh):
+        with lock:
+            os.lseek(fh, offset, os.SEEK_SET)
+            return os.read(fh, length)
+    return read
+
+
+def bench_parallel_reads(files, nb_readers, read_func, chunk_size=131072,
+                         shared_files=None):
+    """ Read all the files with 'nb_readers' concurrent threads, each
+    thread reading whole files chunk by chunk as the kernel does through
+    fuse.
+
+    Parameters
+    ----------
+    files: list of str (mandatory)
+        the files to read.
+    nb_readers: int (mandatory)
+        the number of concurrent readers.
+    read_func: callable (mandatory)
+        a function with the 'FuseRset.read' signature (path, length,
+        offset, fh).
+    chunk_size: int (optional, default 128KB)
+        the size of each read request.
+    shared_files: SharedFiles (optional, default None)
+        if set, open the files through these shared files and give their
+        handles to 'read_func', give the file descriptors otherwise.
+
+    Returns
+    -------
+    throughput: float
+        the aggregate read throughput in MB/s.
+    """
+    # Open all the files first as fuse does in 'FuseRset.open', then share
+    # them between the readers
+    if shared_files is not None:
+        open_func, close_func = shared_files.open, shared_files.release
+    else:
+        open_func, close_func = os.open, os.close
+    fds = [(path, open_func(path, os.O_RDONLY)) for path in files]
+    nb_bytes = [0] * nb_readers
+
+    def reader(index):
+        for path, fd in fds[index::nb_readers]:
+            offset = 0
+            while True:
+                data = read_func(path, chunk_size, offset, fd)
+                if not data:
+                    break
+                offset += len(data)
+                nb_bytes[index] += len(data)
+
+    try:
+        threads = [threading.Thread(target=reader, args=(index, ))
+                   for index in range(nb_readers)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.time() - start
+    finally:
+        for path, fd in fds:
+            close_func(fd)
+
+    return sum(nb_bytes) / (1024. * 1024.) / max(duration, 1e-9)
+
+
+def run_parallel_reads(directory, nb_readers_list, chunk_size=131072):
+    """ Compare the legacy locked reads with the positional reads of
+    'FuseRset.read' for an increasing number of readers.
+    """
+    files = list_files(directory)
+    if len(files) == 0:
+        raise ValueError("No file found in '{0}'.".format(directory))
+
+    # 'FuseRset.read' only needs the shared files of real files: do not
+    # connect any cw instance
+    fuse_rset = FuseRset.__new__(FuseRset)
+    fuse_rset.files = SharedFiles()
+    functions = [
+        ("lseek+read (global lock)", locked_read(threading.Lock()), None),
+        ("pread (lock-free)", fuse_rset.read, fuse_rset.files)
+    ]
+    print("{0} files in '{1}', {2} bytes chunks".format(
+        len(files), directory, chunk_size))
+    for name, read_func, shared_files in functions:
+        for nb_readers in nb_readers_list:
+            throughput = bench_parallel_reads(
+                files, nb_readers, read_func, chunk_size, shared_files)
+            print("{0:<26} readers={1:<4} {2:10.1f} MB/s".format(
+                name, nb_readers, throughput))
+
+
+class FixtureFuseRset(FuseRset):
+    """ A 'FuseRset' that exposes a local directory without any cw
+    instance.
+    """
+    def __init__(self, directory):
+        """ Build the virtual directory of a local directory.
+
+        Parameters
+        ----------
+        directory: str (mandatory)
+            the local directory to expose.
+        """
+        self.login = pwd.getpwuid(os.getuid()).pw_name
+        self.generate_log = False
+        self.files = SharedFiles()
+        self.fixture = VirtualDirectory(directory)
+        uid, gid, now = os.getuid(), os.getgid(), time.time()
+        self.fixture.make_directory("/", uid, gid, now)
+        for root, dirnames, fnames in os.walk(directory):
+            relpath = os.path.relpath(root, directory)
+            vroot = "" if relpath == "." else "/" + relpath
+            for dirname in dirnames:
+                self.fixture.make_directory(
+                    vroot + "/" + dirname, uid, gid, now)
+            for fname in fnames:
+                self.fixture.add_file(
+                    vroot + "/" + fname, os.path.join(root, fname), uid, gid)
+        self.fixture.add_real_sizes()
+
+    @property
+    def vdir(self):
+        """ The fixture virtual directory.
+        """
+        return self.fixture
+
+
+def bench_sequential_reads(directory, block_size=1048576):
+    """ Read sequentially all the files of a directory.
+
+    Returns
+    -------
+    throughput: float
+        the read throughput in MB/s.
+    """
+    nb_bytes = 0
+    start = time.time()
+    for path in list_files(directory):
+        with open(path, "rb") as open_file:
+            while True:
+                data = open_file.read(block_size)
+                if not data:
+                    break
+                nb_bytes += len(data)
+    duration = time.time() - start
+    return nb_bytes / (1024. * 1024.) / max(duration, 1e-9)
+
+
+def bench_metadata(directory):
+    """ List all the directories and stat all the items of a directory.
+
+    Returns
+    -------
+    ops: float
+        the number of metadata operations per second.
+    """
+    nb_ops = 0
+    start = time.time()
+    for root, dirnames, fnames in os.walk(directory):
+        nb_ops += 1
+        for name in dirnames + fnames:
+            os.stat(os.path.join(root, name))
+            nb_ops += 1
+    duration = time.time() - start
+    return nb_ops / max(duration, 1e-9)
+
+
+def run_profiles(directory, mount_point, profiles, nb_passes=2):
+    """ Mount a local directory with each fuse performance profile and
+    measure the sequential read throughput and the metadata operations rate.
+
+    The first pass is run with cold fuse caches, the next ones measure what
+    the kernel caches bring.
+    """
+    operations = FixtureFuseRset(directory)
+    print("{0} files in '{1}' mounted on '{2}'".format(
+        len(list_files(directory)), directory, mount_point))
+    for profile in profiles:
+        thread = threading.Thread(
+            target=FUSE, args=(operations, mount_point),
+            kwargs=dict(foreground=True, **FUSE_PROFILES[profile]))
+        thread.daemon = True
+        thread.start()
+        try:
+            while not os.path.ismount(mount_point):
+                time.sleep(0.1)
+            for index in range(nb_passes):
+                throughput = bench_sequential_reads(mount_point)
+                ops = bench_metadata(mount_point)
+                print("{0:<12} pass={1} {2:10.1f} MB/s {3:10.1f} "
+                      "metadata ops/s".format(
+                          profile, index + 1, throughput, ops))
+        finally:
+            subprocess.call(["fusermount", "-u", mount_point])
+            thread.join()
+
+
+if __name__ == "__main__":
+
+    # Parse the command line
+    parser = OptionParser()
+    parser.add_option("-b", "--bench", dest="bench", default="reads",
+                      type="choice", choices=("reads", "profiles"),
+                      help="the benchmark to run: parallel 'reads' or fuse "
+                           "performance 'profiles'.")
+    parser.add_option("-d", "--dir", dest="directory",
+                      help="the local directory containing the files to "
+                           "read.")
+    parser.add_option("-n", "--nbreaders", dest="nb_readers",
+                      default="1,2,4,8,16",
+                      help="comma separated numbers of parallel readers.")
+    parser.add_option("-c", "--chunksize", dest="chunk_size", type="int",
+                      default=131072,
+                      help="the size of each read request in bytes.")
+    parser.add_option("-m", "--mountpoint", dest="mount_point",
+                      help="the empty directory where the local directory "
+                           "is mounted by the 'profiles' benchmark.")
+    parser.add_option("-p", "--profiles", dest="profiles",
+                      default=",".join(sorted(FUSE_PROFILES)),
+                      help="comma separated fuse performance profiles.")
+    (options, args) = parser.parse_args()
+    if options.directory is None:
+        parser.error("a local directory is required.")
+
+    if options.bench == "reads":
+        run_parallel_reads(
+            options.directory,
+            [int(item) for item in options.nb_readers.split(",")],
+            options.chunk_size)
+    else:
+        if options.mount_point is None:
+            parser.error("a mount point is required.")
+        run_profiles(options.directory, options.mount_point,
+                     options.profiles.split(","))
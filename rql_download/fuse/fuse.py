@@ -253,6 +253,9 @@ class fuse_context(Structure):
 
 _libfuse.fuse_get_context.restype = POINTER(fuse_context)
 
+pythonapi.PyObject_AsReadBuffer.argtypes = (py_object, POINTER(c_void_p),
+                                            POINTER(c_ssize_t))
+
 
 class fuse_operations(Structure):
     _fields_ = [
@@ -333,6 +336,14 @@ def set_st_attrs(st, attrs):
             setattr(st, key, val)
 
 
+def buffer_address(obj):
+    'Returns the address of the memory exposed by a read-only buffer object'
+
+    address, size = c_void_p(), c_ssize_t()
+    pythonapi.PyObject_AsReadBuffer(obj, byref(address), byref(size))
+    return address.value
+
+
 def fuse_get_context():
     'Returns a (uid, gid, pid) tuple'
 
@@ -516,8 +527,12 @@ class FUSE(object):
         assert retsize <= size, \
             'actual amount read %d greater than expected %d' % (retsize, size)
 
-        data = create_string_buffer(ret, retsize)
-        memmove(buf, ret, retsize)
+        if isinstance(ret, bytes):
+            memmove(buf, ret, retsize)
+        else:
+            # Zero-copy slices (buffer objects): copy directly from the
+            # underlying memory
+            memmove(buf, buffer_address(ret), retsize)
         return retsize
 
     def write(self, path, buf, size, offset, fip):
@@ -16,11 +16,19 @@ import time
 import pwd
 import logging
 import datetime
-from threading import Lock
+import threading
+import Queue
 
 # CW import
 from cubicweb.cwconfig import CubicWebConfiguration as cwcfg
 
+# RQL download import
+from cubes.rql_download.fileio import ReadAheadCache
+from cubes.rql_download.fileio import SharedFiles
+from cubes.rql_download.pool import ConnectionPool
+from cubes.rql_download.index import SearchIndex
+from cubes.rql_download.index import get_index_file
+
 # Fuse import
 from cubes.rql_download.fuse.fuse import (FUSE,
                                           FuseOSError,
@@ -28,7 +36,8 @@ from cubes.rql_download.fuse.fuse import (FUSE,
                                           ENOENT,
                                           ENOTDIR,
                                           EROFS,
-                                          ENOTSUP)
+                                          ENOTSUP,
+                                          ENODATA)
 # Define the logger
 logger = logging.getLogger("fuse.log-mixin")
 
@@ -49,6 +58,35 @@ VID_TO_EXT = {
     "ejsonexport": ".json"
 }
 
+# Define the fuse mount options of each performance profile:
+# - default: every read and every stat goes through python.
+# - cached: the kernel caches the attributes and the directory entries, and
+#   keeps the files pages in its cache as long as their mtime is unchanged.
+# - throughput: as 'cached' but the files pages are always kept in the kernel
+#   cache (the real files are expected to be immutable) and the kernel sends
+#   larger read requests and reads ahead more.
+FUSE_PROFILES = {
+    "default": {},
+    "cached": {
+        "auto_cache": True,
+        "attr_timeout": 60,
+        "entry_timeout": 60,
+        "negative_timeout": 10
+    },
+    "throughput": {
+        "kernel_cache": True,
+        "attr_timeout": 300,
+        "entry_timeout": 300,
+        "negative_timeout": 30,
+        "max_read": 1048576,
+        "max_readahead": 1048576
+    }
+}
+
+# The exposed inodes are 64 bits integers: the real files inodes are mapped to
+# the lower half of the range, the virtual items to the upper half
+INODE_MASK = (1 << 63) - 1
+
 # The following import can be used to help debugging but is dangerous because
 # the content of all fuse actions (even the binary content of files) is
 # printed on the log. In order to debug is also necessary to add LoggingMixIn
@@ -56,9 +94,113 @@ VID_TO_EXT = {
 # from cubes.rql_download.fuse.fuse import LoggingMixIn
 
 
+def get_fuse_options(profile, extra_options=""):
+    """ Get the fuse mount options of a performance profile.
+
+    Parameters
+    ----------
+    profile: str (mandatory)
+        a performance profile name defined in 'FUSE_PROFILES'.
+    extra_options: str (optional, default '')
+        comma separated fuse mount options of the form 'name' or 'name=value'
+        that override the profile options.
+
+    Returns
+    -------
+    options: dict
+        the fuse mount options, True for the options without value.
+    """
+    if profile not in FUSE_PROFILES:
+        raise ValueError("Unknown fuse profile '{0}', expect one in "
+                         "'{1}'.".format(profile, sorted(FUSE_PROFILES)))
+    options = dict(FUSE_PROFILES[profile])
+    for option in extra_options.split(","):
+        option = option.strip()
+        if option == "":
+            continue
+        name, _, value = option.partition("=")
+        options[name] = value or True
+    return options
+
+
+class CWConfigFile(object):
+    """ The parsed options of a cw instance 'all-in-one.conf' configuration
+    file.
+
+    The file is parsed once and parsed again only when its modification time
+    changes.
+    """
+    option_re = re.compile(r"^([a-zA-Z0-9_-]+)=(\S*)$")
+
+    def __init__(self, config_file):
+        """ Initialize the CWConfigFile class.
+
+        Parameters
+        ----------
+        config_file: str (mandatory)
+            the path to the 'all-in-one.conf' configuration file.
+        """
+        self.config_file = config_file
+        self.mtime = None
+        self.options = {}
+        self.lock = threading.Lock()
+
+    def get(self, cw_option):
+        """ Get a cw option.
+
+        .. note::
+            raise an exception if the option is not declared in the
+            configuration file.
+
+        Parameters
+        ----------
+        cw_option: str (mandatory)
+            the cw option name.
+
+        Returns
+        -------
+        value: str
+            the option value.
+        """
+        mtime = os.stat(self.config_file).st_mtime
+        with self.lock:
+            if mtime != self.mtime:
+                self.options = self._parse()
+                self.mtime = mtime
+            options = self.options
+
+        # If the parameter is not found raise an exception
+        if cw_option not in options:
+            raise Exception("No '{0}' option has been declared in the '{1}' "
+                            "configuration file.".format(
+                                cw_option, self.config_file))
+        return options[cw_option]
+
+    def _parse(self):
+        """ Parse the configuration file: the first declaration of an option
+        is kept.
+        """
+        options = {}
+        with open(self.config_file) as open_file:
+            for line in open_file.readlines():
+                match = self.option_re.match(line)
+                if match:
+                    name, value = match.groups()
+                    options.setdefault(name, value)
+        return options
+
+
+# Define the parsed configuration files of the current process
+_config_files = {}
+_config_files_lock = threading.Lock()
+
+
 def get_cw_option(instance_name, cw_option):
     """ Get a cw option.
 
+    The instance configuration file is parsed once per process and shared
+    by all the mount points (see 'CWConfigFile').
+
     Parameters
     ----------
     instance_name: str (mandatory)
@@ -68,38 +210,74 @@ def get_cw_option(instance_name, cw_option):
 
     Returns
     -------
-    basedir: str
-        part of the image path to hide in the virtual fs.
+    value: str
+        the option value.
     """
     # Get the configuration file
-    config = cwcfg.config_for(instance_name)
-    config_file = os.path.join(
-        os.path.dirname(config.sources_file()), "all-in-one.conf")
+    with _config_files_lock:
+        if instance_name not in _config_files:
+            config = cwcfg.config_for(instance_name)
+            config_file = os.path.join(
+                os.path.dirname(config.sources_file()), "all-in-one.conf")
+            _config_files[instance_name] = CWConfigFile(config_file)
+        config_file = _config_files[instance_name]
 
-    # Parse the configuration file and retrive the basedir
-    with open(config_file) as open_file:
-        for line in open_file.readlines():
-            match = re.match(r"^([a-zA-Z0-9_-]+)=(\S*)$", line)
-            if match:
-                name, value = match.groups()
-                if name == cw_option:
-                    return value
+    return config_file.get(cw_option)
 
-    # If the basedir parameter is nor found raise an exception
-    raise Exception("No '{0}' option has been declared in the '{1}' "
-                    "configuration file.".format(cw_option, config_file))
+
+def real_inode(st):
+    """ Get the inode exposed for a real file: the real inode, mixed with
+    the real device so that the files of different devices do not collide.
+
+    Parameters
+    ----------
+    st: posix.stat_result (mandatory)
+        the real file stat.
+
+    Returns
+    -------
+    inode: int
+        an inode in the lower half of the inodes range.
+    """
+    return (st.st_ino ^ (st.st_dev << 40)) & INODE_MASK
+
+
+def virtual_inode(path):
+    """ Get the inode exposed for a virtual item (directory or rset file).
+
+    Parameters
+    ----------
+    path: str (mandatory)
+        the virtual path.
+
+    Returns
+    -------
+    inode: int
+        an inode in the upper half of the inodes range.
+    """
+    return (hash(path) & INODE_MASK) | (INODE_MASK + 1)
 
 
 class VirtualDirectory(object):
     """ Build an internal representation of a full virtual directory to allow
     easy and fast usge of this directory with fuse.
+
+    The real files stats are cached during 'stat_ttl' seconds.
+
+    The content of a CWSearch can also be served from its persistent index
+    (see 'add_index'): the index is then queried at each access instead of
+    being loaded in memory.
     """
+    stat_ttl = 60
+
     def __init__(self, root_data_dir):
         """ Creates an empty virtual directory.
 
-        The virtual directory can be populated with make_directory()
-        and add_file().
-        Its content can be accessed with stat(), listdir() and get_real_path().
+        The virtual directory can be populated with make_directory(),
+        add_file() and add_index(), and its totals completed with
+        add_real_sizes().
+        Its content can be accessed with stat(), listdir(), listdir_stat()
+        and get_real_path().
 
         Parameters
         ----------
@@ -110,6 +288,13 @@ class VirtualDirectory(object):
         self.root_data_dir = root_data_dir
         self.content = {}
         self.rset_data = {}
+        self.indexes = {}  # CWSearch name -> (index, uid, gid, time)
+        self.search_eids = {}  # CWSearch name -> CWSearch eid
+        self.nodes = {}  # real path -> file node shared by the searches
+        self.references = {}  # real path -> number of virtual files
+        self.stat_cache = {}  # real path -> (expiration time, stat)
+        self.nb_files = 0
+        self.nb_bytes = 0
 
     def make_directory(self, path, uid, gid, time):
         """ Create a virtual directory.
@@ -197,8 +382,12 @@ class VirtualDirectory(object):
 
         # Otherwise, create a new virtual file pointing to a real one
         else:
-            # File creation: point to the real file
-            self.content[path] = (real_path, uid, gid, None, None)
+            # File creation: point to the real file node, shared by all the
+            # virtual files referencing the same real file
+            node = self.nodes.setdefault(
+                real_path, (real_path, uid, gid, None, None))
+            self.content[path] = node
+            self.references[real_path] = self.references.get(real_path, 0) + 1
 
             # Link the current file to the global tree
             # > get the parent directory name and current file name
@@ -213,7 +402,79 @@ class VirtualDirectory(object):
                     "Virtual directory '{0}' does not exist".format(
                         parentdir_name))
 
-    def stat(self, path):
+            # Update the virtual directory totals: count the shared real
+            # files once, their size is added by 'add_real_sizes'
+            self.nb_files += 1
+            if file_name.startswith("request_result"):
+                self.nb_bytes += len(self.rset_data[path.split("/")[-2]])
+            elif self.references[real_path] > 1:
+                self.nb_files -= 1
+
+    def add_index(self, cwsearch_name, index, uid, gid, time):
+        """ Create a virtual directory serving the content of a CWSearch
+        persistent index.
+
+        Parameters
+        ----------
+        cwsearch_name: str (mandatory)
+            the CWSearch name, ie. the '/cwsearch_name' virtual directory.
+        index: SearchIndex (mandatory)
+            the CWSearch persistent index.
+        uid: str (mandatory)
+            the user identifier.
+        gid: str (mandatory)
+            the user group identifier.
+        time: str (mandatory)
+            the create time that will be set to the index directories.
+        """
+        self.make_directory("/", uid, gid, time)
+        self.make_directory("/" + cwsearch_name, uid, gid, time)
+        self.indexes[cwsearch_name] = (index, uid, gid, time)
+
+        # Update the virtual directory totals: the rset file size is not
+        # known by the index
+        nb_files, nb_bytes = index.totals()
+        self.nb_files += nb_files
+        self.nb_bytes += nb_bytes + len(self.rset_data.get(cwsearch_name, ""))
+
+    def get_path_info(self, path, list_children=True):
+        """ Return the informations of a virtual path, from the in memory
+        content or from the CWSearch persistent indexes.
+
+        Parameters
+        ----------
+        path: str (mandatory)
+            a virtual path.
+        list_children: bool (optional, default True)
+            if False, the children of the indexed directories are not
+            requested and an empty list is returned instead.
+
+        Returns
+        -------
+        path_info: 5-uplet or None
+            None if the path does not exist, otherwise a 5-uplet of the form
+            (real path or children names, uid, gid, mode, ctime).
+        """
+        # Check if the path belongs to an indexed CWSearch
+        if self.indexes:
+            parts = path.split("/", 2)
+            if len(parts) > 1 and parts[1] in self.indexes:
+                index, uid, gid, ctime = self.indexes[parts[1]]
+                relpath = "/" + (parts[2] if len(parts) > 2 else "")
+                entry = index.lookup(relpath)
+                if entry is None:
+                    return None
+                is_dir, real_path = entry
+                if is_dir:
+                    children = []
+                    if list_children:
+                        children = [name for name, _ in index.listdir(relpath)]
+                    return (children, uid, gid, 0500, ctime)
+                return (real_path, uid, gid, None, None)
+
+        return self.content.get(path)
+
+    def stat(self, path, cached_only=False):
         """ Return a dictionary similar to the result of os.fstat for the
         given virtual path.
 
@@ -224,10 +485,14 @@ class VirtualDirectory(object):
         ----------
         path: str (mandatory)
             a virtual path we want to check.
+        cached_only: bool (optional, default False)
+            if set, the file system is not accessed: None is returned for a
+            real file whose stat is not cached.
         """
         # Try to get the path informations: get something if the
-        # the path exists
-        path_info = self.content.get(path)
+        # the path exists, the children of the indexed directories are not
+        # listed
+        path_info = self.get_path_info(path, list_children=False)
 
         # If the path does not exist, raise a 'FuseOSError' exception
         if path_info is None:
@@ -236,8 +501,9 @@ class VirtualDirectory(object):
         # Unpack path information
         real_path, uid, gid, mode, ctime = path_info
 
-        # Initilaize the output
-        result = dict(st_uid=uid, st_gid=gid)
+        # Initilaize the output: the virtual items inodes are taken in the
+        # upper half of the inodes range, the real files keep their inode
+        result = dict(st_uid=uid, st_gid=gid, st_ino=virtual_inode(path))
 
         # Path link to a real file
         if isinstance(real_path, basestring):
@@ -245,24 +511,25 @@ class VirtualDirectory(object):
             # Deal with rset binary file
             if os.path.basename(path).startswith("request_result"):
                 cwsearch_name = path.split("/")[-2]
-                rset_time = self.content["/" + cwsearch_name][4]
+                rset_time = self.get_path_info(
+                    "/" + cwsearch_name, list_children=False)[4]
                 result.update({
                     "st_ctime": rset_time,
                     "st_mtime": rset_time,
                     "st_nlink": 1,
                     "st_mode": 33204,
-                    "st_size": self.rset_data[cwsearch_name].len,
+                    "st_size": len(self.rset_data[cwsearch_name]),
                     "st_atime": rset_time
                 })
 
-            # File on the file system
+            # File on the file system: a real file referenced by several
+            # virtual files is seen as hard linked
             else:
-                st = os.lstat(real_path)
-                # TODO: Remove write access on st_mode
-                result.update(
-                    dict((key, getattr(st, key))
-                         for key in ("st_atime", "st_ctime", "st_mode",
-                                     "st_mtime", "st_nlink", "st_size")))
+                real_stat = self.real_stat(real_path, cached_only)
+                if real_stat is None:
+                    return None
+                result.update(real_stat)
+                result["st_nlink"] = self.references.get(real_path, 1)
         # Path is a virtual directory
         else:
             result["st_mode"] = stat.S_IFDIR + mode
@@ -272,12 +539,45 @@ class VirtualDirectory(object):
             # st_nlinks is the number of reference to the directory a:
             # the number of sub folders in a pointing to a +
             # a has a referece to itself and the parent directory has
-            # a reference to a.
+            # a reference to a. The children of the indexed directories are
+            # not counted: their st_nlink is 2.
             result["st_nlink"] = len(real_path) + 2
             result["st_size"] = 4096
 
         return result
 
+    def real_stat(self, real_path, cached_only=False):
+        """ Return the cached stat of a real file.
+
+        Parameters
+        ----------
+        real_path: str (mandatory)
+            a real file path.
+        cached_only: bool (optional, default False)
+            if set, return None instead of stating the file when its stat is
+            not cached.
+
+        Returns
+        -------
+        stat: dict
+            the file 'st_atime', 'st_ctime', 'st_ino', 'st_mode', 'st_mtime',
+            'st_nlink' and 'st_size' stats.
+        """
+        now = time.time()
+        cached = self.stat_cache.get(real_path)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        if cached_only:
+            return None
+        st = os.lstat(real_path)
+        # TODO: Remove write access on st_mode
+        result = dict((key, getattr(st, key))
+                      for key in ("st_atime", "st_ctime", "st_mode",
+                                  "st_mtime", "st_nlink", "st_size"))
+        result["st_ino"] = real_inode(st)
+        self.stat_cache[real_path] = (now + self.stat_ttl, result)
+        return result
+
     def listdir(self, path):
         """ Return a generator yielding the content of a virtual directory.
 
@@ -295,7 +595,7 @@ class VirtualDirectory(object):
         """
         # Try to get the path informations: get something if the
         # the path exists
-        path_info = self.content.get(path)
+        path_info = self.get_path_info(path)
 
         # If the path does not exist, raise a 'FuseOSError' exception
         if path_info is None:
@@ -314,6 +614,101 @@ class VirtualDirectory(object):
         else:
             raise FuseOSError(ENOTDIR)
 
+    def listdir_stat(self, path):
+        """ Return a generator yielding the content of a virtual directory
+        with the stat of each item.
+
+        Behave like listdir() but each item is a 2-uplet of the form
+        (name, stat), where stat is None if it cannot be computed without
+        accessing the file system, ie. a real file not in the stat cache.
+
+        Parameters
+        ----------
+        path: str (mandatory)
+            a virtual path we want to list.
+        """
+        dirpath = path.rstrip("/")
+        for name in self.listdir(path):
+            if name == ".":
+                item_path = path
+            elif name == "..":
+                item_path = os.path.dirname(dirpath) or "/"
+            else:
+                item_path = dirpath + "/" + name
+            try:
+                yield name, self.stat(item_path, cached_only=True)
+            except OSError:
+                yield name, None
+
+    def add_real_sizes(self):
+        """ Add the size of the real files to the virtual directory totals.
+
+        Called once the directory is built, before it is published, so that
+        'statfs' never accesses the file system. The stats are kept in the
+        stat cache.
+        """
+        for real_path in self.nodes:
+            if os.path.basename(real_path).startswith("request_result"):
+                continue
+            try:
+                self.nb_bytes += self.real_stat(real_path)["st_size"]
+            except OSError:
+                pass
+
+    def statfs(self):
+        """ Return a dictionary similar to the result of os.statvfs for the
+        virtual directory, from the totals computed when it was built.
+
+        Returns
+        -------
+        result: dict
+            the 'f_bsize', 'f_frsize', 'f_blocks', 'f_bfree', 'f_bavail',
+            'f_files', 'f_ffree', 'f_favail', 'f_flag' and 'f_namemax'
+            statistics of a full read-only file system.
+        """
+        block_size = 4096
+        return {
+            "f_bsize": block_size,
+            "f_frsize": block_size,
+            "f_blocks": (self.nb_bytes + block_size - 1) // block_size,
+            "f_bfree": 0,
+            "f_bavail": 0,
+            "f_files": self.nb_files,
+            "f_ffree": 0,
+            "f_favail": 0,
+            "f_flag": 1,  # ST_RDONLY
+            "f_namemax": 255
+        }
+
+    def xattrs(self, path):
+        """ Return the read-only extended attributes of a virtual path: the
+        CWSearch name and eid it comes from and, for the files, their size.
+
+        .. note::
+            raise a 'FuseOSError' exception if the path does not exist.
+
+        Parameters
+        ----------
+        path: str (mandatory)
+            a virtual path.
+
+        Returns
+        -------
+        xattrs: dict
+            the extended attributes names and values.
+        """
+        result = self.stat(path)
+        cwsearch_name = path.split("/")[1]
+        if cwsearch_name not in self.search_eids:
+            return {}
+        xattrs = {
+            "user.rql_download.search": cwsearch_name.encode("utf-8"),
+            "user.rql_download.eid": str(self.search_eids[cwsearch_name])
+        }
+        if not stat.S_ISDIR(result["st_mode"]):
+            xattrs["user.rql_download.size"] = str(result["st_size"])
+        return xattrs
+
     def get_real_path(self, path):
         """ For a file, returns the real path for a given virtual path.
 
@@ -328,7 +723,7 @@ class VirtualDirectory(object):
         """
         # Try to get the file informations: get something if the
         # the path exists
-        path_info = self.content.get(path)
+        path_info = self.get_path_info(path)
 
         # If the path does not exist, raise a 'FuseOSError' exception
         if path_info is None:
@@ -345,150 +740,141 @@ class VirtualDirectory(object):
             raise FuseOSError(ENOTDIR)
 
 
+class AccessLogger(object):
+    """ Class that writes the users acces logs in the background.
+
+    The fuse threads only push the accesses in a bounded in-memory queue, a
+    writer thread appends them to the 'rql_download_<login>.log' files by
+    batches, at least every 'flush_interval' seconds. When the queue is full
+    the accesses are dropped (and counted) rather than blocking a fuse
+    thread.
+    """
+    def __init__(self, log_dir, instance_name, maxsize=100000,
+                 batch_size=1000, flush_interval=1.):
+        """ Initialize the AccessLogger class.
+
+        Parameters
+        ----------
+        log_dir: str (mandatory)
+            the directory where the users acces logs are generated.
+        instance_name: str (mandatory)
+            the cw instance name written in the logs.
+        maxsize: int (optional, default 100000)
+            the maximum number of accesses waiting to be written.
+        batch_size: int (optional, default 1000)
+            the maximum number of accesses written at once.
+        flush_interval: float (optional, default 1)
+            the maximum time in seconds an access waits to be written.
+        """
+        self.log_dir = log_dir
+        self.instance_name = instance_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = Queue.Queue(maxsize)
+        self.log_files = {}  # login -> open log file
+        self.nb_dropped = 0
+        self.writer = threading.Thread(target=self._write_loop)
+        # Start thread as daemon to be able to kill it nicely
+        self.writer.daemon = True
+        self.writer.start()
+
+    def log(self, login, date, real_path, exists):
+        """ Record a file access without blocking.
+
+        Parameters
+        ----------
+        login: str (mandatory)
+            the cw login.
+        date: datetime.datetime (mandatory)
+            the access date.
+        real_path: str (mandatory)
+            the accessed file real path.
+        exists: bool (mandatory)
+            True if the file exists on the file system.
+        """
+        try:
+            self.queue.put_nowait((login, date, real_path, exists))
+        except Queue.Full:
+            self.nb_dropped += 1
+
+    def _write_loop(self):
+        """ Writer loop: gather the accesses by batches and write them.
+        """
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except Queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except:
+                logger.exception("! Cannot write the users acces logs")
+
+    def _write(self, batch):
+        """ Append a batch of accesses to the users acces logs.
+        """
+        # Gather the lines by user
+        lines = {}
+        for login, date, real_path, exists in batch:
+            lines.setdefault(login, []).append(" ".join(
+                [str(date), self.instance_name, login, real_path,
+                 str(exists)]) + "\n")
+
+        # Write and flush each user acces log once
+        for login, user_lines in lines.items():
+            if login not in self.log_files:
+                self.log_files[login] = open(os.path.join(
+                    self.log_dir, "rql_download_{0}.log".format(login)), "a")
+            self.log_files[login].writelines(user_lines)
+            self.log_files[login].flush()
+
+        # Report the dropped accesses
+        if self.nb_dropped > 0:
+            nb_dropped, self.nb_dropped = self.nb_dropped, 0
+            logger.warning("! {0} accesses dropped from the acces logs: the "
+                           "log queue is full".format(nb_dropped))
+
+
 # If debug is necessary, add LoggingMixIn to FuseRset base classes
 # class FuseRset(LoggingMixIn, Operations):
 class FuseRset(Operations):
     """ Class that create a mount point containing virtual path representing
     the CWSearch entities of a cw user.
+
+    The virtual directory is not owned by the mount point but shared by the
+    'FuseDaemon' that serves all the users.
     """
-    def __init__(self, instance, login, queue):
+    def __init__(self, daemon, login):
         """ Initilize the FuseRset class.
 
-        .. note::
-            a user with 'login' login must exist on the system through ldap
-            or the adduser command.
-
         Parameters
         ----------
-        instance: str (mandatory)
-            the cw instance name we want to connect
+        daemon: FuseDaemon (mandatory)
+            the fuse daemon that holds the users virtual directories.
         login: str (mandatory)
             the cw login
         """
         # Class parameters
-        self.rwlock = Lock()
-        self.queue = queue
-        self.instance = instance
+        self.daemon = daemon
+        self.instance = daemon.instance_name
         self.login = login
-        self.vdir = None  # the virtual directory object
-        self.data_root_dir = get_cw_option(self.instance, "basedir")
-
-        # Get the directory where to generate the user acces log
-        # Check the permissions
-        log_dir = get_cw_option(self.instance, "rql_download_log")
-        self.generate_log = (os.access(log_dir, os.F_OK) and
-                             os.access(log_dir, os.W_OK))
-        if self.generate_log:
-            self.log_file = open(os.path.join(
-                log_dir, "rql_download_{0}.log".format(self.login)), "a")
-
-        # Get the user uid and gid
-        try:
-            pw = pwd.getpwnam(self.login)
-        except KeyError:
-            raise Exception("Unknown user '{0}'. A user with 'login' login "
-                            "must exist on the system through ldap or the "
-                            "adduser command.".format(login))
-        self.uid = pw.pw_uid
-        self.gid = pw.pw_gid
-        logger.debug("! login = {0}; uid = {1}; gid = {2}".format(
-            self.login, self.uid, self.gid))
+        self.data_root_dir = daemon.data_root_dir
 
-        # Create the virtual directory
-        self.update()
+        # Check if the user acces log has to be generated
+        self.generate_log = daemon.access_logger is not None
+        self.files = daemon.files
 
-    def update(self):
-        """ Method that create a virtual directory from a user CWSearch
-        entities results.
+    @property
+    def vdir(self):
+        """ The user virtual directory, as last published by the daemon.
         """
-
-        # Message
-        logger.info("! Starting virtual directory update")
-
-        # Get the cw session to execute rql requests
-        repo = self.queue.get()
-
-        try:
-            with repo.internal_cnx() as cnx:
-                # From the cw configuration file, get the mask we will apply
-                # on the virtual tree
-                data_root_dir = self.data_root_dir
-
-                # Create an empty virtual directory
-                self.vdir = VirtualDirectory(data_root_dir)
-
-                # Get the current time for virtual directories times
-                now = time.time()
-
-                # Go through all the user CWSearch entities
-                rql = ("Any S, N WHERE S is CWSearch, S title N, S owned_by U, "
-                       "U login '{0}'".format(self.login))
-                for cwsearch_eid, cwsearch_name in cnx.execute(rql):
-
-                    # Message
-                    logger.info(
-                        "! Processing CWSearch '{0}'".format(cwsearch_name))
-
-                    # Get the files associated to the current CWSearch
-                    rql = "Any D WHERE S eid '{0}', S result F, F data D".format(
-                        cwsearch_eid)
-                    files_data = cnx.execute(rql)[0]
-
-                    # Get the downloadable files path from the json
-                    files = json.load(files_data[0])["files"]
-                    logger.info("! Found {0} valid files for '{1}'".format(
-                        len(files), cwsearch_name))
-
-                    # Get the rset binary associated to the current CWSearch
-                    rql = "Any D WHERE S eid '{0}', S rset F, F data D".format(
-                        cwsearch_eid)
-                    self.vdir.rset_data[cwsearch_name] = (
-                        cnx.execute(rql)[0][0])
-
-                    # Add the rset to the build tree, add the appropriate
-                    # file extension
-                    rql = "Any T WHERE S eid '{0}', S rset_type T".format(
-                        cwsearch_eid)
-                    fext = VID_TO_EXT[cnx.execute(rql)[0][0]]
-                    files.append(
-                        os.path.join(data_root_dir, "request_result" + fext))
-
-                    # Go through all files and create the virtual directory
-                    for fname in files:
-
-                        # Apply the mask: remove 'data_root_dir' from the
-                        # begining of the path
-                        path = None
-                        if fname.startswith(data_root_dir):
-                            path = fname[len(data_root_dir):]
-
-                        # Add the CWSearch name to the path
-                        if os.path.isabs(path):
-                            path = os.path.join(cwsearch_name, path[1:])
-                        else:
-                            path = os.path.join(cwsearch_name, path)
-
-                        # Paths send by fuse are absolute => adds os.path.sep at
-                        # the begining
-                        virtual_path = path.split(os.path.sep)
-                        virtual_path.insert(0, os.path.sep)
-
-                        # Make sure all parent virtual directories are created
-                        for i in range(1, len(virtual_path)):
-                            dir_full_path = os.path.join(*virtual_path[:i])
-                            self.vdir.make_directory(
-                                dir_full_path, self.uid, self.gid, now)
-
-                        # Add the file to the fuse virtual tree
-                        self.vdir.add_file(
-                            os.path.join(*virtual_path), fname, self.uid, self.gid)
-        except:
-            raise
-        finally:
-            # Put back the connection into the queue
-            self.queue.put(repo)
-            # Message
-            logger.info("! Update done")
+        return self.daemon.trees[self.login]
 
     ########################################################################
     # Filesystem methods
@@ -504,42 +890,11 @@ class FuseRset(Operations):
 
         Return a dict with stats on the given virtual path.
 
-        .. note::
-            when the stat method is called on the '/.isalive' fake folder,
-            the method return a fake folder stat but do not raise an exception.
-            This in turns unables us to check if the fuse process is running.
-
-        .. note::
-            when the stat method is called on the '/.update' fake folder,
-            the virtual directory is recreated and the process may not be
-            available during this operation.
-
         Parameters
         ----------
         path: str (mandatory)
             a virtual path
         """
-        # Create a fake folder stat
-        fstat = {
-            "st_ctime": 1.,
-            "st_mtime": 1.,
-            "st_nlink": 1,
-            "st_mode": 16704,
-            "st_size": 4096,
-            "st_gid": 5009,
-            "st_uid": 5009,
-            "st_atime": 1.
-        }
-
-        # Check if the fuse mount is alive
-        if path == "/.isalive":
-            return fstat
-
-        # Start the fuse update: the process is not avalaible during the update
-        elif path == "/.update":
-            self.update()
-            return fstat
-
         return self.vdir.stat(path)
 
     def opendir(self, path):
@@ -552,12 +907,17 @@ class FuseRset(Operations):
     def readdir(self, path, fh):
         """ List the content of a directory.
 
+        Each item is returned with its attributes when they are known
+        without accessing the file system, ie. taken from the virtual
+        directory stat cache, otherwise fuse requests them with 'getattr'.
+
         Parameters
         ----------
         path: str (mandatory)
             a virtual path
         """
-        return self.vdir.listdir(path)
+        return [(name, attrs, 0)
+                for name, attrs in self.vdir.listdir_stat(path)]
 
     def releasedir(self, path, fh):
         """ As for opendir, we do not use releasedir.
@@ -573,40 +933,56 @@ class FuseRset(Operations):
         Open a file.
         """
         logger.debug("open {0}".format(path))
-        # Update the log file if requested
-        if self.generate_log:
-            realpath = os.sep.join(path.split(os.sep)[2:])
-            abspath = os.path.join(self.data_root_dir, realpath)
-            self.log_file.write(" ".join(
-                [str(datetime.datetime.now()), self.instance, self.login,
-                 abspath, str(os.path.isfile(abspath))]))
-            self.log_file.write("\n")
-            self.log_file.flush()
-
         if flags & (os.O_RDWR + os.O_WRONLY):
             raise FuseOSError(EROFS)
 
         # Special case for the rset binary file
+        real_path = self.vdir.get_real_path(path)
         if os.path.basename(path).startswith("request_result"):
+            self.log_access(real_path, False)
             return
 
-        return os.open(self.vdir.get_real_path(path), flags)
+        # Update the log file if requested: the file existence is given by
+        # the open status. The file descriptor of a real file is shared by
+        # all its openings, each opening gets its own handle.
+        try:
+            fh = self.files.open(real_path, flags)
+        except OSError:
+            self.log_access(real_path, False)
+            raise
+        self.log_access(real_path, True)
+        return fh
+
+    def log_access(self, real_path, exists):
+        """ Record a file access in the user acces log if requested.
+
+        Parameters
+        ----------
+        real_path: str (mandatory)
+            the accessed file real path.
+        exists: bool (mandatory)
+            True if the file exists on the file system.
+        """
+        if self.generate_log:
+            self.daemon.access_logger.log(
+                self.login, datetime.datetime.now(), real_path, exists)
 
     def read(self, path, length, offset, fh):
         """ File-class version of 'read'.
         Get all or part of the contents of a file.
         """
         logger.debug("read {0}".format(path))
-        # Special case for the rset binary file
+        # Special case for the rset binary file: zero-copy slice of the
+        # immutable rset content, no seek state shared between readers
         if os.path.basename(path).startswith("request_result"):
             cwsearch_name = path.split("/")[-2]
-            self.vdir.rset_data[cwsearch_name].seek(offset)
-            return self.vdir.rset_data[cwsearch_name].read(length)
-        # The file exists on the file system
+            return buffer(self.vdir.rset_data[cwsearch_name], offset, length)
+        # The file exists on the file system: serve the sequential reads from
+        # the read-ahead buffers of the opening if any, otherwise use a
+        # positional read, there is no shared file offset and concurrent
+        # reads need no lock
         else:
-            with self.rwlock:
-                os.lseek(fh, offset, os.SEEK_SET)
-                return os.read(fh, length)
+            return self.files.read(fh, length, offset)
 
     def release(self, path, fh):
         """ File-class version of 'release'.
@@ -617,9 +993,36 @@ class FuseRset(Operations):
         # Keep binary file in memory
         if os.path.basename(path).startswith("request_result"):
             return
-        # Close file from descriptor
+        # Release the opening: the file descriptor is closed with its last
+        # opening
         else:
-            return os.close(fh)
+            return self.files.release(fh)
+
+    def getxattr(self, path, name, position=0):
+        """ File-class version of 'getxattr'.
+        Get an extended attribute: the file provenance is served from the
+        virtual directory, without any cw request.
+        """
+        logger.debug("getxattr {0} {1}".format(path, name))
+        xattrs = self.vdir.xattrs(path)
+        if name not in xattrs:
+            raise FuseOSError(ENODATA)
+        return xattrs[name]
+
+    def listxattr(self, path):
+        """ File-class version of 'listxattr'.
+        List the extended attributes names.
+        """
+        logger.debug("listxattr {0}".format(path))
+        return sorted(self.vdir.xattrs(path))
+
+    def statfs(self, path):
+        """ File-class version of 'statfs'.
+        Get the file system statistics: the user files total size and number,
+        computed when the user virtual directory was built.
+        """
+        logger.debug("statfs {0}".format(path))
+        return self.vdir.statfs()
 
     def flush(self, path, fh):
         """ File-class version of 'flush".
@@ -684,10 +1087,6 @@ class FuseRset(Operations):
         logger.debug("setxattr: operation not supported.")
         raise FuseOSError(ENOTSUP)
 
-    def statfs(self, path):
-        logger.debug("statfs: operation not supported.")
-        raise FuseOSError(ENOTSUP)
-
     def symlink(self, target, source):
         logger.debug("symlink: operation not supported.")
         raise FuseOSError(EROFS)
@@ -709,42 +1108,375 @@ class FuseRset(Operations):
         raise FuseOSError(EROFS)
 
 
-def start(instance_name, login, queue):
-
-    # Define the fuse log level
-    logger.setLevel(logging.DEBUG)
-    level_name = get_cw_option(instance_name, "log-threshold")
-    level = levels.get(level_name)
-    if level is None:
-        logger.setLevel(logging.DEBUG)
-        logger.error("Unsupported log level {0}, setting to default.".format(
-            level_name))
-    else:
-        logger.setLevel(level)      
-
-    # Get mount parameters
-    mount_base = get_cw_option(instance_name, "mountdir")
-    mount_point = os.path.join(mount_base, login, instance_name)
-    logger.debug("Command line parameters: instance name = {0}, login = {1} "
-                 "fuse mount point = {2}".format(
-                    instance_name, login, mount_point))
-
-    # Check if the user fuse mount point is available
-    isalive = True
-    try:
-        os.stat(os.path.join(mount_point, ".isalive"))
-    except:
-        isalive = False
-
-    # Add the new search to the user fuse mount point:
-    # if the process is already created, just start the update,
-    # otherwise create a fuse loop
-    if isalive:
-        os.stat(os.path.join(mount_point, ".update"))
-    else:
-        # Create the fuse mount point
-        FUSE(FuseRset(instance_name, login, queue),
-             mount_point,
-             foreground=True,
-             allow_other=True,
-             default_permissions=True)
+class FuseDaemon(object):
+    """ Class that serves the fuse mount points of all the users of a cw
+    instance from a single process.
+
+    The daemon holds one shared index of the users virtual directories, the
+    cw configuration parsed once, one pool of internal connections and one
+    refresh scheduler. Each user mount point only runs a thin 'FuseRset' view
+    on this index.
+
+    Refresh requests are debounced ('fuse_refresh_delay' option) and
+    coalesced: a burst of requests for a user triggers a single rebuild. The
+    rebuilds run in background workers, as many as the pool size
+    ('fuse_pool_size' option), so that the users virtual directories are
+    built in parallel with a bounded concurrency while the mount points keep
+    serving the previous virtual directories.
+    """
+    def __init__(self, instance_name, repo):
+        """ Initilize the FuseDaemon class.
+
+        Parameters
+        ----------
+        instance_name: str (mandatory)
+            the cw instance name we want to connect.
+        repo: cubicweb.server.repository.Repository (mandatory)
+            the cw repository used to get the users CWSearch entities.
+        """
+        # Class parameters
+        self.instance_name = instance_name
+        self.trees = {}  # login -> VirtualDirectory
+        self.mounts = {}  # login -> mount thread
+        self.pending = {}  # login -> refresh deadline
+        self.running = set()  # logins being refreshed
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.refresh_delay = repo.vreg.config["fuse_refresh_delay"]
+
+        # Create a pool of internal connections shared by the workers
+        pool_size = repo.vreg.config["fuse_pool_size"]
+        self.pool = ConnectionPool(repo.internal_cnx, pool_size, name="fuse")
+
+        # Define the fuse log level
+        level_name = get_cw_option(instance_name, "log-threshold")
+        level = levels.get(level_name)
+        if level is None:
+            logger.setLevel(logging.DEBUG)
+            logger.error("Unsupported log level {0}, setting to "
+                         "default.".format(level_name))
+        else:
+            logger.setLevel(level)
+
+        # From the cw configuration file, get the mask we will apply on the
+        # virtual trees and the mount parameters
+        self.data_root_dir = get_cw_option(instance_name, "basedir")
+        self.mount_base = get_cw_option(instance_name, "mountdir")
+        self.index_dir = repo.vreg.config["search_index_dir"] or None
+        self.fuse_options = get_fuse_options(
+            repo.vreg.config["fuse_profile"],
+            repo.vreg.config["fuse_options"] or "")
+
+        # Get the directory where to generate the users acces log
+        # Check the permissions
+        log_dir = get_cw_option(instance_name, "rql_download_log")
+        self.access_logger = None
+        if os.access(log_dir, os.F_OK) and os.access(log_dir, os.W_OK):
+            self.access_logger = AccessLogger(log_dir, instance_name)
+
+        # Create the read-ahead buffers of the large files if requested
+        self.read_ahead = None
+        window_size = repo.vreg.config["fuse_read_ahead"]
+        if window_size > 0:
+            self.read_ahead = ReadAheadCache(
+                window_size * 1024 ** 2,
+                repo.vreg.config["fuse_read_ahead_memory"] * 1024 ** 2)
+        self.files = SharedFiles(self.read_ahead)
+
+        # Start the refresh scheduler and its workers: the refreshes are
+        # served by priority, then in the request order
+        self.refresh_queue = Queue.PriorityQueue()
+        self.sequence = 0
+        self.scheduler = threading.Thread(target=self._schedule_loop)
+        # Start thread as daemon to be able to kill it nicely
+        self.scheduler.daemon = True
+        self.scheduler.start()
+        self.workers = []
+        for index in range(pool_size):
+            self.workers.append(threading.Thread(target=self._refresh_loop))
+            # Start thread as daemon to be able to kill it nicely
+            self.workers[-1].daemon = True
+            self.workers[-1].start()
+
+    def refresh(self, login, priority=0):
+        """ Request the (re)build of a user virtual directory.
+
+        The request is served after the refresh delay by a background worker.
+        Requests received for a user before his refresh starts are coalesced
+        into one rebuild. The user mount point is created after the first
+        build of his virtual directory.
+
+        Parameters
+        ----------
+        login: str (mandatory)
+            the cw login.
+        priority: int (optional, default 0)
+            the due requests with the lowest priority values are served
+            first.
+        """
+        with self.condition:
+            if login not in self.pending:
+                self.pending[login] = (
+                    time.time() + self.refresh_delay, priority)
+                self.condition.notify()
+            elif priority < self.pending[login][1]:
+                self.pending[login] = (self.pending[login][0], priority)
+
+    def _schedule_loop(self):
+        """ Refresh scheduler loop: hand over the due refresh requests to the
+        workers, never more than one refresh at a time for a user.
+        """
+        while True:
+            with self.condition:
+                now = time.time()
+                waiting = [(deadline, priority, login)
+                           for login, (deadline, priority)
+                           in self.pending.items()
+                           if login not in self.running]
+                due = [(priority, login)
+                       for deadline, priority, login in waiting
+                       if deadline <= now]
+                if len(due) == 0:
+                    timeout = None
+                    if len(waiting) > 0:
+                        timeout = min(waiting)[0] - now
+                    self.condition.wait(timeout)
+                    continue
+                for priority, login in due:
+                    del self.pending[login]
+                    self.running.add(login)
+            for priority, login in due:
+                self.sequence += 1
+                self.refresh_queue.put((priority, self.sequence, login))
+
+    def _refresh_loop(self):
+        """ Refresh worker loop: build the requested virtual directories
+        and mount the new users.
+        """
+        while True:
+            priority, sequence, login = self.refresh_queue.get()
+            try:
+                self.update(login)
+                self.mount(login)
+            except:
+                logger.exception(
+                    "! Cannot refresh the '{0}' user mount point".format(
+                        login))
+            finally:
+                with self.condition:
+                    self.running.discard(login)
+                    self.condition.notify()
+                self.refresh_queue.task_done()
+
+            # Report the connection pool wait times once all the scheduled
+            # refreshes are done
+            if self.refresh_queue.unfinished_tasks == 0:
+                logger.info("! {0}".format(self.pool.report()))
+
+    def mount(self, login):
+        """ Start the fuse loop of a user if not already running.
+
+        Parameters
+        ----------
+        login: str (mandatory)
+            the cw login.
+        """
+        with self.lock:
+            if login not in self.mounts:
+                self.mounts[login] = threading.Thread(
+                    target=self._serve, args=(login, ))
+                # Start thread as daemon to be able to kill it nicely
+                self.mounts[login].daemon = True
+                self.mounts[login].start()
+
+    def _serve(self, login):
+        """ Run the fuse loop of a user mount point.
+
+        Parameters
+        ----------
+        login: str (mandatory)
+            the cw login.
+        """
+        mount_point = os.path.join(self.mount_base, login, self.instance_name)
+        logger.debug("Fuse parameters: instance name = {0}, login = {1} "
+                     "fuse mount point = {2}, options = {3}".format(
+                        self.instance_name, login, mount_point,
+                        self.fuse_options))
+        try:
+            # Create the fuse mount point: the fuse loop is multithreaded by
+            # default so that concurrent requests are served in parallel
+            FUSE(FuseRset(self, login),
+                 mount_point,
+                 foreground=True,
+                 allow_other=True,
+                 default_permissions=True,
+                 use_ino=True,
+                 **self.fuse_options)
+        except:
+            logger.exception(
+                "! Fuse mount point '{0}' failed".format(mount_point))
+        finally:
+            with self.lock:
+                self.mounts.pop(login, None)
+
+    def update(self, login):
+        """ Method that create a virtual directory from a user CWSearch
+        entities results.
+
+        The new virtual directory is built aside and then published at once
+        in the shared index. The refresh scheduler never runs two updates of
+        the same user at the same time.
+
+        .. note::
+            a user with 'login' login must exist on the system through ldap
+            or the adduser command.
+
+        Parameters
+        ----------
+        login: str (mandatory)
+            the cw login.
+        """
+        # Message
+        logger.info("! Starting virtual directory update for '{0}'".format(
+            login))
+
+        # Get the user uid and gid
+        try:
+            pw = pwd.getpwnam(login)
+        except KeyError:
+            raise Exception("Unknown user '{0}'. A user with 'login' login "
+                            "must exist on the system through ldap or the "
+                            "adduser command.".format(login))
+        uid = pw.pw_uid
+        gid = pw.pw_gid
+        logger.debug("! login = {0}; uid = {1}; gid = {2}".format(
+            login, uid, gid))
+
+        # Get a pooled connection to execute rql requests
+        with self.pool.connection() as cnx:
+            # From the cw configuration file, get the mask we will apply
+            # on the virtual tree
+            data_root_dir = self.data_root_dir
+
+            # Create an empty virtual directory
+            vdir = VirtualDirectory(data_root_dir)
+
+            # Get the current time for virtual directories times
+            now = time.time()
+
+            # Go through all the user CWSearch entities
+            rql = ("Any S, N WHERE S is CWSearch, S title N, S owned_by U, "
+                   "U login '{0}'".format(login))
+            for cwsearch_eid, cwsearch_name in cnx.execute(rql):
+
+                # Message
+                logger.info(
+                    "! Processing CWSearch '{0}'".format(cwsearch_name))
+                vdir.search_eids[cwsearch_name] = cwsearch_eid
+
+                # Get the rset binary associated to the current CWSearch:
+                # keep an immutable copy of its content that can be
+                # sliced by concurrent readers
+                rql = "Any D WHERE S eid '{0}', S rset F, F data D".format(
+                    cwsearch_eid)
+                vdir.rset_data[cwsearch_name] = (
+                    cnx.execute(rql)[0][0].getvalue())
+
+                # Add the rset to the build tree, add the appropriate
+                # file extension
+                rql = "Any T WHERE S eid '{0}', S rset_type T".format(
+                    cwsearch_eid)
+                fext = VID_TO_EXT[cnx.execute(rql)[0][0]]
+                rset_file = os.path.join(
+                    data_root_dir, "request_result" + fext)
+
+                # Use the CWSearch persistent index if available: the files
+                # are not loaded, the index is built once if necessary
+                index_file = None
+                if self.index_dir is not None:
+                    index_file = get_index_file(self.index_dir, cwsearch_eid)
+                    if os.path.isfile(index_file):
+                        vdir.add_index(cwsearch_name, SearchIndex(index_file),
+                                       uid, gid, now)
+                        continue
+
+                # Get the files associated to the current CWSearch
+                rql = "Any D WHERE S eid '{0}', S result F, F data D".format(
+                    cwsearch_eid)
+                files_data = cnx.execute(rql)[0]
+
+                # Get the downloadable files path from the json
+                files = json.load(files_data[0])["files"]
+                logger.info("! Found {0} valid files for '{1}'".format(
+                    len(files), cwsearch_name))
+                files.append(rset_file)
+                if index_file is not None:
+                    index = SearchIndex.build(index_file, files, data_root_dir)
+                    vdir.add_index(cwsearch_name, index, uid, gid, now)
+                    continue
+
+                # Go through all files and create the virtual directory
+                for fname in files:
+
+                    # Apply the mask: remove 'data_root_dir' from the
+                    # begining of the path
+                    path = None
+                    if fname.startswith(data_root_dir):
+                        path = fname[len(data_root_dir):]
+
+                    # Add the CWSearch name to the path
+                    if os.path.isabs(path):
+                        path = os.path.join(cwsearch_name, path[1:])
+                    else:
+                        path = os.path.join(cwsearch_name, path)
+
+                    # Paths send by fuse are absolute => adds os.path.sep at
+                    # the begining
+                    virtual_path = path.split(os.path.sep)
+                    virtual_path.insert(0, os.path.sep)
+
+                    # Make sure all parent virtual directories are created
+                    for i in range(1, len(virtual_path)):
+                        dir_full_path = os.path.join(*virtual_path[:i])
+                        vdir.make_directory(
+                            dir_full_path, uid, gid, now)
+
+                    # Add the file to the fuse virtual tree
+                    vdir.add_file(
+                        os.path.join(*virtual_path), fname, uid, gid)
+
+        # Compute the real files size in this background worker, then
+        # publish the new virtual directory at once: the fuse requests in
+        # progress keep using the previous one
+        vdir.add_real_sizes()
+        self.trees[login] = vdir
+
+        # Message
+        logger.info("! Update done")
+
+
+# Define the fuse daemons of the current process
+_daemons = {}
+_daemons_lock = threading.Lock()
+
+
+def get_fuse_daemon(instance_name, repo):
+    """ Get the fuse daemon of a cw instance: the daemon is created on the
+    first call and then shared by all the callers of the process.
+
+    Parameters
+    ----------
+    instance_name: str (mandatory)
+        the cw instance name we want to connect.
+    repo: cubicweb.server.repository.Repository (mandatory)
+        the cw repository used to get the users CWSearch entities.
+
+    Returns
+    -------
+    daemon: FuseDaemon
+        the fuse daemon of the instance.
+    """
+    with _daemons_lock:
+        if instance_name not in _daemons:
+            _daemons[instance_name] = FuseDaemon(instance_name, repo)
+        return _daemons[instance_name]
@@ -13,8 +13,6 @@ import sys
 import json
 import os
 import datetime
-import threading
-import Queue
 
 # RQL import
 from rql.nodes import Constant, Function
@@ -24,8 +22,12 @@ from cubicweb import NotAnEntity
 from cubicweb import Binary, ValidationError
 from cubicweb.server import hook
 from cubicweb.predicates import is_instance
-from cubes.rql_download.fuse.fuse_mount import start
+from cubes.rql_download.fuse.fuse_mount import get_fuse_daemon
+from cubes.rql_download.fuse.fuse_mount import VID_TO_EXT
+from cubes.rql_download.index import SearchIndex
+from cubes.rql_download.index import get_index_file
 from subprocess import call
+from multiprocessing.pool import ThreadPool
 import glob
 _ = unicode
 
@@ -245,6 +247,57 @@ class CWSearchAdd(hook.Hook):
             # been modified
             self.entity.cw_edited["result"] = f_eid
 
+            # Build the persistent index of the files if requested, once the
+            # CWSearch is commited
+            index_dir = self._cw.vreg.config["search_index_dir"]
+            if index_dir:
+                data_root_dir = self._cw.vreg.config["basedir"]
+                rset_file = os.path.join(
+                    data_root_dir, "request_result" + VID_TO_EXT[export_vid])
+                PostCommitIndexOperation(
+                    self._cw, index_file=get_index_file(
+                        index_dir, self.entity.eid),
+                    files=result["files"] + [rset_file],
+                    data_root_dir=data_root_dir)
+
+
+class PostCommitIndexOperation(hook.Operation):
+    """ Build the persistent index of a CWSearch entity files after it is
+    commited.
+    """
+    def postcommit_event(self):
+        """ Define the IndexOperation postcommit operation.
+        """
+        SearchIndex.build(self.index_file, self.files, self.data_root_dir)
+
+
+class CWSearchIndexDelete(hook.Hook):
+    """ Remove the persistent index of a deleted CWSearch entity.
+    """
+    __regid__ = "rqldownload.search_index_delete_hook"
+    __select__ = hook.Hook.__select__ & is_instance("CWSearch")
+    events = ("after_delete_entity", )
+
+    def __call__(self):
+        """ Method to execute the 'CWSearchIndexDelete' hook.
+        """
+        index_dir = self._cw.vreg.config["search_index_dir"]
+        if index_dir:
+            PostCommitIndexDeleteOperation(
+                self._cw, index_file=get_index_file(
+                    index_dir, self.entity.eid))
+
+
+class PostCommitIndexDeleteOperation(hook.Operation):
+    """ Remove the persistent index of a CWSearch entity after its deletion
+    is commited.
+    """
+    def postcommit_event(self):
+        """ Define the IndexDeleteOperation postcommit operation.
+        """
+        if os.path.isfile(self.index_file):
+            os.remove(self.index_file)
+
 
 class CWSearchExpirationDateHook(hook.Hook):
     """ On startup, register a task to add an expiration date to each CWSearch.
@@ -293,15 +346,15 @@ class CWSearchDelete(hook.Hook):
 ###############################################################################
 
 class CWSearchFuseMount(hook.Hook):
-    """ Class that start/update a process specific to a user that mount
-    his CWSearch entities.
+    """ Class that start/update the fuse mount point specific to a user that
+    mount his CWSearch entities.
     """
     __regid__ = "rqldownload.fuse_mount_hook"
     __select__ = hook.Hook.__select__ & is_instance("CWSearch")
     events = ("after_add_entity", )
 
     def __call__(self):
-        """ Method that start/update the user specific process.
+        """ Method that start/update the user specific mount point.
         """
         # Check if fuse virtual directory have to be mounted
         use_fuse = self._cw.vreg.config["start_user_fuse"]
@@ -313,7 +366,7 @@ class CWSearchFuseMount(hook.Hook):
 
 
 class PostCommitFuseOperation(hook.Operation):
-    """ Start/update a fuse process after a CWSearch entity is commited.
+    """ Start/update a fuse mount point after a CWSearch entity is commited.
     """
     def postcommit_event(self):
         """ Define the FuseOperation postcommit operation.
@@ -323,68 +376,82 @@ class PostCommitFuseOperation(hook.Operation):
         instance_name = repo.schema.name
         login = self.entity.owned_by[0].login
 
-        # Create a new fuse process: try first to update the fuse mount point
-        # if already created otherwise create a new mount point.
-
-        # Create a queue to share the repo object safely across threads
-        queue = Queue.Queue()
-        queue.put(repo)
-        # Create and start a new thread
-        new_thread = threading.Thread(target=start,
-                                      args=(instance_name, login, queue))
-        # Start thread as daemon to be able to kill it nicely
-        new_thread.daemon = True
-        new_thread.start()
+        # Add the new search to the user fuse mount point: the shared fuse
+        # daemon rebuilds the user virtual directory and creates the mount
+        # point if necessary
+        get_fuse_daemon(instance_name, repo).refresh(login)
 
 
 class ServerStartupFuseMount(hook.Hook):
     """ On startup, generate all the fuse mount point associated with CWSearch
-    owners."""
+    owners.
+
+    The existing mount points are unmounted in parallel, then the users
+    virtual directories are built in background by the fuse daemon workers,
+    the most recently active users first. The startup does not wait for the
+    builds.
+
+    With the 'fuse_startup_recent_days' option, the users who did not create
+    a CWSearch during the last days are not mounted: they get their mount
+    point with their next CWSearch."""
     __regid__ = "rqldownload.startup_fuse_mount_hook"
     events = ("server_startup",)
+    nb_unmount_workers = 8
 
     def __call__(self):
-        """ Method that start the user specific processes.
+        """ Method that start the user specific mount points.
         """
         # Check if fuse virtual directory have to be mounted
         use_fuse = self.repo.vreg.config["start_user_fuse"]
         if use_fuse:
 
-            # Execute a rql to get all the CWSearch owner logins
+            # Execute a rql to get all the CWSearch owner logins, the most
+            # recently active first. Only keep the recently active users if
+            # requested: the other users are not mounted, even for their
+            # existing CWSearch, until their next CWSearch
+            rql = ("Any L, MAX(D) GROUPBY L ORDERBY 2 DESC WHERE "
+                   "S is CWSearch, S owned_by U, U login L, "
+                   "S creation_date D")
+            args = {}
+            recent_days = self.repo.vreg.config["fuse_startup_recent_days"]
+            if recent_days > 0:
+                rql += ", D > %(limit)s"
+                args["limit"] = (datetime.datetime.now() -
+                                 datetime.timedelta(recent_days))
             with self.repo.internal_cnx() as cnx:
-                rql = "Any L Where S is CWSearch, S owned_by U, U login L"
-                rset = cnx.execute(rql)
-                logins = set([x[0] for x in rset])
+                logins = [row[0] for row in cnx.execute(rql, args)]
 
             instance_name = self.repo.schema.name
 
-            # Create a queue to share the repo object safely across threads
-            queue = Queue.Queue()
-            queue.put(self.repo)
-
             # Clear mount points: force unmounting each user home instance
             # directory, because these directories can be in an unexpected
             # system state.
             if self.repo.vreg.config["unmount_existing"]:
                 mountdir = self.repo.vreg.config["mountdir"]
-                for user in os.listdir(mountdir):
-                    user_dir = os.path.join(mountdir, user, instance_name)
-                    cmd = ["fusermount", "-uz", user_dir]
-                    try:
-                        call(cmd)
-                    except:
-                        self.repo.exception(
-                            "Command '{}' failed.".format(" ".join(cmd)))
-
-            # Start one thread per user
-            threads = []
-            for login in logins:
-                threads.append(
-                    threading.Thread(target=start,
-                                     args=(instance_name, login, queue)))
-                # Start thread as daemon to be able to kill it nicely
-                threads[-1].daemon = True
-                threads[-1].start()
+                cmds = [
+                    ["fusermount", "-uz",
+                     os.path.join(mountdir, user, instance_name)]
+                    for user in os.listdir(mountdir)]
+                pool = ThreadPool(self.nb_unmount_workers)
+                try:
+                    pool.map(self._unmount, cmds)
+                finally:
+                    pool.close()
+
+            # Serve all the users from a single fuse daemon: the refreshes
+            # are prioritized by user activity after the live requests
+            daemon = get_fuse_daemon(instance_name, self.repo)
+            for rank, login in enumerate(logins):
+                daemon.refresh(login, priority=rank + 1)
+
+    def _unmount(self, cmd):
+        """ Run an unmount command.
+        """
+        try:
+            call(cmd)
+        except:
+            self.repo.exception(
+                "Command '{}' failed.".format(" ".join(cmd)))
 
 
 ###############################################################################
@@ -412,4 +479,8 @@ class LaunchTwistedFTPServer(hook.Hook):
             sftp_server_basedir = self.repo.vreg.config["basedir"]
             if sftp_server_basedir:
                 basedir_opt = "--base-dir=%s" % sftp_server_basedir
-            subprocess.Popen([sys.executable, ftpserver_path, basedir_opt])
+            cmd = [sys.executable, ftpserver_path, basedir_opt]
+            index_dir = self.repo.vreg.config["search_index_dir"]
+            if index_dir:
+                cmd.append("--index-dir=%s" % index_dir)
+            subprocess.Popen(cmd)
@@ -0,0 +1,207 @@
+#! /usr/bin/env python
+##########################################################################
+# NSAp - Copyright (C) CEA, 2013
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+""" Persistent on-disk index of the files of the CWSearch entities.
+"""
+
+# System import
+import os
+import sqlite3
+import tempfile
+import threading
+
+
+def get_index_file(index_dir, cwsearch_eid):
+    """ Get the index file of a CWSearch entity.
+
+    Parameters
+    ----------
+    index_dir: str (mandatory)
+        the directory containing the indexes.
+    cwsearch_eid: int (mandatory)
+        the CWSearch entity eid.
+
+    Returns
+    -------
+    index_file: str
+        the CWSearch SQLite index file path.
+    """
+    return os.path.join(index_dir, "{0}.sqlite".format(cwsearch_eid))
+
+
+class SearchIndex(object):
+    """ The tree of the files of a CWSearch stored in a SQLite database.
+
+    The index is built once when the CWSearch is created and then only
+    queried directory by directory: the files of the CWSearch never have to
+    be loaded in memory.
+
+    The paths are relative to the CWSearch directory: the root of the
+    CWSearch is '/' and the files are masked by the data root directory.
+
+    .. code-block:: python
+
+        index = SearchIndex.build(index_file, files, data_root_dir)
+        for name, real_path in index.listdir("/"):
+            print name, real_path
+    """
+    def __init__(self, index_file):
+        """ Initialize the SearchIndex class.
+
+        Parameters
+        ----------
+        index_file: str (mandatory)
+            an existing SQLite index file.
+        """
+        self.index_file = index_file
+        # SQLite connections cannot be shared between threads
+        self._local = threading.local()
+
+    @classmethod
+    def build(cls, index_file, files, data_root_dir):
+        """ Build the index of a CWSearch files.
+
+        The index is written aside in a private temporary file and then moved
+        at once, so that readers never see a partial index, even when the
+        same index is built concurrently.
+
+        Parameters
+        ----------
+        index_file: str (mandatory)
+            the SQLite index file to create.
+        files: list of str (mandatory)
+            the CWSearch files real paths.
+        data_root_dir: str (mandatory)
+            the mask removed from the begining of the files paths.
+
+        Returns
+        -------
+        index: SearchIndex
+            the new index.
+        """
+        # Compute the tree entries: directories point to no real path and
+        # the size of the missing files is zero
+        entries = {}
+        for fname in files:
+            path = fname
+            if fname.startswith(data_root_dir):
+                path = fname[len(data_root_dir):]
+            names = [name for name in path.split("/") if name != ""]
+            if len(names) == 0:
+                continue
+            parent = u"/"
+            for name in names[:-1]:
+                entries[(parent, name)] = (None, None)
+                parent = parent.rstrip("/") + "/" + name
+            try:
+                size = os.lstat(fname).st_size
+            except OSError:
+                size = 0
+            entries[(parent, names[-1])] = (fname, size)
+
+        # Write the index
+        fd, tmp_file = tempfile.mkstemp(
+            suffix=".tmp", prefix=os.path.basename(index_file) + ".",
+            dir=os.path.dirname(index_file))
+        os.close(fd)
+        cnx = sqlite3.connect(tmp_file)
+        try:
+            cnx.execute(
+                "CREATE TABLE entries (parent TEXT NOT NULL, "
+                "name TEXT NOT NULL, real_path TEXT, size INTEGER, "
+                "PRIMARY KEY (parent, name))")
+            cnx.executemany(
+                "INSERT INTO entries VALUES (?, ?, ?, ?)",
+                ((parent, name, real_path, size)
+                 for (parent, name), (real_path, size)
+                 in entries.iteritems()))
+            cnx.execute(
+                "CREATE TABLE totals (nb_files INTEGER, nb_bytes INTEGER)")
+            cnx.execute(
+                "INSERT INTO totals SELECT COUNT(*), TOTAL(size) FROM entries "
+                "WHERE real_path IS NOT NULL")
+            cnx.commit()
+        except:
+            cnx.close()
+            os.remove(tmp_file)
+            raise
+        cnx.close()
+        os.rename(tmp_file, index_file)
+
+        return cls(index_file)
+
+    @property
+    def cnx(self):
+        """ The SQLite connection of the current thread.
+        """
+        cnx = getattr(self._local, "cnx", None)
+        if cnx is None:
+            cnx = sqlite3.connect(self.index_file)
+            self._local.cnx = cnx
+        return cnx
+
+    def totals(self):
+        """ Get the number of files and their total size, computed when the
+        index was built.
+
+        Returns
+        -------
+        totals: 2-uplet
+            the number of files and their total size in bytes.
+        """
+        nb_files, nb_bytes = self.cnx.execute(
+            "SELECT nb_files, nb_bytes FROM totals").fetchone()
+        return nb_files, int(nb_bytes)
+
+    def lookup(self, path):
+        """ Find an entry of the index.
+
+        Parameters
+        ----------
+        path: str (mandatory)
+            a path relative to the CWSearch directory.
+
+        Returns
+        -------
+        entry: 2-uplet or None
+            None if the path is not indexed, otherwise a 2-uplet of the form
+            (is_dir, real_path) where real_path is None for the directories.
+        """
+        if isinstance(path, str):
+            path = path.decode("utf-8")
+        path = path.rstrip("/")
+        if path == "":
+            return True, None
+        parent, name = path.rsplit("/", 1)
+        row = self.cnx.execute(
+            "SELECT real_path FROM entries WHERE parent = ? AND name = ?",
+            (parent or u"/", name)).fetchone()
+        if row is None:
+            return None
+        return row[0] is None, row[0]
+
+    def listdir(self, path):
+        """ List an indexed directory.
+
+        Parameters
+        ----------
+        path: str (mandatory)
+            a directory path relative to the CWSearch directory.
+
+        Returns
+        -------
+        entries: list of 2-uplet
+            the directory items sorted by name, each item of the form
+            (name, real_path) where real_path is None for the directories.
+        """
+        if isinstance(path, str):
+            path = path.decode("utf-8")
+        return self.cnx.execute(
+            "SELECT name, real_path FROM entries WHERE parent = ? "
+            "ORDER BY name", (path.rstrip("/") or u"/", )).fetchall()
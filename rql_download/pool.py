@@ -0,0 +1,143 @@
+#! /usr/bin/env python
+##########################################################################
+# NSAp - Copyright (C) CEA, 2013
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+""" Bounded pool of cubicweb connections shared between threads.
+"""
+
+# System import
+import time
+import Queue
+import threading
+from contextlib import contextmanager
+
+
+class PoolTimeoutError(Exception):
+    """ No connection became available in the pool before the timeout.
+    """
+
+
+class ConnectionPool(object):
+    """ Bound the number of cubicweb connections used concurrently and
+    report the time spent waiting for one of them.
+
+    .. code-block:: python
+
+        pool = ConnectionPool(repo.internal_cnx, size=4)
+        with pool.connection() as cnx:
+            cnx.execute(rql)
+    """
+    def __init__(self, factory, size, timeout=None, name="cw"):
+        """ Initialize the ConnectionPool class.
+
+        Parameters
+        ----------
+        factory: callable (mandatory)
+            a function returning a new connection, used as a context manager
+            (ie. 'repo.internal_cnx' or 'session.new_cnx'), None if the
+            factory is given with each connection request.
+        size: int (mandatory)
+            the maximum number of connections used concurrently.
+        timeout: float (optional, default None)
+            the maximum time in seconds to wait for a connection, None to
+            wait forever.
+        name: str (optional, default 'cw')
+            the pool name used in the reports.
+        """
+        if size < 1:
+            raise ValueError("A connection pool needs at least one slot.")
+        self.factory = factory
+        self.size = size
+        self.timeout = timeout
+        self.name = name
+        self._slots = Queue.Queue()
+        for index in range(size):
+            self._slots.put(index)
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self._nb_acquired = 0
+        self._nb_timeouts = 0
+        self._total_wait = 0.
+        self._max_wait = 0.
+
+    @contextmanager
+    def connection(self, factory=None):
+        """ Wait for a free slot and open a connection in it.
+
+        Parameters
+        ----------
+        factory: callable (optional, default None)
+            a function returning a new connection, ie. the session of the
+            user sharing the pool, None to use the pool factory.
+
+        .. note::
+            raise a 'PoolTimeoutError' if no slot is available before the
+            pool timeout.
+        """
+        factory = factory or self.factory
+        slot = self._acquire()
+        try:
+            with factory() as cnx:
+                yield cnx
+        finally:
+            self._release(slot)
+
+    def _acquire(self):
+        """ Get a free slot and record the waiting time.
+        """
+        start = time.time()
+        try:
+            slot = self._slots.get(timeout=self.timeout)
+        except Queue.Empty:
+            with self._lock:
+                self._nb_timeouts += 1
+            raise PoolTimeoutError(
+                "No connection available in the '{0}' pool after {1} "
+                "seconds.".format(self.name, self.timeout))
+        wait = time.time() - start
+        with self._lock:
+            self._in_use += 1
+            self._nb_acquired += 1
+            self._total_wait += wait
+            self._max_wait = max(self._max_wait, wait)
+        return slot
+
+    def _release(self, slot):
+        """ Give back a slot to the pool.
+        """
+        with self._lock:
+            self._in_use -= 1
+        self._slots.put(slot)
+
+    def stats(self):
+        """ Get the pool metrics.
+
+        Returns
+        -------
+        stats: dict
+            the pool 'size', the number of connections 'in_use', the current
+            'utilization' ratio, the number of 'acquired' connections and of
+            'timeouts', the 'mean_wait' and 'max_wait' times in seconds.
+        """
+        with self._lock:
+            return {
+                "size": self.size,
+                "in_use": self._in_use,
+                "utilization": self._in_use / float(self.size),
+                "acquired": self._nb_acquired,
+                "timeouts": self._nb_timeouts,
+                "mean_wait": self._total_wait / max(self._nb_acquired, 1),
+                "max_wait": self._max_wait
+            }
+
+    def report(self):
+        """ Get a one line summary of the pool metrics.
+        """
+        return ("'{0}' pool: {in_use}/{size} connections in use, {acquired} "
+                "acquired, {timeouts} timeouts, wait mean={mean_wait:.3f}s "
+                "max={max_wait:.3f}s".format(self.name, **self.stats()))
@@ -59,4 +59,71 @@ options = (
               "them.",
       "group": "rql_download", "level": 0,
       }),
+    ("fuse_pool_size",
+      {"type": "int",
+      "default": 4,
+      "help": "number of internal connections used concurrently to build the "
+              "users fuse virtual directories (ie. the number of parallel "
+              "virtual directory updates).",
+      "group": "rql_download", "level": 1,
+      }),
+    ("fuse_refresh_delay",
+      {"type": "float",
+      "default": 1.,
+      "help": "delay in seconds before rebuilding a user fuse virtual "
+              "directory after a new CWSearch: the requests received during "
+              "this delay are coalesced in one rebuild.",
+      "group": "rql_download", "level": 1,
+      }),
+    ("fuse_profile",
+      {"type": "choice",
+      "choices": ("default", "cached", "throughput"),
+      "default": "default",
+      "help": "fuse performance profile: 'default' sends every read and stat "
+              "to cubicweb, 'cached' lets the kernel cache the attributes and "
+              "the unchanged files pages, 'throughput' also keeps the files "
+              "pages cached and uses larger read and read-ahead sizes (the "
+              "files are expected to be immutable).",
+      "group": "rql_download", "level": 1,
+      }),
+    ("fuse_options",
+      {"type": "string",
+      "default": "",
+      "help": "comma separated fuse mount options (ie. "
+              "'max_read=131072,attr_timeout=10') that override the "
+              "'fuse_profile' options.",
+      "group": "rql_download", "level": 1,
+      }),
+    ("fuse_read_ahead",
+      {"type": "int",
+      "default": 0,
+      "help": "size in MB of the windows prefetched in background when a "
+              "file is read sequentially through fuse, 0 to disable the "
+              "read-ahead.",
+      "group": "rql_download", "level": 1,
+      }),
+    ("fuse_read_ahead_memory",
+      {"type": "int",
+      "default": 512,
+      "help": "maximum memory in MB held by the fuse read-ahead buffers of "
+              "all the open files.",
+      "group": "rql_download", "level": 1,
+      }),
+    ("search_index_dir",
+      {"type": "string",
+      "default": "",
+      "help": "directory where a persistent index of the files of each "
+              "CWSearch is built at its creation and then queried by the "
+              "fuse and sftp servers, empty to keep the files in memory.",
+      "group": "rql_download", "level": 1,
+      }),
+    ("fuse_startup_recent_days",
+      {"type": "int",
+      "default": 0,
+      "help": "on startup, only mount the users who created a CWSearch "
+              "during the last days, 0 to mount all the users. The other "
+              "users have no mount point, even for their existing CWSearch, "
+              "until they create a new CWSearch.",
+      "group": "rql_download", "level": 1,
+      }),
 )
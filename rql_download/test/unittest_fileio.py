@@ -0,0 +1,113 @@
+#! /usr/bin/env python
+##########################################################################
+# NSAp - Copyright (C) CEA, 2013
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+""" Test the shared files and their read-ahead buffers """
+
+# System import
+import os
+import shutil
+import tempfile
+import unittest
+
+# Rql Download import
+from cubes.rql_download.fileio import ReadAheadCache
+from cubes.rql_download.fileio import ReadAheadChunk
+from cubes.rql_download.fileio import SharedFiles
+
+
+class TestSharedFiles(unittest.TestCase):
+    """ Test the openings of the shared files.
+    """
+    def setUp(self):
+        """ Create a real file.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.content = "".join(chr(index % 256) for index in range(4096))
+        self.real_path = os.path.join(self.tmpdir, "file.txt")
+        with open(self.real_path, "wb") as open_file:
+            open_file.write(self.content)
+        self.cache = ReadAheadCache(window_size=256, max_memory=4096,
+                                    nb_workers=2)
+        self.files = SharedFiles(self.cache)
+
+    def tearDown(self):
+        """ Remove the real file.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def test_openings(self):
+        """ The openings of a file share its file descriptor but each one
+        has its own handle and read-ahead state.
+        """
+        handles = [self.files.open(self.real_path, os.O_RDONLY)
+                   for index in range(2)]
+        self.assertNotEqual(handles[0], handles[1])
+        self.assertEqual(self.files.fileno(handles[0]),
+                         self.files.fileno(handles[1]))
+
+        # Two interleaved sequential readers at different offsets are both
+        # prefetched
+        offsets = [0, 2048]
+        for index in range(6):
+            for reader, handle in enumerate(handles):
+                data = self.files.read(handle, 64, offsets[reader])
+                self.assertEqual(
+                    str(data),
+                    self.content[offsets[reader]: offsets[reader] + 64])
+                offsets[reader] += 64
+        for handle in handles:
+            self.assertTrue(len(self.files.handles[handle][2].chunks) > 0)
+
+        # The memory is given back and the file descriptor is closed with
+        # the last opening
+        fd = self.files.fileno(handles[0])
+        self.files.release(handles[0])
+        os.fstat(fd)
+        self.files.release(handles[1])
+        self.assertRaises(OSError, os.fstat, fd)
+        self.assertEqual(self.cache.memory, 0)
+        self.assertEqual(self.files.files, {})
+        self.assertEqual(self.files.handles, {})
+
+    def test_opener(self):
+        """ The opener, ie. the user permissions check, is only called to
+        open the file descriptor.
+        """
+        calls = []
+
+        def opener(real_path, flags):
+            calls.append(real_path)
+            return os.open(real_path, flags)
+
+        handles = [self.files.open(self.real_path, os.O_RDONLY, opener)
+                   for index in range(2)]
+        self.assertEqual(calls, [self.real_path])
+        for handle in handles:
+            self.files.release(handle)
+
+    def test_drop_pending_chunk(self):
+        """ The memory of a dropped chunk is given back once its prefetch
+        is done.
+        """
+        self.assertTrue(self.cache.reserve(256))
+        chunk = ReadAheadChunk(0, 256)
+        self.cache.drop(chunk)
+        self.assertEqual(self.cache.memory, 256)
+        handle = self.files.open(self.real_path, os.O_RDONLY)
+        try:
+            self.cache.queue.put((self.files.fileno(handle), chunk))
+            chunk.ready.wait()
+        finally:
+            self.files.release(handle)
+        self.assertEqual(self.cache.memory, 0)
+        self.assertEqual(chunk.data, None)
+
+
+if __name__ == "__main__":
+    unittest.main()
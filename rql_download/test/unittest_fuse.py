@@ -0,0 +1,234 @@
+#! /usr/bin/env python
+##########################################################################
+# NSAp - Copyright (C) CEA, 2013
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+""" Test the fuse virtual directories and their mount point views """
+
+# System import
+import os
+import stat
+import time
+import shutil
+import tempfile
+import threading
+import Queue
+import unittest
+
+# Rql Download import
+from cubes.rql_download.pool import ConnectionPool
+from cubes.rql_download.fuse.fuse_mount import FuseDaemon
+from cubes.rql_download.fuse.fuse_mount import FuseRset
+from cubes.rql_download.fuse.fuse_mount import VirtualDirectory
+
+
+class FixtureFuseDaemon(FuseDaemon):
+    """ A fuse daemon without cw instance: the refreshes are only recorded
+    and publish an empty virtual directory.
+    """
+    def __init__(self, refresh_delay, nb_workers=1):
+        """ Start the refresh scheduler and its workers.
+        """
+        self.instance_name = "fixture"
+        self.trees = {}
+        self.mounts = {}
+        self.pending = {}
+        self.running = set()
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.refresh_delay = refresh_delay
+        self.pool = ConnectionPool(object, 1, name="fixture")
+        self.data_root_dir = "/"
+        self.access_logger = None
+        self.files = None
+        self.refresh_queue = Queue.PriorityQueue()
+        self.sequence = 0
+        self.updates = []
+        self.updated = threading.Condition()
+        self.scheduler = threading.Thread(target=self._schedule_loop)
+        self.scheduler.daemon = True
+        self.scheduler.start()
+        for index in range(nb_workers):
+            worker = threading.Thread(target=self._refresh_loop)
+            worker.daemon = True
+            worker.start()
+
+    def update(self, login):
+        """ Record the refresh of a user.
+        """
+        self.trees[login] = VirtualDirectory(self.data_root_dir)
+        with self.updated:
+            self.updates.append(login)
+            self.updated.notify_all()
+
+    def mount(self, login):
+        """ Do not mount anything.
+        """
+
+    def wait_updates(self, nb_updates, timeout=5):
+        """ Wait for at least 'nb_updates' refreshes.
+        """
+        deadline = time.time() + timeout
+        with self.updated:
+            while len(self.updates) < nb_updates and time.time() < deadline:
+                self.updated.wait(deadline - time.time())
+        return list(self.updates)
+
+
+class TestVirtualDirectory(unittest.TestCase):
+    """ Test a virtual directory built over a temporary directory, with two
+    CWSearch sharing a real file.
+    """
+    def setUp(self):
+        """ Create the real files and their virtual directory.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.real_paths = []
+        for name, size in (("shared.nii", 5000), ("other.nii", 10)):
+            self.real_paths.append(os.path.join(self.tmpdir, name))
+            with open(self.real_paths[-1], "wb") as open_file:
+                open_file.write("x" * size)
+        shared_path, other_path = self.real_paths
+
+        self.vdir = VirtualDirectory(self.tmpdir)
+        self.vdir.make_directory("/", 0, 0, 0)
+        for cwsearch_eid, cwsearch_name in ((10, "search1"), (11, "search2")):
+            self.vdir.search_eids[cwsearch_name] = cwsearch_eid
+            self.vdir.rset_data[cwsearch_name] = "rset"
+            self.vdir.make_directory("/" + cwsearch_name, 0, 0, 0)
+            self.vdir.add_file("/{0}/shared.nii".format(cwsearch_name),
+                               shared_path, 0, 0)
+            self.vdir.add_file(
+                "/{0}/request_result.txt".format(cwsearch_name),
+                os.path.join(self.tmpdir, "request_result.txt"), 0, 0)
+        self.vdir.add_file("/search1/other.nii", other_path, 0, 0)
+
+        # A mount point view on the virtual directory
+        daemon = FuseDaemon.__new__(FuseDaemon)
+        daemon.instance_name = "fixture"
+        daemon.data_root_dir = self.tmpdir
+        daemon.access_logger = None
+        daemon.files = None
+        daemon.trees = {"user": self.vdir}
+        self.fuse_rset = FuseRset(daemon, "user")
+
+    def tearDown(self):
+        """ Remove the real files.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def test_readdir(self):
+        """ The readdir attributes are only taken from the stat cache: the
+        real files are never stated.
+        """
+        entries = dict((name, attrs) for name, attrs, offset
+                       in self.fuse_rset.readdir("/search1", None))
+        self.assertEqual(sorted(entries), [".", "..", "other.nii",
+                                           "request_result.txt",
+                                           "shared.nii"])
+        self.assertEqual(entries["shared.nii"], None)
+        self.assertEqual(entries["other.nii"], None)
+        self.assertEqual(entries["request_result.txt"]["st_size"], 4)
+        self.assertTrue(stat.S_ISDIR(entries[".."]["st_mode"]))
+        self.assertEqual(self.vdir.stat_cache, {})
+
+        # Once stated, a real file attributes are served from the cache
+        self.fuse_rset.getattr("/search1/shared.nii")
+        entries = dict((name, attrs) for name, attrs, offset
+                       in self.fuse_rset.readdir("/search1", None))
+        self.assertEqual(entries["shared.nii"]["st_size"], 5000)
+        self.assertEqual(entries["other.nii"], None)
+
+    def test_statfs(self):
+        """ The statfs totals count the shared real files once and are
+        computed before the virtual directory is published.
+        """
+        self.vdir.add_real_sizes()
+        self.assertEqual(len(self.vdir.stat_cache), 2)
+        os.remove(self.real_paths[0])
+        result = self.fuse_rset.statfs("/")
+        self.assertEqual(result["f_files"], 4)
+        self.assertEqual(result["f_blocks"], 2)
+        self.assertEqual(self.vdir.nb_bytes, 5000 + 10 + 2 * 4)
+
+    def test_xattrs(self):
+        """ The extended attributes give the CWSearch a path comes from.
+        """
+        self.assertEqual(self.fuse_rset.listxattr("/"), [])
+        self.assertEqual(self.fuse_rset.getxattr(
+            "/search2", "user.rql_download.eid"), "11")
+        self.assertEqual(self.fuse_rset.listxattr("/search2"), [
+            "user.rql_download.eid", "user.rql_download.search"])
+        self.assertEqual(self.fuse_rset.getxattr(
+            "/search1/other.nii", "user.rql_download.size"), "10")
+        self.assertEqual(self.fuse_rset.getxattr(
+            "/search1/other.nii", "user.rql_download.search"), "search1")
+        self.assertRaises(OSError, self.fuse_rset.getxattr,
+                          "/search2", "user.rql_download.size")
+        self.assertRaises(OSError, self.fuse_rset.listxattr, "/search3")
+
+    def test_shared_nodes(self):
+        """ The virtual files of a real file share one node and are seen as
+        hard links.
+        """
+        shared_path, other_path = self.real_paths
+        self.assertEqual(len(self.vdir.nodes), 3)
+        self.assertTrue(self.vdir.content["/search1/shared.nii"] is
+                        self.vdir.content["/search2/shared.nii"])
+        self.assertEqual(self.vdir.references[shared_path], 2)
+        self.assertEqual(self.vdir.references[other_path], 1)
+
+        stats = [self.vdir.stat(path) for path in ("/search1/shared.nii",
+                                                   "/search2/shared.nii")]
+        self.assertEqual(stats[0]["st_ino"], stats[1]["st_ino"])
+        self.assertEqual(stats[0]["st_nlink"], 2)
+        self.assertEqual(self.vdir.stat("/search1/other.nii")["st_nlink"], 1)
+        self.assertTrue(stat.S_ISDIR(self.vdir.stat("/search1")["st_mode"]))
+        self.assertRaises(ValueError, self.vdir.add_file,
+                          "/search1/shared.nii", other_path, 0, 0)
+
+
+class TestFuseDaemon(unittest.TestCase):
+    """ Test the refresh scheduler of the fuse daemon.
+    """
+    def test_debounced_refresh(self):
+        """ A burst of refresh requests for a user triggers a single rebuild
+        after the refresh delay.
+        """
+        daemon = FixtureFuseDaemon(refresh_delay=0.2)
+        start = time.time()
+        for index in range(10):
+            daemon.refresh("user1")
+        daemon.refresh("user2")
+        self.assertEqual(sorted(daemon.wait_updates(2)), ["user1", "user2"])
+        self.assertTrue(time.time() - start >= 0.2)
+        time.sleep(0.3)
+        self.assertEqual(len(daemon.updates), 2)
+        self.assertEqual(daemon.pending, {})
+        self.assertEqual(daemon.running, set())
+
+        # A new request after the rebuild triggers a new rebuild
+        daemon.refresh("user1")
+        self.assertEqual(daemon.wait_updates(3)[2:], ["user1"])
+
+    def test_refresh_priority(self):
+        """ The due refreshes are queued by priority: the priority of a
+        pending request can only be raised.
+        """
+        daemon = FixtureFuseDaemon(refresh_delay=0.1, nb_workers=0)
+        daemon.refresh("user1", priority=2)
+        daemon.refresh("user2", priority=2)
+        daemon.refresh("user3", priority=1)
+        daemon.refresh("user2", priority=0)
+        daemon.refresh("user3", priority=3)
+        logins = [daemon.refresh_queue.get(timeout=5)[2]
+                  for index in range(3)]
+        self.assertEqual(logins, ["user2", "user3", "user1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+#! /usr/bin/env python
+##########################################################################
+# NSAp - Copyright (C) CEA, 2013
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+""" Test the CWSearch persistent index """
+
+# System import
+import os
+import shutil
+import tempfile
+import unittest
+import threading
+
+# Rql Download import
+from cubes.rql_download.index import SearchIndex, get_index_file
+
+
+class TestSearchIndex(unittest.TestCase):
+    """ Test the CWSearch persistent index.
+    """
+    def setUp(self):
+        """ Index a few files.
+        """
+        self.index_dir = tempfile.mkdtemp()
+        self.index = SearchIndex.build(
+            get_index_file(self.index_dir, 1234), [
+                u"/tmp/study/subdir1/fichier1",
+                u"/tmp/study/subdir2/fichier2",
+                u"/tmp/study/subdir2/fichier3",
+                u"/tmp/study/subdir1/fichier4",
+                u"/tmp/request_result.json"
+            ], u"/tmp")
+
+    def tearDown(self):
+        """ Remove the index.
+        """
+        shutil.rmtree(self.index_dir)
+
+    def test_build(self):
+        """ The index is written at once in the index directory.
+        """
+        self.assertEqual(os.listdir(self.index_dir), ["1234.sqlite"])
+
+    def test_listdir(self):
+        """ Only the requested directory is listed.
+        """
+        self.assertEqual(self.index.listdir("/"), [
+            (u"request_result.json", u"/tmp/request_result.json"),
+            (u"study", None)])
+        self.assertEqual(self.index.listdir("/study/subdir1/"), [
+            (u"fichier1", u"/tmp/study/subdir1/fichier1"),
+            (u"fichier4", u"/tmp/study/subdir1/fichier4")])
+        self.assertEqual(self.index.listdir("/unknown"), [])
+
+    def test_lookup(self):
+        """ The entries are found by path.
+        """
+        self.assertEqual(self.index.lookup("/"), (True, None))
+        self.assertEqual(self.index.lookup("/study/subdir2"), (True, None))
+        self.assertEqual(self.index.lookup("/study/subdir2/fichier3"),
+                         (False, u"/tmp/study/subdir2/fichier3"))
+        self.assertEqual(self.index.lookup("/study/fichier3"), None)
+
+    def test_totals(self):
+        """ The number of files and their size are computed once.
+        """
+        self.assertEqual(self.index.totals(), (5, 0))
+        fname = os.path.join(self.index_dir, "data.txt")
+        with open(fname, "w") as open_file:
+            open_file.write("x" * 10)
+        index = SearchIndex.build(
+            get_index_file(self.index_dir, 1), [fname], self.index_dir)
+        self.assertEqual(index.totals(), (1, 10))
+
+    def test_concurrent_builds(self):
+        """ Concurrent builds of the same index never publish a partial
+        index.
+        """
+        index_file = get_index_file(self.index_dir, 42)
+        files = [u"/tmp/study/file{0}".format(index)
+                 for index in range(2000)]
+        errors = []
+
+        def build():
+            try:
+                for index in range(5):
+                    SearchIndex.build(index_file, files, u"/tmp")
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=build) for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(os.listdir(self.index_dir)),
+                         ["1234.sqlite", "42.sqlite"])
+        self.assertEqual(SearchIndex(index_file).totals(), (2000, 0))
+        self.assertEqual(len(SearchIndex(index_file).listdir("/study")), 2000)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+##########################################################################
+# NSAp - Copyright (C) CEA, 2013
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+""" Test the connection pool """
+
+# System import
+import time
+import threading
+import unittest
+
+# Rql Download import
+from cubes.rql_download.pool import ConnectionPool, PoolTimeoutError
+
+
+class FakeConnection(object):
+    """ A connection that records the number of concurrent users.
+    """
+    lock = threading.Lock()
+    opened = 0
+    max_opened = 0
+
+    def __enter__(self):
+        with self.lock:
+            FakeConnection.opened += 1
+            FakeConnection.max_opened = max(FakeConnection.max_opened,
+                                            FakeConnection.opened)
+        time.sleep(0.02)
+        return self
+
+    def __exit__(self, *args):
+        with self.lock:
+            FakeConnection.opened -= 1
+
+
+class OtherConnection(FakeConnection):
+    """ A connection opened by another factory, ie. another user session.
+    """
+
+
+class TestConnectionPool(unittest.TestCase):
+    """ Test the bounded connection pool.
+    """
+    def setUp(self):
+        """ Reset the connection counters.
+        """
+        FakeConnection.opened = 0
+        FakeConnection.max_opened = 0
+
+    def test_bounded_concurrency(self):
+        """ No more than 'size' connections are used at the same time.
+        """
+        pool = ConnectionPool(FakeConnection, 2)
+
+        def worker():
+            with pool.connection():
+                pass
+
+        threads = [threading.Thread(target=worker) for index in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(FakeConnection.max_opened, 2)
+        stats = pool.stats()
+        self.assertEqual(stats["acquired"], 6)
+        self.assertEqual(stats["in_use"], 0)
+        self.assertTrue(stats["max_wait"] > 0)
+
+    def test_timeout(self):
+        """ A 'PoolTimeoutError' is raised when no connection is available.
+        """
+        pool = ConnectionPool(FakeConnection, 1, timeout=0.001)
+        with pool.connection():
+            with self.assertRaises(PoolTimeoutError):
+                with pool.connection():
+                    pass
+        self.assertEqual(pool.stats()["timeouts"], 1)
+        self.assertEqual(pool.stats()["in_use"], 0)
+
+    def test_shared_slots(self):
+        """ The connections of different factories share the pool slots.
+        """
+        pool = ConnectionPool(None, 2)
+
+        def worker(factory):
+            with pool.connection(factory):
+                pass
+
+        threads = [threading.Thread(target=worker, args=(factory, ))
+                   for factory in [FakeConnection, OtherConnection] * 3]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(FakeConnection.max_opened, 2)
+        self.assertEqual(pool.stats()["acquired"], 6)
+
+
+if __name__ == "__main__":
+    unittest.main()
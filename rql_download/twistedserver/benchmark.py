@@ -0,0 +1,470 @@
+#! /usr/bin/env python
+##########################################################################
+# NSAp - Copyright (C) CEA, 2013
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+"""
+Benchmarks of the sftp request handlers against a local directory.
+
+Simulated sftp clients walk or read the local directory through the
+'CubicWebProxiedSFTPServer' handlers, without any network transport and
+without any cw instance.
+
+> concurrent clients exemple (add 10ms to each stat to mimic a slow NFS):
+    python benchmark.py -b clients -d /tmp/study -n 1,8,32 -t 16 -l 0.01
+
+> pipelined reads exemple (1, 16 and 64 read requests in flight):
+    python benchmark.py -b reads -d /tmp/study -r 1,16,64 -t 16
+
+> directory listings exemple (a CWSearch of 10^5 generated paths):
+    python benchmark.py -b listing -p 100000
+"""
+
+# System import
+import os
+import pwd
+import time
+import stat
+import random
+from optparse import OptionParser
+
+# Twisted import
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.conch.ssh.filetransfer import FXF_READ
+from twisted.conch.unix import SFTPServerForUnixConchUser
+from twisted.conch.unix import UnixConchUser
+from twisted.python.threadpool import ThreadPool
+
+# Cubicweb import
+from cubicweb import Binary
+
+# RQL download import
+from cubes.rql_download import fileio
+from cubes.rql_download.fileio import FileHashes
+from cubes.rql_download.fileio import ReadAheadCache
+from cubes.rql_download.fileio import SharedFiles
+from cubes.rql_download.twistedserver.server import CubicWebConchUser
+from cubes.rql_download.twistedserver.server import CubicWebProxiedSFTPServer
+from cubes.rql_download.twistedserver.server import SortedFiles
+from cubes.rql_download.twistedserver.server import VirtualPathTranslator
+
+
+# Define the fixture virtual names
+INSTANCE_NAME = "fixture"
+SEARCH_NAME = u"bench"
+
+
+def list_files(directory):
+    """ List recursively the regular files of a directory.
+    """
+    files = []
+    for root, dirnames, fnames in os.walk(directory):
+        for fname in fnames:
+            path = os.path.join(root, fname)
+            if os.path.isfile(path):
+                files.append(path)
+    return files
+
+
+class FixtureSearch(object):
+    """ A 'Search' that exposes a local directory as a single CWSearch.
+    """
+    def __init__(self, directory):
+        """ Sort the files of a local directory.
+
+        Parameters
+        ----------
+        directory: str (mandatory)
+            the local directory to expose.
+        """
+        self.files = SortedFiles(
+            [(path, False) for path in list_files(directory)])
+
+    def get_dir_files(self, virtpath, session_index):
+        dirpath = os.path.join(virtpath.search_basedir,
+                               virtpath.search_relpath)
+        return self.files.children(dirpath)
+
+    def get_searches(self, session_indexes=None):
+        return [[(SEARCH_NAME, )]]
+
+    def get_rset_size(self, search_name, session_index):
+        return 0
+
+    def get_file_data(self, file_eid, rset_file, session_index,
+                      search_name=None):
+        return Binary()
+
+
+class FixtureConchUser(CubicWebConchUser):
+    """ A 'CubicWebConchUser' that exposes a local directory without any cw
+    instance.
+    """
+    def __init__(self, search, directory, threadpool, files=None):
+        """ Build the avatar of the current unix user.
+
+        Parameters
+        ----------
+        search: FixtureSearch (mandatory)
+            the local directory CWSearch.
+        directory: str (mandatory)
+            the local directory to expose.
+        threadpool: twisted.python.threadpool.ThreadPool (mandatory)
+            the thread pool running the blocking sftp requests, None to run
+            them in the reactor thread.
+        files: SharedFiles (optional, default None)
+            the real files opened by all the users.
+        """
+        UnixConchUser.__init__(self, pwd.getpwuid(os.getuid()).pw_name)
+        self.login = self.username
+        self.threadpool = threadpool
+        self.files = files or SharedFiles()
+        self.hashes = FileHashes()
+        self.path_translator = VirtualPathTranslator(search)
+        self.path_translator.BASE_REAL_DIR = directory
+        self.path_translator.INSTANCE_NAMES = [INSTANCE_NAME]
+        self.path_translator.load_search_index()
+
+
+def slow_call(func, latency, regular_files_only=False):
+    """ Build a stat or read function that mimics a slow file system.
+
+    The reads of the pipes (ie. the reactor waker) can be left unchanged.
+    """
+    def _call(*args, **kwargs):
+        if (not regular_files_only or
+                stat.S_ISREG(os.fstat(args[0]).st_mode)):
+            time.sleep(latency)
+        return func(*args, **kwargs)
+    return _call
+
+
+def set_latency(latency):
+    """ Add a latency to the stats and the reads.
+    """
+    os.stat = slow_call(os.stat, latency)
+    os.lstat = slow_call(os.lstat, latency)
+    os.read = slow_call(os.read, latency, regular_files_only=True)
+    fileio.pread = slow_call(fileio.pread, latency)
+
+
+@defer.inlineCallbacks
+def sftp_client(server, chunk_size=32768):
+    """ Walk the fixture as a sftp client: list each directory, stat each
+    item and read each file.
+
+    Returns
+    -------
+    counts: 2-uplet
+        a Deferred called back with the number of requests and the number of
+        bytes read.
+    """
+    nb_requests, nb_bytes = 0, 0
+    directories = ["/{0}/{1}".format(INSTANCE_NAME, SEARCH_NAME)]
+    while len(directories) > 0:
+        dirpath = directories.pop()
+        listing = yield defer.maybeDeferred(server.openDirectory, dirpath)
+        nb_requests += 1
+        for name, longname, attrs in listing:
+            path = dirpath + "/" + name
+            attrs = yield defer.maybeDeferred(server.getAttrs, path, False)
+            nb_requests += 1
+            if stat.S_ISDIR(attrs["permissions"]):
+                directories.append(path)
+                continue
+            sftp_file = yield defer.maybeDeferred(
+                server.openFile, path, FXF_READ, {})
+            offset = 0
+            while True:
+                data = yield defer.maybeDeferred(
+                    sftp_file.readChunk, offset, chunk_size)
+                nb_requests += 1
+                if not data:
+                    break
+                offset += len(data)
+            nb_bytes += offset
+            yield defer.maybeDeferred(sftp_file.close)
+            nb_requests += 2
+        listing.close()
+    defer.returnValue((nb_requests, nb_bytes))
+
+
+@defer.inlineCallbacks
+def bench_clients(search, directory, nb_clients, nb_threads):
+    """ Run 'nb_clients' concurrent sftp clients.
+
+    Parameters
+    ----------
+    search: FixtureSearch (mandatory)
+        the local directory CWSearch.
+    directory: str (mandatory)
+        the local directory to expose.
+    nb_clients: int (mandatory)
+        the number of concurrent clients.
+    nb_threads: int (mandatory)
+        the size of the thread pool running the blocking requests, 0 to run
+        them in the reactor thread.
+
+    Returns
+    -------
+    rates: 2-uplet
+        a Deferred called back with the requests rate per second and the
+        read throughput in MB/s.
+    """
+    threadpool = None
+    if nb_threads > 0:
+        threadpool = ThreadPool(minthreads=1, maxthreads=nb_threads,
+                                name="sftp")
+        threadpool.start()
+    try:
+        start = time.time()
+        results = yield defer.gatherResults([
+            sftp_client(CubicWebProxiedSFTPServer(
+                FixtureConchUser(search, directory, threadpool)))
+            for index in range(nb_clients)])
+        duration = max(time.time() - start, 1e-9)
+    finally:
+        if threadpool is not None:
+            threadpool.stop()
+    nb_requests = sum(item[0] for item in results)
+    nb_bytes = sum(item[1] for item in results)
+    defer.returnValue(
+        (nb_requests / duration, nb_bytes / (1024. * 1024.) / duration))
+
+
+@defer.inlineCallbacks
+def run_clients(directory, nb_clients_list, nb_threads, latency=0.):
+    """ Compare the requests served in the reactor thread with the requests
+    served by the thread pool for an increasing number of clients.
+    """
+    print("{0} files in '{1}'".format(len(list_files(directory)), directory))
+    search = FixtureSearch(directory)
+    if latency > 0:
+        set_latency(latency)
+    try:
+        for name, threads in (("reactor thread", 0),
+                              ("thread pool", nb_threads)):
+            for nb_clients in nb_clients_list:
+                rate, throughput = yield bench_clients(
+                    search, directory, nb_clients, threads)
+                print("{0:<16} threads={1:<4} clients={2:<4} {3:10.1f} "
+                      "requests/s {4:10.1f} MB/s".format(
+                          name, threads, nb_clients, rate, throughput))
+    finally:
+        reactor.stop()
+
+
+def open_legacy(sftp_server, path):
+    """ Open a real file with the twisted unix sftp file handle.
+    """
+    t = sftp_server.avatar.path_translator
+    return SFTPServerForUnixConchUser.openFile(
+        sftp_server, t.real_path(t.split_virtual_path(path)), FXF_READ, {})
+
+
+@defer.inlineCallbacks
+def pipelined_read(sftp_file, size, nb_requests, chunk_size):
+    """ Read a file as a sftp client with 'nb_requests' read requests in
+    flight.
+
+    Returns
+    -------
+    nb_bytes: int
+        a Deferred called back with the number of bytes read.
+    """
+    offsets = iter(xrange(0, size, chunk_size))
+    nb_bytes = [0]
+
+    @defer.inlineCallbacks
+    def request_loop():
+        for offset in offsets:
+            data = yield defer.maybeDeferred(
+                sftp_file.readChunk, offset, chunk_size)
+            nb_bytes[0] += len(data)
+
+    yield defer.gatherResults([request_loop() for index in range(nb_requests)])
+    defer.returnValue(nb_bytes[0])
+
+
+@defer.inlineCallbacks
+def bench_reads(sftp_server, files, nb_requests, chunk_size, open_func=None):
+    """ Read all the files one after the other with pipelined requests.
+
+    Parameters
+    ----------
+    sftp_server: CubicWebProxiedSFTPServer (mandatory)
+        the sftp server of the fixture user.
+    files: list of 2-uplet (mandatory)
+        the virtual path and the size of each file.
+    nb_requests: int (mandatory)
+        the number of read requests in flight.
+    chunk_size: int (mandatory)
+        the size of each read request.
+    open_func: callable (optional, default None)
+        the function opening a file, 'sftp_server.openFile' by default.
+
+    Returns
+    -------
+    throughput: float
+        a Deferred called back with the read throughput in MB/s.
+    """
+    nb_bytes = 0
+    start = time.time()
+    for path, size in files:
+        if open_func is None:
+            sftp_file = yield defer.maybeDeferred(
+                sftp_server.openFile, path, FXF_READ, {})
+        else:
+            sftp_file = open_func(sftp_server, path)
+        nb_bytes += yield pipelined_read(
+            sftp_file, size, nb_requests, chunk_size)
+        yield defer.maybeDeferred(sftp_file.close)
+    duration = max(time.time() - start, 1e-9)
+    defer.returnValue(nb_bytes / (1024. * 1024.) / duration)
+
+
+@defer.inlineCallbacks
+def run_reads(directory, nb_requests_list, nb_threads, chunk_size=32768,
+              read_ahead=8, latency=0.):
+    """ Compare the twisted unix file handle, reading in the reactor
+    thread, with the pipelined positional reads of the thread pool, with
+    and without read-ahead.
+    """
+    files = [("/{0}/{1}/{2}".format(
+        INSTANCE_NAME, SEARCH_NAME, os.path.relpath(path, directory)),
+        os.path.getsize(path)) for path in list_files(directory)]
+    print("{0} files in '{1}', {2} bytes chunks".format(
+        len(files), directory, chunk_size))
+    search = FixtureSearch(directory)
+    if latency > 0:
+        set_latency(latency)
+    threadpool = ThreadPool(minthreads=1, maxthreads=nb_threads, name="sftp")
+    threadpool.start()
+    try:
+        for name, files_factory, open_func in (
+                ("unix file (reactor)", SharedFiles, open_legacy),
+                ("pread (pool)", SharedFiles, None),
+                ("pread+read-ahead (pool)", lambda: SharedFiles(
+                    ReadAheadCache(read_ahead * 1024 ** 2, 512 * 1024 ** 2)),
+                 None)):
+            for nb_requests in nb_requests_list:
+                sftp_server = CubicWebProxiedSFTPServer(FixtureConchUser(
+                    search, directory, threadpool, files_factory()))
+                throughput = yield bench_reads(
+                    sftp_server, files, nb_requests, chunk_size, open_func)
+                print("{0:<24} requests={1:<4} {2:10.1f} MB/s".format(
+                    name, nb_requests, throughput))
+    finally:
+        threadpool.stop()
+        reactor.stop()
+
+
+def legacy_filter_files(files, path):
+    """ The legacy 'VirtualPathTranslator.filter_files': a scan of all the
+    CWSearch files for each listed directory.
+    """
+    if not path.endswith(os.path.sep):
+        path += os.path.sep
+    res = set()
+    for f, rset_file in files:
+        if f.startswith(path):
+            filepath = path + f[len(path):].split('/', 1)[0]
+            if filepath not in res:
+                yield filepath, rset_file
+                res.add(filepath)
+
+
+def run_listing(nb_paths, nb_listings=100):
+    """ Compare the legacy scan of the CWSearch files with the binary search
+    in the sorted files to list random directories of a generated CWSearch.
+
+    The generated paths mimic a study: /study/<subject>/<session>/<file>.
+    """
+    random.seed(0)
+    files = [(u"/study/sub{0:04d}/ses{1}/file{2:06d}.nii.gz".format(
+        index % 1000, index % 3, index), False) for index in range(nb_paths)]
+    random.shuffle(files)
+    dirpaths = [u"/study"] + [
+        u"/study/sub{0:04d}/ses{1}".format(random.randrange(1000),
+                                           random.randrange(3))
+        for index in range(nb_listings - 1)]
+    print("{0} paths, {1} directory listings".format(nb_paths, nb_listings))
+
+    start = time.time()
+    expected = [sorted(legacy_filter_files(files, dirpath))
+                for dirpath in dirpaths]
+    duration = time.time() - start
+    print("{0:<20} {1:10.3f} ms/listing".format(
+        "scan (legacy)", duration * 1000. / nb_listings))
+
+    start = time.time()
+    sorted_files = SortedFiles(files)
+    build = time.time() - start
+    start = time.time()
+    results = [sorted_files.children(dirpath) for dirpath in dirpaths]
+    duration = time.time() - start
+    print("{0:<20} {1:10.3f} ms/listing (sorted once in {2:.1f} ms)".format(
+        "bisect (sorted)", duration * 1000. / nb_listings, build * 1000.))
+    if results != expected:
+        raise ValueError("The listings differ.")
+
+
+if __name__ == "__main__":
+
+    # Parse the command line
+    parser = OptionParser()
+    parser.add_option("-b", "--bench", dest="bench", default="clients",
+                      type="choice", choices=("clients", "reads", "listing"),
+                      help="the benchmark to run: concurrent 'clients', "
+                           "pipelined 'reads' or directory 'listing'.")
+    parser.add_option("-d", "--dir", dest="directory",
+                      help="the local directory containing the files to "
+                           "expose.")
+    parser.add_option("-n", "--nbclients", dest="nb_clients",
+                      default="1,8,32",
+                      help="comma separated numbers of concurrent clients.")
+    parser.add_option("-r", "--nbrequests", dest="nb_requests",
+                      default="1,16,64",
+                      help="comma separated numbers of read requests in "
+                           "flight.")
+    parser.add_option("-c", "--chunksize", dest="chunk_size", type="int",
+                      default=32768,
+                      help="the size of each read request in bytes.")
+    parser.add_option("-a", "--readahead", dest="read_ahead", type="int",
+                      default=8,
+                      help="the read-ahead window in MB.")
+    parser.add_option("-t", "--nbthreads", dest="nb_threads", type="int",
+                      default=16,
+                      help="the size of the thread pool.")
+    parser.add_option("-l", "--latency", dest="latency", type="float",
+                      default=0.,
+                      help="the time in seconds added to each stat and "
+                           "each read to mimic a slow file system.")
+    parser.add_option("-p", "--nbpaths", dest="nb_paths", type="int",
+                      default=100000,
+                      help="the number of paths of the generated CWSearch "
+                           "listed by the 'listing' benchmark.")
+    (options, args) = parser.parse_args()
+    if options.bench == "listing":
+        run_listing(options.nb_paths)
+    elif options.directory is None:
+        parser.error("a local directory is required.")
+    else:
+        directory = os.path.abspath(options.directory)
+        if options.bench == "clients":
+            reactor.callWhenRunning(
+                run_clients, directory,
+                [int(item) for item in options.nb_clients.split(",")],
+                options.nb_threads, options.latency)
+        else:
+            reactor.callWhenRunning(
+                run_reads, directory,
+                [int(item) for item in options.nb_requests.split(",")],
+                options.nb_threads, options.chunk_size, options.read_ahead,
+                options.latency)
+        reactor.run()
@@ -64,6 +64,50 @@ class RsetSFTPCommand(object):
             "help": "base directory in which file are stored (it acts as "
                     "mask, so every files outside this base-dir will be "
                     "invisible)."}),
+        ("index-dir", {
+            "type": "string",
+            "default": "",
+            "metavar": "<string>",
+            "help": "directory containing the persistent indexes of the "
+                    "CWSearch files, empty to load the files from the "
+                    "cubicweb instance."}),
+        ("nb-threads", {
+            "type": "int",
+            "default": 16,
+            "metavar": "<int>",
+            "help": "the maximum number of threads running the blocking "
+                    "sftp requests (cubicweb queries and file system "
+                    "accesses)."}),
+        ("read-ahead", {
+            "type": "int",
+            "default": 8,
+            "metavar": "<int>",
+            "help": "the size in MB of the windows prefetched when a file "
+                    "is read sequentially, 0 to disable the read-ahead."}),
+        ("read-ahead-memory", {
+            "type": "int",
+            "default": 512,
+            "metavar": "<int>",
+            "help": "the maximum memory in MB held by the read-ahead "
+                    "buffers."}),
+        ("cw-pool-size", {
+            "type": "int",
+            "default": 8,
+            "metavar": "<int>",
+            "help": "the maximum number of cubicweb connections used "
+                    "concurrently by all the users on each instance."}),
+        ("cw-pool-timeout", {
+            "type": "int",
+            "default": 30,
+            "metavar": "<int>",
+            "help": "the maximum time in seconds a request waits for a "
+                    "cubicweb connection, 0 to wait forever."}),
+        ("cw-pool-report", {
+            "type": "int",
+            "default": 300,
+            "metavar": "<int>",
+            "help": "the period in seconds of the connection pools usage "
+                    "reports, 0 to disable the reports."}),
         ("port", {
             "type": "int",
             "default": 9999,
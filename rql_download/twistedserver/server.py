@@ -14,8 +14,17 @@ import os.path as osp
 import logging
 import json
 import stat
+import time
+import struct
+import bisect
+import errno
+import functools
+import hashlib
+import multiprocessing.pool
 import posix
+import threading
 from collections import namedtuple
+from contextlib import contextmanager
 
 # Twisted import
 from twisted.conch.ls import lsLine
@@ -28,8 +37,14 @@ from twisted.cred.checkers import ICredentialsChecker
 from twisted.cred.error import UnauthorizedLogin
 from twisted.conch.interfaces import ISFTPServer, ISFTPFile
 from twisted.conch.ssh import factory, keys, session
+from twisted.conch.ssh.common import NS, getNS
+from twisted.conch.ssh.filetransfer import FXF_READ, FXF_WRITE
 from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.internet import threads
 from twisted.python import log
+from twisted.python.threadpool import ThreadPool
 from zope.interface import implements
 
 # CW import
@@ -37,6 +52,15 @@ from cubicweb import cwconfig
 from cubicweb.server.repository import Repository
 from cubicweb.server.utils import TasksManager
 
+# RQL download import
+from cubes.rql_download.index import SearchIndex
+from cubes.rql_download.index import get_index_file
+from cubes.rql_download.fileio import FileHashes
+from cubes.rql_download.fileio import ReadAheadCache
+from cubes.rql_download.fileio import SharedFiles
+from cubes.rql_download.fileio import hash_range
+from cubes.rql_download.pool import ConnectionPool
+
 # Define the logger
 def CWObserver(kwargs):
     log_text = kwargs.get("log_text")
@@ -58,6 +82,152 @@ VirtualPath = namedtuple('VirtualPath', ('search_name', 'search_relpath',
                                          'search_basedir', 'search_instance'))
 
 
+class EffectiveUserLock(object):
+    """ Guard the effective user of the process, shared by all its
+    threads.
+
+    The file system accesses made with the process user run concurrently in
+    'shared' mode. The accesses made with the effective user of a sftp user
+    run alone in 'exclusive' mode, so that the other threads never access
+    the file system with the wrong user.
+
+    .. code-block:: python
+
+        lock = EffectiveUserLock()
+        with lock.shared():
+            os.stat(path)
+        lock.acquire_exclusive()
+        try:
+            os.seteuid(uid)
+            ...
+        finally:
+            os.seteuid(0)
+            lock.release_exclusive()
+    """
+    def __init__(self):
+        """ Initialize the EffectiveUserLock class.
+        """
+        self._condition = threading.Condition(threading.Lock())
+        self._nb_shared = 0
+        self._nb_waiting = 0
+        self._owner = None
+        self._depth = 0
+
+    @contextmanager
+    def shared(self):
+        """ Access the file system with the process user: wait for the
+        exclusive accesses, waiting or in progress, of the other threads. A
+        thread in exclusive mode keeps its effective user.
+        """
+        thread = threading.current_thread()
+        with self._condition:
+            owned = self._owner is thread
+            if not owned:
+                while self._owner is not None or self._nb_waiting > 0:
+                    self._condition.wait()
+                self._nb_shared += 1
+        try:
+            yield
+        finally:
+            if not owned:
+                with self._condition:
+                    self._nb_shared -= 1
+                    if self._nb_shared == 0:
+                        self._condition.notify_all()
+
+    def acquire_exclusive(self):
+        """ Wait for all the other accesses before switching the effective
+        user. The exclusive mode can be nested in the same thread.
+        """
+        thread = threading.current_thread()
+        with self._condition:
+            if self._owner is not thread:
+                self._nb_waiting += 1
+                while self._owner is not None or self._nb_shared > 0:
+                    self._condition.wait()
+                self._nb_waiting -= 1
+                self._owner = thread
+            self._depth += 1
+
+    def release_exclusive(self):
+        """ Release the exclusive mode once the process user is restored.
+        """
+        with self._condition:
+            self._depth -= 1
+            if self._depth == 0:
+                self._owner = None
+                self._condition.notify_all()
+
+
+# The effective user is shared by all the threads of the process
+EFFECTIVE_USER_LOCK = EffectiveUserLock()
+
+
+class SortedFiles(object):
+    """ The files of a CWSearch sorted once by path, so that the children of
+    a directory are found by binary search.
+
+    Listing a directory only visits its children: the subtree of each child
+    directory is skipped with a binary search too.
+
+    .. code-block:: python
+
+        files = SortedFiles([(u"/study/subdir1/fichier1", False)])
+        files.children(u"/study")  # [(u"/study/subdir1", False)]
+    """
+    def __init__(self, files):
+        """ Initialize the SortedFiles class.
+
+        Parameters
+        ----------
+        files: list of 2-uplet (mandatory)
+            a list of files formated in a 2-uplet of the form (path, is_virtual).
+        """
+        self.files = sorted(files)
+        self.paths = [path for path, is_virtual in self.files]
+
+    def children(self, dirpath):
+        """ Get the children of a directory.
+
+        Parameters
+        ----------
+        dirpath: str (mandatory)
+            the directory path.
+
+        Returns
+        -------
+        children: list of 2-uplet
+            the directory children sorted by path, each item of the form
+            (child path, is_virtual).
+        """
+        # The paths starting with 'prefix' are sorted before the ones starting
+        # with 'prefix' where the trailing separator is replaced by the next
+        # character
+        prefix = dirpath.rstrip(os.path.sep) + os.path.sep
+        index = bisect.bisect_left(self.paths, prefix)
+        end = bisect.bisect_left(self.paths, prefix[:-1] + "0", index)
+
+        children = []
+        seen = set()
+        while index < end:
+            path, is_virtual = self.files[index]
+            name = path[len(prefix):].split(os.path.sep, 1)[0]
+            if name == "":
+                index += 1
+                continue
+            child = prefix + name
+            if child not in seen:
+                seen.add(child)
+                children.append((child, is_virtual))
+            # Skip the child directory subtree
+            if len(path) > len(child):
+                index = bisect.bisect_left(
+                    self.paths, child + "0", index + 1, end)
+            else:
+                index += 1
+        return children
+
+
 class VirtualPathTranslator(object):
     """ Responsible to translate virtual path into real one.
 
@@ -73,6 +243,11 @@ class VirtualPathTranslator(object):
     file_perm = 0b1000000100100100
     dir_perm = 0b100001101101101
     file_entity_re = re.compile(r'(request_result)|.+_(\d+)$')
+    # The user CWSearch names are reloaded after 'search_index_ttl' seconds,
+    # or when an unknown name is requested and the names are older than
+    # 'search_index_min_age' seconds
+    search_index_ttl = 60
+    search_index_min_age = 2
 
     def __init__(self, search_request):
         """ Initialize the 'VirtualPathTranslator' class.
@@ -83,6 +258,51 @@ class VirtualPathTranslator(object):
             An in memory user CWSearch.
         """
         self.search_request = search_request
+        self.search_index_times = {}  # instance name -> loading time
+        self.instance_search_names = {}
+        self.all_cw_search_names = set()
+
+    def load_search_index(self, force=False, instance_name=None):
+        """ Load the user CWSearch names of an instance, or of each instance,
+        if they have expired.
+
+        The names are held in 'instance_search_names' (instance name ->
+        list of CWSearch names) and in the 'all_cw_search_names' set of the
+        loaded instances names.
+
+        Parameters
+        ----------
+        force: bool (optional, default False)
+            if True reload the names unless they are younger than
+            'search_index_min_age' seconds.
+        instance_name: str (optional, default None)
+            the instance of interest, None to load all the instances: the
+            instances are only requested on the first access to their tree.
+        """
+        now = time.time()
+        expired = []
+        for index, name in enumerate(self.INSTANCE_NAMES):
+            if instance_name is not None and name != instance_name:
+                continue
+            loading_time = self.search_index_times.get(name)
+            if loading_time is not None:
+                age = now - loading_time
+                if ((not force and age < self.search_index_ttl) or
+                        (force and age < self.search_index_min_age)):
+                    continue
+            expired.append((index, name))
+        if len(expired) == 0:
+            return
+        rsets = self.search_request.get_searches(
+            [index for index, name in expired])
+        for (index, name), rset in zip(expired, rsets):
+            self.instance_search_names[name.lstrip("/")] = [
+                r[0].encode("utf-8") for r in rset]
+            self.search_index_times[name] = now
+        all_cw_search_names = set()
+        for names in self.instance_search_names.itervalues():
+            all_cw_search_names.update(names)
+        self.all_cw_search_names = all_cw_search_names
 
     def list_directory(self, path):
         """ Method to list a virtual folder.
@@ -108,14 +328,6 @@ class VirtualPathTranslator(object):
             an iterator containing virtual folder description. Each iterator
             item is a 3-uplet of the form (basename, longname, stat).
         """
-        # Create/update an association between cw rset and db name
-        self.rset_map = dict((key.lstrip("/"), value) for key, value in zip(
-            self.INSTANCE_NAMES, self.search_request.get_searches()))
-        self.all_cw_search_names = []
-        for name, rset in self.rset_map.iteritems():
-            self.all_cw_search_names.extend(
-                [r[0].encode("utf-8") for r in rset])
-
         # Check we are dealing with a path
         assert path.startswith('/')
         # print "LIST::", path
@@ -136,11 +348,10 @@ class VirtualPathTranslator(object):
         # Construct search folders if root contains instances
         elif (self.INSTANCE_NAMES is not None and
               path.lstrip("/") in self.INSTANCE_NAMES):
-            # Get the proper rset
-            rset = self.rset_map[path.lstrip("/")]
-            cw_search_names = [r[0].encode("utf-8") for r in rset]
-            for name in cw_search_names:
-                s = self.stat('/%s' % name)
+            # Get the proper CWSearch names, reloaded only when expired
+            self.load_search_index(instance_name=path.lstrip("/"))
+            for name in self.instance_search_names[path.lstrip("/")]:
+                s = self.stat('%s/%s' % (path.rstrip("/"), name))
                 yield (name,
                        lsLine(name, s),
                        self.attrs_from_stat(s))
@@ -155,12 +366,11 @@ class VirtualPathTranslator(object):
                 if not rset_file:
                     s = self.stat(filepath, path_is_real=True)
                 else:
-                    # retrieve rset binary from database
-                    rset = self.search_request.get_file_data(
-                        file_eid=None, rset_file=True,
-                        search_name=virtpath.search_name,
-                        session_index=session_index)
-                    s = self.stat_file_entity(rset.len)
+                    # retrieve the rset size only: the rset binary is not
+                    # transfered
+                    s = self.stat_file_entity(
+                        self.search_request.get_rset_size(
+                            virtpath.search_name, session_index))
                 basename = osp.basename(filepath).encode('utf-8')
                 longname = lsLine(basename, s)
                 yield (basename, longname, self.attrs_from_stat(s))
@@ -257,22 +467,23 @@ class VirtualPathTranslator(object):
 
         Returns
         -------
-        out: bool
-            True if the virtualpath point to a cubicweb file,
-            False otherwise.
+        out: 2-uplet or None
+            None if the virtual path does not point to a cubicweb file,
+            otherwise a 2-uplet of the form (file eid, rset file) where
+            rset file is True for the CWSearch rset virtual file.
+
+        .. note::
+            the translator is shared by all the user connections: the match
+            is returned and not stored in the translator.
         """
         m = self.file_entity_re.search(virtpath.search_relpath)
         if m:
-            self.matched_entity_file_eid = None
-            self.matched_rset_file = False
             if m.group(1):
-                self.matched_rset_file = True
-            elif m.group(2):
-                self.matched_entity_file_eid = m.group(2)
-            return True
-        return False
+                return None, True
+            return m.group(2), False
+        return None
 
-    def open_cw_file(self, virtpath):
+    def open_cw_file(self, virtpath, file_entity, threadpool=None):
         """ Method used to open a virtual cubicweb file.
 
         Parameters
@@ -280,6 +491,11 @@ class VirtualPathTranslator(object):
         virtpath: VirtualPath  (mandatory)
             a virtual path of the form (search name, search relpath,
             search basedir, search instance).
+        file_entity: 2-uplet (mandatory)
+            the cubicweb file matched by 'is_file_entity'.
+        threadpool: twisted.python.threadpool.ThreadPool (optional)
+            the thread pool serving the file reads, None to read in the
+            reactor thread.
 
         Returns
         -------
@@ -287,13 +503,14 @@ class VirtualPathTranslator(object):
             a virtual file containing the Binary field data.
         """
         session_index = self.INSTANCE_NAMES.index(virtpath.search_instance)
+        file_eid, rset_file = file_entity
         data = self.search_request.get_file_data(
-            file_eid=self.matched_entity_file_eid,
-            rset_file=self.matched_rset_file,
+            file_eid=file_eid,
+            rset_file=rset_file,
             search_name=virtpath.search_name,
             session_index=session_index)
         attrs = self.get_attrs_file_entity(data)
-        return CubicwebFile(data, attrs)
+        return CubicwebFile(data, attrs, threadpool=threadpool)
 
     def stat(self, path, followlinks=0, path_is_real=False):
         """ Method to access a path state.
@@ -317,19 +534,18 @@ class VirtualPathTranslator(object):
         """
         if not path_is_real:
 
-            # Create the association between cw rset and db name
-            if not hasattr(self, "all_cw_search_names"):
-                self.rset_map = dict((key.lstrip("/"), value) for key, value in zip(
-                    self.INSTANCE_NAMES, self.search_request.get_searches()))
-                self.all_cw_search_names = []
-                for name, rset in self.rset_map.iteritems():
-                    self.all_cw_search_names.extend(
-                        [r[0].encode("utf-8") for r in rset])
-
+            # Get the user CWSearch names of the instance, reloaded only
+            # when expired or when an unknown name may be a new CWSearch:
+            # the instance names themselves do not need any request
             virtpath = self.split_virtual_path(path)
-            if (virtpath.search_name != '' and
-               virtpath.search_name not in (self.all_cw_search_names +
-                                            self.INSTANCE_NAMES)):
+            if (virtpath.search_instance is not None or
+                    not self.is_known_name(virtpath.search_name)):
+                self.load_search_index(
+                    instance_name=virtpath.search_instance)
+            if not self.is_known_name(virtpath.search_name):
+                self.load_search_index(
+                    force=True, instance_name=virtpath.search_instance)
+            if not self.is_known_name(virtpath.search_name):
                 # raise OSError like os.stat does
                 raise OSError('No such file or directory: "%s"' % path)
             if virtpath.search_relpath == '/' or virtpath.search_relpath == '':
@@ -348,16 +564,35 @@ class VirtualPathTranslator(object):
             real_path = self.real_path(virtpath)
         else:
             real_path = path
-        if followlinks:
-            s = os.stat(real_path)
-        else:
-            s = os.lstat(real_path)
+        # The stats use the process user: never run them while another thread
+        # uses the effective user of a sftp user
+        with EFFECTIVE_USER_LOCK.shared():
+            if followlinks:
+                s = os.stat(real_path)
+            else:
+                s = os.lstat(real_path)
         if stat.S_ISDIR(s.st_mode):
             mode = self.dir_perm
         elif stat.S_ISREG(s.st_mode):
             mode = self.file_perm
         return posix.stat_result((mode,) + s[1:])
 
+    def is_known_name(self, name):
+        """ Check if a name is an instance or a user CWSearch name.
+
+        Parameters
+        ----------
+        name: str (mandatory)
+            the first level name of a virtual path.
+
+        Returns
+        -------
+        out: bool
+            True if the name is empty, an instance name or a CWSearch name.
+        """
+        return (name == '' or name in self.all_cw_search_names or
+                name in self.INSTANCE_NAMES)
+
     def attrs_from_stat(self, s):
         """ Convert a 'posix.stat_result' to python dictionary.
 
@@ -401,10 +636,7 @@ class VirtualPathTranslator(object):
         #if virtpath.search_name == self.INSTANCE_NAME:
         #    return self.cw_search_names
 
-        files = self.search_request.get_files(virtpath, session_index)
-        if files is None:
-            return []
-        return self.filter_files(files, self.real_path(virtpath))
+        return self.search_request.get_dir_files(virtpath, session_index)
 
     def split_virtual_path(self, path):
         """ Extract the name of a Search Entity from path.
@@ -444,39 +676,67 @@ class VirtualPathTranslator(object):
 
         Parameters
         ----------
-        files: list of 2-uplet (mandatory)
+        files: list of 2-uplet or SortedFiles (mandatory)
             a list of files formated in a 2-uplet of the form (path, is_virtual).
+            Sort the files once with 'SortedFiles' to list several
+            directories.
         path: string (mandatory)
             the associated dir real path.
 
         Returns
         -------
         out: iterator
-            each item is 2-uplet of the form (file path, associated rset).
+            each item is 2-uplet of the form (file path, associated rset),
+            sorted by path.
         """
-        if not path.endswith(os.path.sep):
-            path += os.path.sep
-        res = set()
-        for f, rset_file in files:
-            if f.startswith(path):
-                filepath = path + f[len(path):].split('/', 1)[0]
-                if filepath not in res:
-                    yield filepath, rset_file
-                    res.add(filepath)
+        if not isinstance(files, SortedFiles):
+            files = SortedFiles(files)
+        return iter(files.children(path))
 
 
-class CubicWebConchUser(UnixConchUser):
-    """ Class to create a cubicweb user.
+class LazyList(object):
+    """ A read-only list whose items are computed on their first access.
     """
-    def __init__(self, unix_username, cw_session_ids, login, cw_instance_names,
-                 cw_repositories, base_dir):
-        """ Initialize the CubicWebConchUser class.
+    def __init__(self, loader, size):
+        """ Initialize the LazyList class.
+
+        Parameters
+        ----------
+        loader: callable (mandatory)
+            a function returning the item of an index.
+        size: int (mandatory)
+            the number of items.
+        """
+        self.loader = loader
+        self.size = size
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, index):
+        with self.lock:
+            if index not in self.items:
+                self.items[index] = self.loader(index)
+            return self.items[index]
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return (self[index] for index in range(self.size))
+
+
+class CubicWebUserState(object):
+    """ The cubicweb state of a user shared by all his sftp connections: the
+    cubicweb sessions, the user eids, the CWSearch names and trees.
+
+    The state lives as long as one of the user connections is opened.
+    """
+    def __init__(self, cw_session_ids, login, cw_instance_names,
+                 cw_repositories, base_dir, index_dir=None, pools=None):
+        """ Initialize the CubicWebUserState class.
 
         Parameters
         ----------
-        unix_username: str (mandatory)
-            the sftp server will read file system with the permission
-            associated to this user.
         cw_session_ids: list of str (mandatory)
             the cubicweb sessions identifiers.
         login: str (mandatory)
@@ -489,16 +749,20 @@ class CubicWebConchUser(UnixConchUser):
             base directory in which file are stored (it acts as
             mask, so every files outside this base_dir will be
             invisible).
+        index_dir: str (optional, default None)
+            the directory containing the persistent indexes of the CWSearch
+            files, None to load the files from the cubicweb instances.
+        pools: list of ConnectionPool (optional, default None)
+            the connection pools of the instances shared by all the users.
         """
-        # Inheritance
-        UnixConchUser.__init__(self, unix_username)
-
         # Class parameters
         self.login = login
+        self.pools = pools
+        self.nb_references = 0
 
         # create the session associated to each repository
+        self.cw_repositories = cw_repositories
         self.cw_sessions = []
-        self.cw_users = []
         self.instance_names = []
         for cnt, item in enumerate(
                 zip(cw_session_ids, cw_repositories, cw_instance_names)):
@@ -510,18 +774,16 @@ class CubicWebConchUser(UnixConchUser):
             session = repo._get_session(sessionid)
             self.cw_sessions.append(session)
 
-            # Get the user entity eid
-            with repo.internal_cnx() as cnx:
-                login_eid = cnx.execute(
-                    "Any X WHERE X is CWUser, X login '{0}'".format(login))
-            self.cw_users.append(login_eid[0][0])
-
             # Store the instance name: assume the name is unique
             self.instance_names.append(instance_name)
 
+        # Get the user entity eids on the first access to each instance
+        self.cw_users = LazyList(self._get_user_eid, len(self.cw_sessions))
+
         # Create a Search object that provides tools to filter the CWSearch
         # elements
-        search_filter = Search(self.cw_sessions, cwusers=self.cw_users)
+        search_filter = Search(self.cw_sessions, cwusers=self.cw_users,
+                               index_dir=index_dir, pools=pools)
 
         # Create an object to translate the paths contained in the CWSearch
         # elements
@@ -529,32 +791,105 @@ class CubicWebConchUser(UnixConchUser):
         self.path_translator.BASE_REAL_DIR = base_dir
         self.path_translator.INSTANCE_NAMES = self.instance_names
 
-    def logout(self):
+    def _get_user_eid(self, index):
+        """ Get the user entity eid in an instance.
+
+        Parameters
+        ----------
+        index: int (mandatory)
+            an index pointing to the instance of interest.
+
+        Returns
+        -------
+        eid: int
+            the CWUser entity eid.
+        """
+        factory = self.cw_repositories[index].internal_cnx
+        if self.pools is None:
+            cw_cnx = factory()
+        else:
+            cw_cnx = self.pools[index].connection(factory)
+        with cw_cnx as cnx:
+            login_eid = cnx.execute(
+                "Any X WHERE X is CWUser, X login %(login)s",
+                {"login": self.login})
+        return login_eid[0][0]
+
+    def close(self):
         """ Method to close all the user sessions.
         """
         for cwsession in self.cw_sessions:
             cwsession.close()
+
+
+class CubicWebConchUser(UnixConchUser):
+    """ Class to create a cubicweb user.
+    """
+    def __init__(self, unix_username, state, threadpool=None, files=None,
+                 hashes=None):
+        """ Initialize the CubicWebConchUser class.
+
+        Parameters
+        ----------
+        unix_username: str (mandatory)
+            the sftp server will read file system with the permission
+            associated to this user.
+        state: CubicWebUserState (mandatory)
+            the cubicweb state shared by the user connections.
+        threadpool: twisted.python.threadpool.ThreadPool (optional)
+            the thread pool running the blocking sftp requests, None to run
+            them in the reactor thread.
+        files: SharedFiles (optional, default None)
+            the real files opened by all the users, None to share the real
+            files of this user only.
+        hashes: FileHashes (optional, default None)
+            the cached hashes of the real files, None to cache the hashes
+            requested by this user only.
+        """
+        # Inheritance
+        UnixConchUser.__init__(self, unix_username)
+
+        # Class parameters
+        self.state = state
+        self.login = state.login
+        self.threadpool = threadpool
+        self.files = files or SharedFiles()
+        self.hashes = hashes or FileHashes()
+        self.cw_sessions = state.cw_sessions
+        self.path_translator = state.path_translator
+
+    def logout(self):
+        """ Method called when the user connection is closed.
+        """
         print "'{0}' logout!".format(self.login)
 
     def _runAsUser(self, f, *args, **kw):
         """ Method to logged-in a user.
+
+        The effective user is switched for the whole process: the other
+        threads wait for the end of the call to access the file system, so
+        that only short calls, ie. an 'os.open', must be run this way.
         """
         user_is_root = os.getuid() == 0  # for tests
-        if user_is_root:
-            euid = os.geteuid()
-            egid = os.getegid()
-            groups = os.getgroups()
-            uid, gid = self.getUserGroupId()
-            os.setegid(0)
-            os.seteuid(0)
-            os.setgroups(self.getOtherGroups())
-            os.setegid(gid)
-            os.seteuid(uid)
         try:
             f = iter(f)
         except TypeError:
             f = [(f, args, kw)]
+
+        # Take the lock first: the process user is always restored and the
+        # lock released, even if the user switch fails
+        if user_is_root:
+            EFFECTIVE_USER_LOCK.acquire_exclusive()
+        saved_ids = None
         try:
+            if user_is_root:
+                saved_ids = (os.geteuid(), os.getegid(), os.getgroups())
+                uid, gid = self.getUserGroupId()
+                os.setegid(0)
+                os.seteuid(0)
+                os.setgroups(self.getOtherGroups())
+                os.setegid(gid)
+                os.seteuid(uid)
             for i in f:
                 func = i[0]
                 args = len(i) > 1 and i[1] or ()
@@ -562,19 +897,33 @@ class CubicWebConchUser(UnixConchUser):
                 r = func(*args, **kw)
         finally:
             if user_is_root:
-                os.setegid(0)
-                os.seteuid(0)
-                os.setgroups(groups)
-                os.setegid(egid)
-                os.seteuid(euid)
+                try:
+                    if saved_ids is not None:
+                        euid, egid, groups = saved_ids
+                        os.setegid(0)
+                        os.seteuid(0)
+                        os.setgroups(groups)
+                        os.setegid(egid)
+                        os.seteuid(euid)
+                finally:
+                    EFFECTIVE_USER_LOCK.release_exclusive()
         return r
 
 
 class Search(object):
     """ Class to access all the file paths associated to a specific user
     CWSearch searches.
+
+    The files of a CWSearch are sorted once per session and reused during
+    'tree_ttl' seconds, as well as the size of the CWSearch rset and the
+    CWSearch eid.
+
+    The cubicweb connections are taken in the connection pools of the
+    instances when available: the pools are shared by all the users.
     """
-    def __init__(self, sessions, cwusers):
+    tree_ttl = 300
+
+    def __init__(self, sessions, cwusers, index_dir=None, pools=None):
         """ Initilaize the Search class.
 
         Parameters
@@ -583,9 +932,111 @@ class Search(object):
             a list of cubicweb sessions.
         cwusers: list of int (mandatory)
             a list of user eids.
+        index_dir: str (optional, default None)
+            the directory containing the persistent indexes of the CWSearch
+            files, None to load the files from the cubicweb instances.
+        pools: list of ConnectionPool (optional, default None)
+            the connection pools bounding the concurrent connections to each
+            instance, None to open the connections without limit.
         """
         self.cwsessions = sessions
         self.cwusers = cwusers
+        self.index_dir = index_dir
+        self.pools = pools
+        self.indexes = {}  # index file -> SearchIndex
+        self.trees = {}  # (session index, search name) -> (expiration, files)
+        self.rset_sizes = {}  # same keys as 'trees' -> (expiration, size)
+        self.search_eids = {}  # same keys as 'trees' -> (expiration, eid)
+
+    def connection(self, session_index):
+        """ Open a connection of the user session of an instance.
+
+        Parameters
+        ----------
+        session_index: int (mandatory)
+            an index pointing to the instance of interest.
+
+        Returns
+        -------
+        cnx: context manager
+            the cubicweb connection, taken in the instance connection pool
+            if any.
+        """
+        session = self.cwsessions[session_index]
+        if self.pools is None:
+            return session.new_cnx()
+        return self.pools[session_index].connection(session.new_cnx)
+
+    def get_dir_files(self, virtpath, session_index):
+        """ Return the files and directories located in a CWSearch
+        directory.
+
+        Parameters
+        ----------
+        virtpath: VirtualPath  (mandatory)
+            a virtual path of the form (search name, search relpath,
+            search basedir, search instance).
+        session_index: int (mandatory)
+            an index pointing to the instance of interest.
+
+        Returns
+        -------
+        filepaths: list of 2-uplet (mandatory)
+            the directory files formated in 2-uplets (path, is_virtual).
+        """
+        # Use the CWSearch persistent index if available: only the
+        # requested directory is loaded
+        if self.index_dir is not None:
+            index_file = get_index_file(
+                self.index_dir,
+                self.get_search_eid(virtpath.search_name, session_index))
+            with EFFECTIVE_USER_LOCK.shared():
+                is_indexed = osp.isfile(index_file)
+            if is_indexed:
+                return self.get_indexed_files(virtpath, index_file)
+
+        # Otherwise sort the CWSearch files once
+        key = (session_index, virtpath.search_name)
+        now = time.time()
+        if key not in self.trees or self.trees[key][0] < now:
+            self.trees[key] = (
+                now + self.tree_ttl,
+                SortedFiles(self.get_files(virtpath, session_index)))
+        dirpath = osp.join(virtpath.search_basedir, virtpath.search_relpath)
+        return self.trees[key][1].children(dirpath)
+
+    def get_search_eid(self, search_name, session_index):
+        """ Get the eid of a user CWSearch.
+
+        Parameters
+        ----------
+        search_name: string (mandatory)
+            the CWSearch name.
+        session_index: int (mandatory)
+            an index pointing to the instance of interest.
+
+        Returns
+        -------
+        eid: int
+            the CWSearch eid.
+        """
+        key = (session_index, search_name)
+        now = time.time()
+        if key not in self.search_eids or self.search_eids[key][0] < now:
+            # Get the user before the connection: it may need a connection
+            # of the same pool
+            cwuser = self.cwusers[session_index]
+            with self.connection(session_index) as cnx:
+                rset = cnx.execute('Any S WHERE S is CWSearch, '
+                                   'S title %(title)s, S owned_by %(cwuser)s',
+                                   {'title': search_name,
+                                    'cwuser': cwuser})
+            # The CWSearch may have been deleted since the names were loaded
+            if not rset:
+                raise OSError(errno.ENOENT, "No such CWSearch: '{0}'".format(
+                    search_name))
+            self.search_eids[key] = (now + self.tree_ttl, rset[0][0])
+        return self.search_eids[key][1]
 
     def get_files(self, virtpath, session_index):
         """ Return a list of file associated to CWSearch named 'search_name'
@@ -604,12 +1055,11 @@ class Search(object):
         filepaths: list of 2-uplet (mandatory)
             a list of files formated in a 2-uplet of the form (path, is_virtual).
         """
-        # Get the selected session and user
-        session = self.cwsessions[session_index]
+        # Get the selected user
         cwuser = self.cwusers[session_index]
 
         # Create the connection
-        with session.new_cnx() as cnx:
+        with self.connection(session_index) as cnx:
 
             # Get all the user CWSearch entities
             rset = cnx.execute('Any D WHERE S is CWSearch, S title %(title)s, '
@@ -633,24 +1083,101 @@ class Search(object):
 
         return filepaths
 
-    def get_searches(self):
+    def get_indexed_files(self, virtpath, index_file):
+        """ Return the files located in a CWSearch directory from the
+        CWSearch persistent index.
+
+        Parameters
+        ----------
+        virtpath: VirtualPath  (mandatory)
+            a virtual path of the form (search name, search relpath,
+            search basedir, search instance).
+        index_file: str (mandatory)
+            the CWSearch persistent index file.
+
+        Returns
+        -------
+        filepaths: list of 2-uplet (mandatory)
+            a list of files formated in a 2-uplet of the form (path, is_virtual).
+        """
+        if index_file not in self.indexes:
+            self.indexes[index_file] = SearchIndex(index_file)
+        index = self.indexes[index_file]
+
+        # The SQLite connection of each thread is opened, and the index
+        # read, with the process user
+        with EFFECTIVE_USER_LOCK.shared():
+            entries = index.listdir("/" + virtpath.search_relpath)
+        filepaths = []
+        for name, real_path in entries:
+            if real_path is None:
+                real_path = osp.join(virtpath.search_basedir,
+                                     virtpath.search_relpath, name)
+            filepaths.append((real_path, name.startswith("request_result")))
+        return filepaths
+
+    def get_searches(self, session_indexes=None):
         """ Method to get for each user the result set with the name of the
         associated CWSearch entities.
 
+        Parameters
+        ----------
+        session_indexes: list of int (optional, default None)
+            the indexes pointing to the instances of interest, None for all
+            the instances.
+
         Returns
         -------
         rsets: list of rset
             the search names related to each user.
         """
+        if session_indexes is None:
+            session_indexes = range(len(self.cwsessions))
         rsets = []
-        for cwsession, cwuser in zip(self.cwsessions, self.cwusers):
-            with cwsession.new_cnx() as cnx:
+        for session_index in session_indexes:
+            cwuser = self.cwusers[session_index]
+            with self.connection(session_index) as cnx:
                 rsets.append(
                     cnx.execute('Any SN WHERE X is CWSearch, X title SN, '
                                 'X owned_by %(cwuser)s ',
                                 {'cwuser': cwuser}))
         return rsets
 
+    def get_rset_size(self, search_name, session_index):
+        """ Get the size of the rset virtual file associated to a CWSearch.
+
+        Only the length of the rset Binary is requested: the rset data is
+        never loaded.
+
+        Parameters
+        ----------
+        search_name: string (mandatory)
+            the CWSearch name.
+        session_index: int (mandatory)
+            an index pointing to the instance of interest.
+
+        Returns
+        -------
+        size: int
+            the rset size in bytes.
+        """
+        key = (session_index, search_name)
+        now = time.time()
+        if key not in self.rset_sizes or self.rset_sizes[key][0] < now:
+            cwuser = self.cwusers[session_index]
+            with self.connection(session_index) as cnx:
+                rset = cnx.execute('Any LENGTH(D) WHERE F is File, '
+                                   'S is CWSearch, S title %(title)s, '
+                                   'S owned_by %(cwuser)s, S rset F, '
+                                   'F data D',
+                                   {'title': search_name,
+                                    'cwuser': cwuser})
+            size = 0
+            if rset:
+                size = rset[0][0] or 0
+            self.rset_sizes[key] = (now + self.tree_ttl, size)
+        return self.rset_sizes[key][1]
+
     def get_file_data(self, file_eid, rset_file, session_index,
                       search_name=None):
         """ Get the Binary data contain in an entity.
@@ -671,12 +1198,11 @@ class Search(object):
         out: Binary or None
             the desired Binary data object.
         """
-        # Get the selected session and user
-        session = self.cwsessions[session_index]
+        # Get the selected user
         cwuser = self.cwusers[session_index]
 
         if rset_file:
-            with session.new_cnx() as cnx:
+            with self.connection(session_index) as cnx:
                 rset = cnx.execute('Any D WHERE F is File, '
                                    'S is CWSearch, S title %(title)s, '
                                    'S owned_by %(cwuser)s, S rset F, '
@@ -684,7 +1210,7 @@ class Search(object):
                                    {'title': search_name,
                                     'cwuser': cwuser})
         else:
-            with session.new_cnx() as cnx:
+            with self.connection(session_index) as cnx:
                 rset = cnx.execute('Any D WHERE F is File, '
                                    'F eid %(eid)s, F data D',
                                    {'eid': file_eid})
@@ -694,19 +1220,34 @@ class Search(object):
 
 class CubicWebCredentialsChecker:
     """ Check user credentials on a cubicweb instance
+
+    The credentials of a connected user are cached during 'auth_cache_ttl'
+    seconds: the next connections of the user, ie. the parallel connections
+    of a download client, reuse his cubicweb sessions.
     """
     credentialInterfaces = IUsernamePassword,
     implements(ICredentialsChecker)
+    auth_cache_ttl = 60
 
-    def __init__(self, cw_repositories):
+    def __init__(self, cw_repositories, user_states=None, threadpool=None):
         """ Initialize the 'CubicWebCredentialsChecker' class.
 
         Parameters
         ----------
         cw_repositories: cubicweb.server.repository.Repository (mandatory)
             internal cubicweb connections.
+        user_states: dict (optional, default None)
+            the cubicweb state of each connected user login, shared with the
+            realm.
+        threadpool: twisted.python.threadpool.ThreadPool (optional)
+            the thread pool connecting the repositories in parallel, None to
+            connect them in the reactor thread.
         """
         self.cw_repositories = cw_repositories
+        self.threadpool = threadpool
+        self.user_states = user_states if user_states is not None else {}
+        self.auth_cache = {}  # login -> (expiration, password digest)
+        self.salt = os.urandom(16)
 
     def requestAvatarId(self, credentials):
         """ Get the avatar id.
@@ -725,17 +1266,55 @@ class CubicWebCredentialsChecker:
             (provided as checkers.ANONYMOUS) or fire a
             Failure(UnauthorizedLogin). Alternatively, return the result itself.
         """
-        try:
-            session_ids = []
-            for repo in self.cw_repositories:
-                session_ids.append(repo.connect(credentials.username,
-                                                password=credentials.password))
-        except:
-            logging.exception("Failed to get connection for user {0}".format(
-                credentials.username))
-            return defer.fail(UnauthorizedLogin("Invalid user/password"))
-        else:
-            return defer.succeed((credentials.username, session_ids))
+        # Reuse the sessions of a connected user if his credentials are
+        # cached
+        digest = hashlib.sha256(self.salt + credentials.password).digest()
+        cached = self.auth_cache.get(credentials.username)
+        if (credentials.username in self.user_states and cached is not None
+                and cached[0] > time.time() and cached[1] == digest):
+            return defer.succeed((credentials.username, None))
+
+        # Connect all the repositories in parallel
+        connections = defer.DeferredList([
+            defer.maybeDeferred(
+                defer_to_pool, self.threadpool, repo.connect,
+                credentials.username, password=credentials.password)
+            for repo in self.cw_repositories], consumeErrors=True)
+        return connections.addCallback(self._connected, credentials, digest)
+
+    def _connected(self, results, credentials, digest):
+        """ Check all the repositories have been connected.
+
+        Parameters
+        ----------
+        results: list of 2-uplet (mandatory)
+            the (success, session id or failure) result of each repository
+            connection.
+        credentials: (mandatory)
+            the user credentials.
+        digest: str (mandatory)
+            the salted digest of the user password.
+
+        Returns
+        -------
+        out: 2-uplet
+            the user login and the cubicweb sessions identifiers.
+        """
+        if not all(success for success, result in results):
+            for success, result in results:
+                if not success:
+                    logging.error(
+                        "Failed to get connection for user {0}: {1}".format(
+                            credentials.username, result.getErrorMessage()))
+            # Do not leave the opened sessions behind
+            for (success, result), repo in zip(results, self.cw_repositories):
+                if success:
+                    repo._get_session(result).close()
+            self.auth_cache.pop(credentials.username, None)
+            raise UnauthorizedLogin("Invalid user/password")
+        self.auth_cache[credentials.username] = (
+            time.time() + self.auth_cache_ttl, digest)
+        return credentials.username, [result for success, result in results]
 
 
 class CubicWebSFTPRealm:
@@ -747,7 +1326,8 @@ class CubicWebSFTPRealm:
     """
     implements(IRealm)
 
-    def __init__(self, cw_instance_names, cw_repositories, conf):
+    def __init__(self, cw_instance_names, cw_repositories, conf,
+                 threadpool=None, files=None, pools=None, hashes=None):
         """ Initilaize the 'CubicWebSFTPRealm' class.
 
         Parameters
@@ -758,10 +1338,23 @@ class CubicWebSFTPRealm:
             the internal cubicweb connections.
         conf: logilab.common.configuration.Configuration (mandatory)
             the server configuration options.
+        threadpool: twisted.python.threadpool.ThreadPool (optional)
+            the thread pool running the blocking sftp requests.
+        files: SharedFiles (optional)
+            the real files opened by all the users.
+        pools: list of ConnectionPool (optional)
+            the connection pools of the instances shared by all the users.
+        hashes: FileHashes (optional)
+            the cached hashes of the real files requested by all the users.
         """
         self.conf = conf
         self.cw_instance_names = cw_instance_names
         self.cw_repositories = cw_repositories
+        self.threadpool = threadpool
+        self.files = files
+        self.pools = pools
+        self.hashes = hashes
+        self.user_states = {}  # login -> CubicWebUserState
 
     def requestAvatar(self, identity, mind, *interfaces):
         """ This method will typically be called from 'Portal.login'.
@@ -779,15 +1372,47 @@ class CubicWebSFTPRealm:
             a 3-uplet of the form (interface, avatarAspect, logout).
         """
         #print "INNNN::", identity, self.cw_repositories
-        cw_session_ids = identity[1]
+        login, cw_session_ids = identity
+
+        # Share the cubicweb state of the user connections: the sessions
+        # opened for an already connected user are not needed
+        state = self.user_states.get(login)
+        if state is None:
+            state = CubicWebUserState(
+                cw_session_ids=cw_session_ids,
+                login=login,
+                cw_instance_names=self.cw_instance_names,
+                cw_repositories=self.cw_repositories,
+                base_dir=self.conf.get('base-dir'),
+                index_dir=self.conf.get('index-dir') or None,
+                pools=self.pools)
+            self.user_states[login] = state
+        elif cw_session_ids is not None:
+            for sessionid, repo in zip(cw_session_ids, self.cw_repositories):
+                repo._get_session(sessionid).close()
+        state.nb_references += 1
+
         unix_username = self.conf.get('unix-username')
-        user = CubicWebConchUser(unix_username,
-                                 cw_session_ids=cw_session_ids,
-                                 login=identity[0],
-                                 cw_instance_names=self.cw_instance_names,
-                                 cw_repositories=self.cw_repositories,
-                                 base_dir=self.conf.get('base-dir'))
-        return interfaces[0], user, user.logout
+        user = CubicWebConchUser(unix_username, state,
+                                 threadpool=self.threadpool,
+                                 files=self.files, hashes=self.hashes)
+        return interfaces[0], user, lambda: self.logout(user)
+
+    def logout(self, user):
+        """ Close a user connection: the user cubicweb sessions are closed
+        with his last connection.
+
+        Parameters
+        ----------
+        user: CubicWebConchUser (mandatory)
+            the avatar of the closed connection.
+        """
+        user.logout()
+        state = user.state
+        state.nb_references -= 1
+        if state.nb_references == 0:
+            del self.user_states[state.login]
+            state.close()
 
 
 class CubicWebSSHdFactory(factory.SSHFactory):
@@ -803,21 +1428,77 @@ class CubicWebSSHdFactory(factory.SSHFactory):
         """
         self._init_keys(conf)
 
-        # Deal with multiple instances
+        # Deal with multiple instances: build the repositories concurrently
         cw_instance_names = conf.get("cubicweb-instance").split(":")
-        cw_repositories = []
-        for instance_name in cw_instance_names:
-            config = cwconfig.instance_configuration(cw_instance_names[0])
-            cw_repositories.append(
-                Repository(config, TasksManager(), vreg=None))
+        workers = multiprocessing.pool.ThreadPool(len(cw_instance_names))
+        try:
+            cw_repositories = workers.map(self._build_repository,
+                                          cw_instance_names)
+        finally:
+            workers.close()
+
+        # Run the blocking cubicweb requests and file system accesses in a
+        # bounded thread pool: a slow request never stalls the reactor
+        self.threadpool = ThreadPool(
+            minthreads=1, maxthreads=conf.get("nb-threads"), name="sftp")
+        self.threadpool.start()
+        reactor.addSystemEventTrigger(
+            "during", "shutdown", self.threadpool.stop)
+
+        # Share the real files opened by all the users and prefetch the
+        # files read sequentially
+        read_ahead = None
+        if conf.get("read-ahead") > 0:
+            read_ahead = ReadAheadCache(
+                window_size=conf.get("read-ahead") * 1024 ** 2,
+                max_memory=conf.get("read-ahead-memory") * 1024 ** 2)
+        self.files = SharedFiles(read_ahead)
+        self.hashes = FileHashes()
+
+        # Bound the cubicweb connections opened concurrently by all the users
+        # on each instance and report the pools usage periodically
+        self.pools = [
+            ConnectionPool(None, conf.get("cw-pool-size"),
+                           timeout=conf.get("cw-pool-timeout") or None,
+                           name=instance_name)
+            for instance_name in cw_instance_names]
+        if conf.get("cw-pool-report") > 0:
+            self.pools_report = task.LoopingCall(self.report_pools)
+            self.pools_report.start(conf.get("cw-pool-report"), now=False)
 
         # A Portal associates one Realm with a collection of CredentialChecker
         # instances.
-        portal = Portal(
-            CubicWebSFTPRealm(cw_instance_names, cw_repositories, conf))
-        portal.registerChecker(CubicWebCredentialsChecker(cw_repositories))
+        realm = CubicWebSFTPRealm(cw_instance_names, cw_repositories, conf,
+                                  threadpool=self.threadpool, files=self.files,
+                                  pools=self.pools, hashes=self.hashes)
+        portal = Portal(realm)
+        portal.registerChecker(CubicWebCredentialsChecker(
+            cw_repositories, user_states=realm.user_states,
+            threadpool=self.threadpool))
         self.portal = portal
 
+    def report_pools(self):
+        """ Print the metrics of the instances connection pools.
+        """
+        for pool in self.pools:
+            print pool.report()
+
+    def _build_repository(self, instance_name):
+        """ Build the repository of a cubicweb instance.
+
+        Parameters
+        ----------
+        instance_name: str (mandatory)
+            the cubicweb instance name.
+
+        Returns
+        -------
+        repo: cubicweb.server.repository.Repository
+            the instance repository.
+        """
+        config = cwconfig.instance_configuration(instance_name)
+        return Repository(config, TasksManager(), vreg=None)
+
     def _init_keys(self, config):
         """ Method to set the public and private keys (as generated by
         ssh-keygen).
@@ -849,10 +1530,51 @@ def unauthorized(func):
     return _unauthorized
 
 
+def defer_to_pool(threadpool, func, *args, **kwargs):
+    """ Run a blocking function in a thread pool.
+
+    Parameters
+    ----------
+    threadpool: twisted.python.threadpool.ThreadPool (mandatory)
+        the thread pool, None to call the function directly.
+    func: callable (mandatory)
+        the function to call with the remaining arguments.
+
+    Returns
+    -------
+    out: object
+        a Deferred that is called back with the function result, or the
+        function result itself if no thread pool is given.
+    """
+    if threadpool is None:
+        return func(*args, **kwargs)
+    return threads.deferToThreadPool(reactor, threadpool, func, *args,
+                                     **kwargs)
+
+
 class CubicWebProxiedSFTPServer(SFTPServerForUnixConchUser):
     """ Implements the authorized actions on the sftp server.
+
+    The requests that access the cubicweb instances or the file system are
+    run in the avatar thread pool and return Deferreds.
+
+    Two read-only extended requests are supported:
+
+    * 'check-file-name': the hashes of a range of a file, as defined in the
+      sftp extensions draft (string filename, string hash algorithms,
+      uint64 start offset, uint64 length, uint32 block size). The reply is
+      the 'check-file' string, the hash algorithm string and the hashes.
+      The block size is 0 or at least 'min_hash_block_size' bytes, and at
+      most 'max_hash_blocks' blocks are hashed at once.
+    * 'stat-many@rql_download': the attributes of several paths, sent as a
+      string containing a json list of paths. The reply is a string
+      containing a json list of attributes dictionaries, null for the
+      missing paths.
     """
     implements(ISFTPServer)
+    max_stat_paths = 1024
+    min_hash_block_size = 256
+    max_hash_blocks = 4096
 
     def openFile(self, filename, flags, attrs):
         """ Called when the clients asks to open a file.
@@ -890,11 +1612,21 @@ class CubicWebProxiedSFTPServer(SFTPServerForUnixConchUser):
             an object that meets the ISFTPFile interface. Alternatively,
             it can return a L{Deferred} that will be called back with the object.
         """
+        return defer_to_pool(self.avatar.threadpool, self._open_file,
+                             filename, flags, attrs)
+
+    def _open_file(self, filename, flags, attrs):
+        """ Open a file: see 'openFile'.
+        """
         t = self.avatar.path_translator
         virtpath = t.split_virtual_path(filename)
-        if t.is_file_entity(virtpath):
-            return t.open_cw_file(virtpath)
+        file_entity = t.is_file_entity(virtpath)
+        if file_entity:
+            return t.open_cw_file(virtpath, file_entity,
+                                  self.avatar.threadpool)
         filepath = t.real_path(virtpath)
+        if flags & FXF_READ and not flags & FXF_WRITE:
+            return RealFile(self, filepath)
         return SFTPServerForUnixConchUser.openFile(self, filepath, flags,
                                                    attrs)
 
@@ -1003,7 +1735,14 @@ class CubicWebProxiedSFTPServer(SFTPServerForUnixConchUser):
         path: str  (mandatory)
             the directory to open.
         """
-        return self.avatar.path_translator.list_directory(path)
+        return defer_to_pool(self.avatar.threadpool, self._open_directory,
+                             path)
+
+    def _open_directory(self, path):
+        """ List a directory at once: see 'openDirectory'.
+        """
+        return DirectoryListing(
+            list(self.avatar.path_translator.list_directory(path)))
 
     def getAttrs(self, path, followLinks):
         """ Return the attributes for the given path.
@@ -1026,7 +1765,9 @@ class CubicWebProxiedSFTPServer(SFTPServerForUnixConchUser):
             If it is False, return attributes for the specified path.
         """
         # path parameter comes from realPath method
-        return self.avatar.path_translator.get_attrs(path, followLinks)
+        return defer_to_pool(self.avatar.threadpool,
+                             self.avatar.path_translator.get_attrs, path,
+                             followLinks)
 
     @unauthorized
     def setAttrs(self, path, attrs):
@@ -1100,7 +1841,6 @@ class CubicWebProxiedSFTPServer(SFTPServerForUnixConchUser):
             return '/'
         return osp.abspath(path)  # handle /toto/..
 
-    @unauthorized
     def extendedRequest(self, extendedName, extendedData):
         """ This is the extension mechanism for SFTP.  The other side can send
         us arbitrary requests.
@@ -1111,10 +1851,6 @@ class CubicWebProxiedSFTPServer(SFTPServerForUnixConchUser):
         The return value is a string, or a Deferred that will be called
         back with a string.
 
-        .. warning::
-
-            Unauthorized method.
-
         Parameters
         ----------
         extendedName: str  (mandatory)
@@ -1122,6 +1858,178 @@ class CubicWebProxiedSFTPServer(SFTPServerForUnixConchUser):
         extendedData: str  (mandatory)
             the data the other side sent with the request
         """
+        if extendedName == "check-file-name":
+            return defer_to_pool(self.avatar.threadpool, self._check_file,
+                                 extendedData)
+        if extendedName == "stat-many@rql_download":
+            return defer_to_pool(self.avatar.threadpool, self._stat_many,
+                                 extendedData)
+        logging.warning('user %s sent the unsupported extended request %s',
+                        self.avatar, extendedName)
+        raise NotImplementedError(
+            "extended request {0} is not supported".format(extendedName))
+
+    def _check_file(self, data):
+        """ Hash a range of a file: see 'extendedRequest'.
+        """
+        # Unpack the request
+        filename, data = getNS(data)
+        algorithms, data = getNS(data)
+        start, length, block_size = struct.unpack("!QQL", data)
+        algorithm = None
+        for name in algorithms.split(","):
+            if name in FileHashes.algorithms:
+                algorithm = name
+                break
+        if algorithm is None:
+            raise NotImplementedError(
+                "no supported hash algorithm in {0}".format(algorithms))
+        if 0 < block_size < self.min_hash_block_size:
+            raise ValueError("the hash block size must be 0 or at least "
+                             "{0} bytes".format(self.min_hash_block_size))
+
+        # Hash a virtual cubicweb file in memory
+        t = self.avatar.path_translator
+        virtpath = t.split_virtual_path(filename)
+        file_entity = t.is_file_entity(virtpath)
+        if file_entity:
+            cw_file = t.open_cw_file(virtpath, file_entity)
+            try:
+                content = cw_file.binary.getvalue()
+            finally:
+                cw_file.close()
+            hashes = hash_range(
+                lambda size, offset: content[offset: offset + size],
+                len(content), algorithm, start, length, block_size,
+                self.max_hash_blocks)
+            return NS("check-file") + NS(algorithm) + hashes
+
+        # Hash a real file opened with the user permissions
+        filepath = t.real_path(virtpath)
+        files = self.avatar.files
+        handle = files.open(filepath, os.O_RDONLY, opener=functools.partial(
+            self.avatar._runAsUser, os.open))
+        try:
+            hashes = self.avatar.hashes.hash(
+                filepath, files.fileno(handle), algorithm, start, length,
+                block_size, self.max_hash_blocks)
+        finally:
+            files.release(handle)
+        return NS("check-file") + NS(algorithm) + hashes
+
+    def _stat_many(self, data):
+        """ Get the attributes of several paths: see 'extendedRequest'.
+        """
+        paths = json.loads(getNS(data)[0])
+        if len(paths) > self.max_stat_paths:
+            raise IOError(
+                "at most {0} paths can be stated at once".format(
+                    self.max_stat_paths))
+        # A path that cannot be stated, ie. a relative path, does not fail
+        # the whole request
+        attrs = []
+        for path in paths:
+            try:
+                attrs.append(self.avatar.path_translator.get_attrs(
+                    path.encode("utf-8"), True))
+            except (AssertionError, IOError, OSError):
+                attrs.append(None)
+        return NS(json.dumps(attrs))
+
+
+class DirectoryListing(object):
+    """ The items of a listed directory, as expected by 'openDirectory'.
+    """
+    def __init__(self, items):
+        self.items = iter(items)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self.items.next()
+
+    def close(self):
+        """ Called when the client is finished reading the directory.
+        """
+        self.items = iter([])
+
+
+class RealFile:
+    """ A real file opened for reading.
+
+    The reads are positional reads run in the avatar thread pool, so that
+    the pipelined requests of a client are served concurrently, and served
+    from the read-ahead buffers of the shared files when the file is read
+    sequentially.
+    """
+    implements(ISFTPFile)
+
+    def __init__(self, server, filename):
+        """ Initialize the RealFile class.
+
+        Parameters
+        ----------
+        server: CubicWebProxiedSFTPServer (mandatory)
+            the sftp server of the user.
+        filename: str (mandatory)
+            the real file path.
+        """
+        self.server = server
+        self.avatar = server.avatar
+        self.files = self.avatar.files
+        # The permissions are checked once when the file is opened: only the
+        # open system call runs with the user permissions
+        self.handle = self.files.open(
+            filename, os.O_RDONLY,
+            opener=functools.partial(self.avatar._runAsUser, os.open))
+
+    def close(self):
+        """ Close the file.
+        """
+        return defer_to_pool(self.avatar.threadpool, self.files.release,
+                             self.handle)
+
+    def readChunk(self, offset, length):
+        """ Read from the file: see 'CubicwebFile.readChunk'.
+        """
+        return defer_to_pool(self.avatar.threadpool, self._read, offset,
+                             length)
+
+    def _read(self, offset, length):
+        """ Read from the file: the read-ahead buffers are sliced and must
+        be copied in the sftp packets.
+        """
+        return str(self.files.read(self.handle, length, offset))
+
+    @unauthorized
+    def writeChunk(self, offset, data):
+        """ Write to the file.
+
+        .. warning::
+
+            Unauthorized method.
+        """
+
+    def getAttrs(self):
+        """ Return the attributes for the file.
+        """
+        return defer_to_pool(self.avatar.threadpool, self._get_attrs)
+
+    def _get_attrs(self):
+        """ Return the attributes for the file: see 'getAttrs'.
+        """
+        return self.server._getAttrs(os.fstat(
+            self.files.fileno(self.handle)))
+
+    @unauthorized
+    def setAttrs(self, attrs):
+        """ Set the attributes for the file.
+
+        .. warning::
+
+            Unauthorized method.
+        """
 
 
 class CubicwebFile:
@@ -1129,9 +2037,11 @@ class CubicwebFile:
     """
     implements(ISFTPFile)
 
-    def __init__(self, cw_binary, attrs):
+    def __init__(self, cw_binary, attrs, threadpool=None):
         self.binary = cw_binary
         self.attrs = attrs
+        self.threadpool = threadpool
+        self.lock = threading.Lock()
 
     def close(self):
         """ Close the file.
@@ -1163,8 +2073,14 @@ class CubicwebFile:
         data: object
             the requested chunk of data.
         """
-        self.binary.seek(offset)
-        return self.binary.read(length)
+        return defer_to_pool(self.threadpool, self._read, offset, length)
+
+    def _read(self, offset, length):
+        """ Read from the file: see 'readChunk'.
+        """
+        with self.lock:
+            self.binary.seek(offset)
+            return self.binary.read(length)
 
     @unauthorized
     def writeChunk(self, offset, data):
@@ -7,9 +7,15 @@
 # for details.
 ##########################################################################
 
+# System import
+import os.path as osp
+
 # Cubicweb import
 from cubicweb import Binary
 
+# Rql Download import
+from cubes.rql_download.twistedserver.server import SortedFiles
+
 
 class Search(object):
     """ A class that emulate a CWSearch entity.
@@ -36,12 +42,77 @@ class Search(object):
         return map(lambda x: (x, False),
                    self.searchs.get(virtpath.search_name))
 
-    def get_searches(self):
+    def get_dir_files(self, virtpath, session_index):
+        files = SortedFiles(self.get_files(virtpath, session_index))
+        dirpath = osp.join(virtpath.search_basedir, virtpath.search_relpath)
+        return files.children(dirpath)
+
+    def get_searches(self, session_indexes=None):
         return [[
             (u"search1",),
             (u"search2",)
         ]]
 
+    def get_rset_size(self, search_name, session_index):
+        return len("nothing in None")
+
     def get_file_data(self, file_eid, rset_file, session_index,
                       search_name=None):
         return Binary("nothing in %s" % file_eid)
+
+
+class Session(object):
+    """ A class that emulate a cubicweb session.
+    """
+    def __init__(self):
+        self.closed = False
+
+    def new_cnx(self):
+        return Connection()
+
+    def close(self):
+        self.closed = True
+
+
+class Connection(object):
+    """ A class that emulate a cubicweb connection.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def execute(self, rql, args=None):
+        if "CWUser" in rql:
+            return [[1]]
+        return [(u"search1",), (u"search2",)]
+
+
+class EmptyConnection(Connection):
+    """ A class that emulate a cubicweb connection without any entity.
+    """
+    def execute(self, rql, args=None):
+        return []
+
+
+class Repository(object):
+    """ A class that emulate a cubicweb repository.
+    """
+    def __init__(self):
+        self.sessions = {}
+        self.nb_internal_cnx = 0
+
+    def connect(self, login, password):
+        if password != "secret":
+            raise Exception("Invalid password")
+        sessionid = len(self.sessions)
+        self.sessions[sessionid] = Session()
+        return sessionid
+
+    def _get_session(self, sessionid):
+        return self.sessions[sessionid]
+
+    def internal_cnx(self):
+        self.nb_internal_cnx += 1
+        return Connection()
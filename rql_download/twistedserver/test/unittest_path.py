@@ -11,15 +11,43 @@
 
 # System import
 from __future__ import with_statement
+import os
+import json
+import errno
+import shutil
+import struct
+import hashlib
 import unittest
+import tempfile
+import threading
 from collections import namedtuple
 
+# Twisted import
+from twisted.conch.ssh.common import NS, getNS
+
 # Cubicweb import
 from cubes.rql_download.twistedserver.server import VirtualPathTranslator
 from cubes.rql_download.twistedserver.server import VirtualPath
+from cubes.rql_download.twistedserver.server import SortedFiles
+from cubes.rql_download.twistedserver.server import CubicWebProxiedSFTPServer
+from cubes.rql_download.twistedserver.server import RealFile
+from cubes.rql_download.twistedserver.server import CubicWebSFTPRealm
+from cubes.rql_download.twistedserver.server import CubicWebCredentialsChecker
+from cubes.rql_download.twistedserver.server import CubicWebUserState
+from cubes.rql_download.twistedserver.server import EffectiveUserLock
+from cubes.rql_download.twistedserver.server import EFFECTIVE_USER_LOCK
+from cubes.rql_download.twistedserver.server import CubicWebConchUser
+from cubes.rql_download.twistedserver.server import Search as ServerSearch
+from cubes.rql_download.index import SearchIndex
+from cubes.rql_download.index import get_index_file
+from cubes.rql_download.fileio import FileHashes
+from cubes.rql_download.fileio import SharedFiles
+from cubes.rql_download.pool import ConnectionPool
 
 # Rql Download import
 from testlib import Search
+from testlib import Repository
+from testlib import EmptyConnection
 
 
 FakeStat = namedtuple("FakeStat", ("st_mode", "st_ino", "st_dev", "st_nlink",
@@ -110,6 +138,319 @@ class TestTwistedSFTPServer(unittest.TestCase):
             "/{0}/search1/tmp/study".format(self.search.instance))]
         self.assertEqual(result, expected)
 
+    def test_list_rset(self):
+        """ Test that the rset data is not loaded to list a directory.
+        """
+        get_files = self.search.get_files
+        self.search.get_files = lambda virtpath, session_index: (
+            get_files(virtpath, session_index) +
+            [("/request_result.json", True)])
+        self.search.get_file_data = None
+        path = "/{0}/search1".format(self.search.instance)
+        result = dict((r[0], r[2])
+                      for r in self.path_translator.list_directory(path))
+        self.assertEqual(result["request_result.json"]["size"],
+                         self.search.get_rset_size("search1", 0))
+
+    def test_open_directory(self):
+        """ Test the sftp server listing without thread pool.
+        """
+        import os
+        stat_f = lambda x: FakeStat(33188, 16398844, 65024L, 1, 1049, 1049, 0,
+                                    1409046988, 1409046988, 1409046988)
+        os.stat = stat_f
+        os.lstat = stat_f
+        avatar = namedtuple("Avatar", ("path_translator", "threadpool"))(
+            self.path_translator, None)
+        server = CubicWebProxiedSFTPServer(avatar)
+        listing = server.openDirectory(
+            "/{0}/search1/tmp/study".format(self.search.instance))
+        self.assertEqual([r[0] for r in listing], ["subdir1", "subdir2"])
+        listing.close()
+        self.assertEqual(list(listing), [])
+
+    def test_open_real_file(self):
+        """ Test the positional reads of a real file.
+        """
+        fd, path = tempfile.mkstemp()
+        os.write(fd, "real file content")
+        os.close(fd)
+        avatar = type("Avatar", (object, ), {
+            "path_translator": self.path_translator, "threadpool": None,
+            "files": SharedFiles(),
+            "_runAsUser": lambda self, func, *args: func(*args)})()
+        try:
+            real_file = RealFile(CubicWebProxiedSFTPServer(avatar), path)
+            self.assertEqual(real_file.readChunk(5, 4), "file")
+            self.assertEqual(real_file.readChunk(17, 4), "")
+            real_file.close()
+            self.assertEqual(avatar.files.files, {})
+        finally:
+            os.remove(path)
+
+    def test_extended_requests(self):
+        """ Test the checksum and bulk stat extended requests.
+        """
+        content = "real file content" * 40
+        fd, path = tempfile.mkstemp(suffix=".txt")
+        os.write(fd, content)
+        os.close(fd)
+        avatar = type("Avatar", (object, ), {
+            "path_translator": self.path_translator, "threadpool": None,
+            "files": SharedFiles(), "hashes": FileHashes(),
+            "_runAsUser": lambda self, func, *args: func(*args)})()
+        server = CubicWebProxiedSFTPServer(avatar)
+        self.search.searchs["search1"].append(path)
+        virtual_path = "/{0}/search1{1}".format(self.search.instance, path)
+        try:
+            # Hash a range of a real file at once, then block by block
+            data = (NS(virtual_path) + NS("sha999,md5") +
+                    struct.pack("!QQL", 5, 4, 0))
+            self.assertEqual(
+                server.extendedRequest("check-file-name", data),
+                NS("check-file") + NS("md5") + hashlib.md5("file").digest())
+            data = (NS(virtual_path) + NS("sha1") +
+                    struct.pack("!QQL", 0, 0, 256))
+            self.assertEqual(
+                server.extendedRequest("check-file-name", data),
+                NS("check-file") + NS("sha1") + "".join(
+                    hashlib.sha1(content[start: start + 256]).digest()
+                    for start in (0, 256, 512)))
+            self.assertEqual(len(avatar.hashes.hashes), 2)
+
+            # Reject the small blocks and the replies with too many blocks
+            data = (NS(virtual_path) + NS("md5") +
+                    struct.pack("!QQL", 0, 0, 16))
+            self.assertRaises(ValueError, server.extendedRequest,
+                              "check-file-name", data)
+            data = (NS(virtual_path) + NS("md5") +
+                    struct.pack("!QQL", 0, 0, 256))
+            self.assertEqual(len(server.extendedRequest(
+                "check-file-name", data)), 4 + 10 + 4 + 3 + 3 * 16)
+            server.max_hash_blocks = 2
+            data = (NS(virtual_path) + NS("md5") +
+                    struct.pack("!QQL", 0, 700, 256))
+            self.assertRaises(ValueError, server.extendedRequest,
+                              "check-file-name", data)
+            del server.max_hash_blocks
+            self.assertEqual(avatar.files.files, {})
+
+            # Hash a virtual cubicweb file
+            data = (NS("/test/search1/request_result.json") + NS("md5") +
+                    struct.pack("!QQL", 0, 0, 0))
+            self.assertEqual(
+                server.extendedRequest("check-file-name", data),
+                NS("check-file") + NS("md5") +
+                hashlib.md5("nothing in None").digest())
+
+            # Stat several paths at once
+            data = NS(json.dumps([virtual_path, "/toto", "toto"]))
+            attrs = json.loads(getNS(server.extendedRequest(
+                "stat-many@rql_download", data))[0])
+            self.assertEqual(
+                attrs[0], self.path_translator.get_attrs(virtual_path, True))
+            self.assertEqual(attrs[1:], [None, None])
+            self.assertRaises(NotImplementedError, server.extendedRequest,
+                              "posix-rename@openssh.com", "")
+        finally:
+            os.remove(path)
+
+    def test_single_connection_pool(self):
+        """ Test that the lazy user eid never waits for the connection pool
+        slot held by its caller.
+        """
+        repo = Repository()
+        pool = ConnectionPool(None, 1, timeout=0.5, name="test")
+        index_dir = tempfile.mkdtemp()
+        try:
+            SearchIndex.build(get_index_file(index_dir, u"search1"),
+                              [u"/tmp/study/fichier1"], u"/tmp")
+            state = CubicWebUserState(
+                [repo.connect("user", "secret")], "user", ["test"], [repo],
+                "/", index_dir=index_dir, pools=[pool])
+            search = state.path_translator.search_request
+            virtpath = VirtualPath("search1", "study", "/tmp", "test")
+            self.assertEqual(search.get_dir_files(virtpath, 0),
+                             [(u"/tmp/study/fichier1", False)])
+            state = CubicWebUserState(
+                [repo.connect("user", "secret")], "user", ["test"], [repo],
+                "/", index_dir=index_dir, pools=[pool])
+            state.path_translator.search_request.get_rset_size("search1", 0)
+            self.assertEqual(pool.stats()["timeouts"], 0)
+        finally:
+            shutil.rmtree(index_dir)
+
+    def test_search_eid(self):
+        """ Test that the CWSearch eid of an index is requested once, and
+        that a deleted CWSearch is reported as a missing directory.
+        """
+        repo = Repository()
+        pool = ConnectionPool(None, 1, name="test")
+        index_dir = tempfile.mkdtemp()
+        try:
+            SearchIndex.build(get_index_file(index_dir, u"search1"),
+                              [u"/tmp/study/fichier1"], u"/tmp")
+            state = CubicWebUserState(
+                [repo.connect("user", "secret")], "user", ["test"], [repo],
+                "/", index_dir=index_dir, pools=[pool])
+            search = state.path_translator.search_request
+            search.cwusers = [1]
+            virtpath = VirtualPath("search1", "study", "/tmp", "test")
+            for index in range(3):
+                self.assertEqual(search.get_dir_files(virtpath, 0),
+                                 [(u"/tmp/study/fichier1", False)])
+            self.assertEqual(pool.stats()["acquired"], 1)
+
+            # The CWSearch has been deleted
+            search.search_eids.clear()
+            connection = search.connection
+            search.connection = lambda session_index: EmptyConnection()
+            try:
+                search.get_dir_files(virtpath, 0)
+                self.fail("A missing CWSearch must raise an OSError")
+            except OSError as error:
+                self.assertEqual(error.errno, errno.ENOENT)
+            finally:
+                search.connection = connection
+        finally:
+            shutil.rmtree(index_dir)
+
+    def test_effective_user_lock(self):
+        """ Test that the process user accesses wait for the effective user
+        switches of the other threads.
+        """
+        lock = EffectiveUserLock()
+        accesses = []
+
+        def access():
+            with lock.shared():
+                accesses.append(threading.current_thread())
+
+        # The shared accesses run concurrently
+        with lock.shared():
+            thread = threading.Thread(target=access)
+            thread.start()
+            thread.join(1)
+            self.assertEqual(len(accesses), 1)
+
+        # The shared accesses of the other threads wait for the exclusive
+        # mode, which can be nested
+        lock.acquire_exclusive()
+        lock.acquire_exclusive()
+        try:
+            with lock.shared():
+                pass
+            thread = threading.Thread(target=access)
+            thread.start()
+            thread.join(0.1)
+            self.assertEqual(len(accesses), 1)
+            lock.release_exclusive()
+            thread.join(0.1)
+            self.assertEqual(len(accesses), 1)
+        finally:
+            lock.release_exclusive()
+        thread.join(1)
+        self.assertEqual(len(accesses), 2)
+
+    def test_index_process_user(self):
+        """ Test that the index connection of each thread waits for the
+        effective user switches.
+        """
+        index_dir = tempfile.mkdtemp()
+        try:
+            index_file = get_index_file(index_dir, u"search1")
+            SearchIndex.build(index_file, [u"/tmp/study/fichier1"], u"/tmp")
+            search = ServerSearch([], [], index_dir=index_dir)
+            virtpath = VirtualPath("search1", "study", "/tmp", "test")
+            expected = [(u"/tmp/study/fichier1", False)]
+            self.assertEqual(search.get_indexed_files(virtpath, index_file),
+                             expected)
+
+            # A new thread opens its own connection
+            results = []
+            thread = threading.Thread(target=lambda: results.append(
+                search.get_indexed_files(virtpath, index_file)))
+            thread.daemon = True
+            EFFECTIVE_USER_LOCK.acquire_exclusive()
+            try:
+                thread.start()
+                thread.join(0.1)
+                self.assertEqual(results, [])
+            finally:
+                EFFECTIVE_USER_LOCK.release_exclusive()
+            thread.join(1)
+            self.assertEqual(results, [expected])
+        finally:
+            shutil.rmtree(index_dir)
+
+    @unittest.skipIf(os.getuid() != 0, "the user switch needs root")
+    def test_run_as_unknown_user(self):
+        """ Test that a failed user switch releases the effective user
+        lock and keeps the process user.
+        """
+        class UnknownUser(CubicWebConchUser):
+            def __init__(self):
+                pass
+
+            def getUserGroupId(self):
+                raise KeyError("unknown user")
+
+        user = UnknownUser()
+        euid, egid = os.geteuid(), os.getegid()
+        self.assertRaises(KeyError, user._runAsUser, os.getpid)
+        self.assertEqual((os.geteuid(), os.getegid()), (euid, egid))
+        accesses = []
+
+        def access():
+            with EFFECTIVE_USER_LOCK.shared():
+                accesses.append(1)
+
+        thread = threading.Thread(target=access)
+        thread.daemon = True
+        thread.start()
+        thread.join(1)
+        self.assertEqual(accesses, [1])
+
+    def test_user_state(self):
+        """ Test the cubicweb state shared by the connections of a user.
+        """
+        repos = [Repository(), Repository()]
+        pools = [ConnectionPool(None, 1, name=name)
+                 for name in ("test", "test2")]
+        realm = CubicWebSFTPRealm(
+            ["test", "test2"], repos,
+            {"unix-username": "root", "base-dir": "/", "index-dir": ""},
+            pools=pools)
+        checker = CubicWebCredentialsChecker(
+            repos, user_states=realm.user_states)
+        credentials = namedtuple("Credentials", ("username", "password"))
+        identities, logouts = [], []
+        for index in range(3):
+            checker.requestAvatarId(
+                credentials("user", "secret")).addCallback(identities.append)
+            interface, user, logout = realm.requestAvatar(
+                identities[-1], None, None)
+            logouts.append(logout)
+        self.assertEqual(identities[0], ("user", [0, 0]))
+        self.assertEqual(identities[1:], [("user", None)] * 2)
+        self.assertEqual(len(repos[0].sessions), 1)
+        self.assertEqual(realm.user_states["user"].nb_references, 3)
+
+        # The instances are only requested on the first access to their tree
+        self.assertEqual([repo.nb_internal_cnx for repo in repos], [0, 0])
+        list(user.path_translator.list_directory("/test2"))
+        self.assertEqual([repo.nb_internal_cnx for repo in repos], [0, 1])
+        self.assertEqual([pool.stats()["acquired"] for pool in pools], [0, 2])
+        errors = []
+        checker.requestAvatarId(
+            credentials("user", "wrong")).addErrback(errors.append)
+        self.assertEqual(len(errors), 1)
+        for logout in logouts:
+            self.assertFalse(repos[0].sessions[0].closed)
+            logout()
+        self.assertTrue(repos[0].sessions[0].closed)
+        self.assertEqual(realm.user_states, {})
+
     def test_get_attrs(self):
         """ Test the get attributes method.
         """
@@ -138,13 +479,64 @@ class TestTwistedSFTPServer(unittest.TestCase):
                 "/{0}".format(self.search.instance)).st_mode,
             self.path_translator.dir_perm)
 
+    def test_sorted_files(self):
+        """ Test the children of a directory found in the sorted files.
+        """
+        files = SortedFiles([("/study/a/x", False),
+                             ("/study/a.txt", False),
+                             ("/study/a/y/z", False),
+                             ("/study/b", False),
+                             ("/study/a", False),
+                             ("/study0/c", False),
+                             ("/study/a/x", False),
+                             ("/study/a/w/", False),
+                             ("/study/rset.json", True)])
+        self.assertEqual(files.children("/"), [
+            ("/study", False), ("/study0", False)])
+        self.assertEqual(files.children("/study/"), [
+            ("/study/a", False), ("/study/a.txt", False),
+            ("/study/b", False), ("/study/rset.json", True)])
+        self.assertEqual(files.children("/study/a"), [
+            ("/study/a/w", False), ("/study/a/x", False),
+            ("/study/a/y", False)])
+        self.assertEqual(files.children("/study/a/w"), [])
+        self.assertEqual(files.children("/study/c"), [])
+
+    def test_search_index(self):
+        """ Test that the user CWSearch names are loaded once.
+        """
+        calls = []
+        get_searches = self.search.get_searches
+        self.search.get_searches = lambda *args: (
+            calls.append(1) or get_searches(*args))
+        path = "/{0}".format(self.search.instance)
+        for index in range(3):
+            list(self.path_translator.list_directory(path))
+            self.path_translator.stat(path + "/search1")
+        self.assertEqual(len(calls), 1)
+        self.assertRaises(OSError, self.path_translator.stat,
+                          path + "/search3")
+        self.assertEqual(len(calls), 1)
+
+        # The names are reloaded once expired
+        times = self.path_translator.search_index_times
+        for name in times:
+            times[name] -= self.path_translator.search_index_ttl
+        list(self.path_translator.list_directory(path))
+        self.assertEqual(len(calls), 2)
+
     def test_open_file_entity(self):
         """ Try to access a file.
         """
         virtpath = self.path_translator.split_virtual_path(
             "/test/search1/rien_12345")
-        self.assertTrue(self.path_translator.is_file_entity(virtpath))
-        ftp_file = self.path_translator.open_cw_file(virtpath)
+        file_entity = self.path_translator.is_file_entity(virtpath)
+        self.assertEqual(file_entity, ("12345", False))
+        # The matches of the other connections of the user do not interfere
+        self.assertEqual(self.path_translator.is_file_entity(
+            self.path_translator.split_virtual_path(
+                "/test/search1/request_result.json")), (None, True))
+        ftp_file = self.path_translator.open_cw_file(virtpath, file_entity)
         expected_file_content = "nothing in 12345"
         self.assertEqual(expected_file_content,
                          ftp_file.readChunk(0, -1))